@@ -24,11 +24,10 @@ this program. If not, see <http://www.gnu.org/licenses/>.
 """
 
 from enum import Enum
-import threading
 import time
-from getkey import getkey, keys
 
 from lib.drone import Drone
+from lib.keyinput import KeyboardInput, IDLE
 
 class State(Enum):
     SOCKET_CREATE     = 1
@@ -39,86 +38,10 @@ class State(Enum):
 
 state = State.SOCKET_CREATE
 
-controlState = {
-    'throttle': 0.5,
-    'pitch': 0.5,
-    'roll': 0.5,
-    'yaw': 0.5
-}
-
-lastKeyChange = 0
-
-# Thread used to monitor keyboard input for control state
-def keycodeThread():
-    global lastKeyChange
-    global controlState
-
-    while state != State.INTERRUPT:
-
-        key = getkey(blocking=True)
-
-        # throttle
-        if key == keys.UP:
-            controlState['throttle'] = 0.85
-        elif key == keys.DOWN:
-            controlState['throttle'] = 0.0
-        else:
-            controlState['throttle'] = 0.5
-
-        # roll
-        if key == keys.LEFT:
-            controlState['roll'] = 0.3
-        elif key == keys.RIGHT:
-            controlState['roll'] = 0.7
-        else:
-            controlState['roll'] = 0.5
-
-        # pitch
-        if key == 'w':
-            controlState['pitch'] = 0.3
-        elif key == 's':
-            controlState['pitch'] = 0.7
-        else:
-            controlState['pitch'] = 0.5
-
-        # yaw - note: its 100% or 0% for yaw, no scaling
-        if key == 'a':
-            controlState['yaw'] = 0.0
-        elif key == 'd':
-            controlState['yaw'] = 1.0
-        else:
-            controlState['yaw'] = 0.5
-
-        lastKeyChange = int(round(time.time() * 1000))
-
-def keytimeoutThread():
-    # workaround for some weird blocking stuff with
-    # getting currently pressed keys
-
-    global lastKeyChange
-    global controlState
-
-    while state != State.INTERRUPT:
-        if lastKeyChange > 0:
-            now = int(round(time.time() * 1000))
-
-            if now - lastKeyChange > 200:
-                controlState = {
-                    'throttle': 0.5,
-                    'pitch': 0.5,
-                    'roll': 0.5,
-                    'yaw': 0.5
-                }
-
-
 if __name__ == '__main__':
-    # Setup keycode thread
-    keycodes = threading.Thread(target=keycodeThread, daemon=True)
-    keycodes.start()
-
-    # Hack for some input blocking related stuff
-    keycodesHack = threading.Thread(target=keytimeoutThread, daemon=True)
-    keycodesHack.start()
+    # Key presses update the setpoint on their own threads
+    keyboard = KeyboardInput()
+    keyboard.start()
 
     drone = Drone()
 
@@ -143,10 +66,7 @@ if __name__ == '__main__':
                     state = State.SOCKET_CREATE
 
             elif state == State.TAKEOFF:
-                if (controlState['throttle'] != 0.5 or
-                    controlState['pitch'] != 0.5 or
-                    controlState['roll'] != 0.5 or
-                    controlState['yaw'] != 0.5):
+                if keyboard.setpoint() != IDLE:
 
                     startTime = time.time_ns() // 1_000_000
 
@@ -154,17 +74,26 @@ if __name__ == '__main__':
                         drone.takeoff()
                         time.sleep(0.01)
 
+                    # The key that started the takeoff waited for it on purpose,
+                    # so isn't counted towards latency
+                    keyboard.skip()
                     state = State.CONTROL_LOOP
                 else:
                     drone.idle()
 
             elif state == State.CONTROL_LOOP:
                 try:
-                    drone.control(controlState['throttle'], controlState['pitch'], controlState['roll'], controlState['yaw'])
+                    setpoint, timestamp = keyboard.current()
+                    drone.control(*setpoint)
+                    keyboard.delivered(timestamp)
                 except KeyboardInterrupt as e:
                     raise e
                 except Exception as e:
                     state = State.SOCKET_CREATE
 
     except KeyboardInterrupt as e:
-        state = State.INTERRUPT
\ No newline at end of file
+        state = State.INTERRUPT
+        keyboard.stop()
+
+        print('Key to send latency: {:.2f}ms mean, {:.2f}ms worst'.format(
+            keyboard.stats()['latencyMean'] * 1000, keyboard.stats()['latencyMax'] * 1000))
@@ -0,0 +1,282 @@
+"""
+Matt Clarke 2021.
+asyncio version of the Drone class, so that one event loop can drive
+many drones without a thread per drone.
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import asyncio
+
+from lib.drone import Drone, ticksMs
+
+class AsyncDrone(Drone):
+    """
+    This class handles sending commands to the remote drone, from inside an
+    asyncio event loop.
+
+    It behaves as Drone does, except that the methods below are coroutines
+    and never block the event loop.
+
+    `capture` and `metrics` record sends and replies as they do on Drone, and
+    `keepaliveFloor` enables send-on-change as it does on Drone.
+
+    Exported methods:
+    - videoType()
+    - firmware()
+    - async connect()
+    - async setup()
+    - async takeoff()
+    - async arm()
+    - async idle()
+    - async control(throttle, pitch, roll, yaw)
+    - close()
+
+    Example:
+
+        drone = AsyncDrone()
+        if await drone.connect():
+            await drone.setup()
+            await drone.takeoff()
+    """
+
+    # Delay before each send, mirroring Drone. Set to 0 to pace externally
+    interval = 0.01
+
+    # Seconds to wait for each reply during setup()
+    timeout = 1.0
+
+    def __init__(self):
+        self.udpTransport = None
+        self.tcpReader = None
+        self.tcpWriter = None
+
+        self._replies = asyncio.Queue()
+
+    async def connect(self, ip = '192.168.1.1', udpPort = 8080, tcpPort = 8888, timeout = None):
+        """
+        Sets up the transports used for communication to the drone. UDP and TCP
+        are brought up concurrently. Any previous transports are closed first,
+        and unread replies discarded; if either endpoint fails, neither is kept.
+
+        Parameters:
+            ip      (string): IP address of the drone. This is defaults to 192.168.1.1, but may differ by manufacturer.
+            udpPort (int):    UDP port of the drone.
+            tcpPort (int):    TCP port of the drone.
+            timeout (float):  Seconds to wait for the TCP connection. Defaults to `timeout`.
+
+        Returns:
+            `True` if connection is established, otherwise `False`
+        """
+
+        loop = asyncio.get_running_loop()
+        timeout = self.timeout if timeout is None else timeout
+
+        # Nothing from an earlier connection may be kept, including replies
+        # setup() would otherwise take as answers to its own queries
+        self.close()
+        self._replies = asyncio.Queue()
+
+        replies = self._replies
+        udp = loop.create_datagram_endpoint(lambda: _ReplyProtocol(replies), remote_addr=(ip, udpPort))
+        tcp = asyncio.wait_for(asyncio.open_connection(ip, tcpPort), timeout)
+
+        results = await asyncio.gather(udp, tcp, return_exceptions=True)
+
+        # A new connection has been sent nothing yet
+        self._resetControl()
+
+        if not isinstance(results[0], BaseException):
+            self.udpTransport = results[0][0]
+        if not isinstance(results[1], BaseException):
+            self.tcpReader, self.tcpWriter = results[1]
+
+        if self.udpTransport is None or self.tcpWriter is None:
+            self.close()
+            return False
+
+        # Validate the connection worked
+        try:
+            self.udpTransport.sendto(self._generateDroneIdCommand(1))
+            return True
+        except Exception:
+            self.close()
+            return False
+
+    async def setup(self, timeout = None):
+        """
+        Sends appropriate commands to arm the drone. After arming, videoType and firmware
+        is available.
+
+        Parameters:
+            timeout (float): Seconds to wait for each reply. Defaults to `timeout`.
+
+        Note: this will raise asyncio.TimeoutError if a reply does not arrive in time,
+        or another exception if connection has been lost.
+        """
+
+        timeout = self.timeout if timeout is None else timeout
+
+        # No data to recieve on these two
+        await self.safeSend(self._generateDroneIdCommand(1))
+        await self.safeSend(self._generateSetDateCommand(None))
+        await self.safeSend(self._generateSecondSetupCommand())
+
+        # Get drone video type
+        await self.safeSend(b'\x42')
+        self.videoType_ = (await self.recieve(6, timeout)).decode('ascii')
+
+        # Get drone firmware
+        # Due to seemingly a drone-side bug, gotta call this twice
+        await self.safeSend(b'\x28')
+        await self.recieve(6, timeout)
+        await self.safeSend(b'\x28')
+        self.firmware_ = (await self.recieve(6, timeout)).decode('ascii')
+
+        # Send first heartbeat
+        await self.safeSendTcp(self._generateHeartbeatCommand())
+        data = await asyncio.wait_for(self.tcpReader.read(20), timeout) # ignore
+        if self.capture is not None: self.capture.record(3, data) # TCP_IN
+
+    async def idle(self):
+        """
+        Sends an "idle" control command. See Drone.idle().
+        """
+
+        await self.control(0.5, 0.5, 0.5, 0.5)
+
+    async def takeoff(self):
+        """
+        Sends a takeoff command to the drone. See Drone.takeoff().
+        """
+
+        await self.safeSend(self._generateTakeoffCommand())
+
+        # The next control frame differs from this on the wire
+        self._lastControlSend = None
+
+    async def arm(self):
+        """
+        Arms the drone for a manual takeoff. See Drone.arm().
+        """
+
+        await self.control(1.0, 0.5, 0.5, 0.5)
+        await self.control(0.5, 0.5, 0.5, 0.5)
+
+    async def control(self, throttle, pitch, roll, yaw):
+        """
+        Sends a control command to the drone. See Drone.control().
+        """
+
+        if self.keepaliveFloor is None:
+            await self.safeSend(self._generateControlCommand(throttle, pitch, roll, yaw))
+            self.framesSent += 1
+            return
+
+        if self.frameCache is not None:
+            controlPacket = self._generateControlCommand(throttle, pitch, roll, yaw)
+            held = self._holdFrame(controlPacket)
+        else:
+            held = self._holdControl(throttle, pitch, roll, yaw)
+
+            # Copied, as the transport may buffer it past the next update
+            controlPacket = bytes(self.controlFrame.view)
+
+        if held:
+            # Hold the same timing as a send
+            await self.pace()
+            self.framesSuppressed += 1
+            return
+
+        try:
+            await self.safeSend(controlPacket)
+        except BaseException as e:
+            # The frame may never have reached the drone, so the next call
+            # sends it regardless
+            self._lastControlSend = None
+            raise e
+
+        self.framesSent += 1
+        self._lastControlSend = ticksMs()
+
+    def close(self):
+        """
+        Closes both transports. Safe to call more than once.
+        """
+
+        if self.udpTransport is not None:
+            self.udpTransport.close()
+            self.udpTransport = None
+
+        if self.tcpWriter is not None:
+            self.tcpWriter.close()
+            self.tcpWriter = None
+            self.tcpReader = None
+
+    #############################################################################
+    # Private - Communication
+    #############################################################################
+
+    async def pace(self):
+        if self.interval > 0:
+            await asyncio.sleep(self.interval)
+
+    async def safeSend(self, data):
+        await self.pace()
+
+        try:
+            if self.metrics is None:
+                self.udpTransport.sendto(data)
+            else:
+                started = self.metrics.clock()
+                self.udpTransport.sendto(data)
+                self.metrics.sent('udp', len(data), started)
+
+            if self.capture is not None: self.capture.record(0, data) # UDP_OUT
+        except Exception as e:
+            if self.metrics is not None: self.metrics.error('udp')
+            print('send ' + str(e))
+            raise e
+
+    async def safeSendTcp(self, data):
+        await self.pace()
+
+        try:
+            if self.metrics is None:
+                self.tcpWriter.write(data)
+                await self.tcpWriter.drain()
+            else:
+                started = self.metrics.clock()
+                self.tcpWriter.write(data)
+                await self.tcpWriter.drain()
+                self.metrics.sent('tcp', len(data), started)
+
+            if self.capture is not None: self.capture.record(1, data) # TCP_OUT
+        except Exception as e:
+            if self.metrics is not None: self.metrics.error('tcp')
+            print('send (tcp) ' + str(e))
+            raise e
+
+    # Waits for the next UDP reply
+    async def recieve(self, bufferSize, timeout = None):
+        data = (await asyncio.wait_for(self._replies.get(), timeout))[:bufferSize]
+        if self.capture is not None: self.capture.record(2, data) # UDP_IN
+        return data
+
+class _ReplyProtocol(asyncio.DatagramProtocol):
+    # Queues every datagram recieved from the drone
+
+    def __init__(self, replies):
+        self.replies = replies
+
+    def datagram_received(self, data, addr):
+        self.replies.put_nowait(data)
@@ -0,0 +1,104 @@
+"""
+Matt Clarke 2021.
+Vectorised encoding of control packets, for whole flight plans or many
+drones at once.
+
+Dependencies:
+    - numpy
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import numpy as np
+
+# Every control frame is a 2 byte header, followed by 9 single byte fields
+FRAME_SIZE = 11
+
+def encodeControlFrames(throttle, pitch, roll, yaw, command = 0x01, throttleTrim = 0x10, rollTrim = 0x10, pitchTrim = 0x10):
+    """
+    Encodes many control commands in one pass, returning them as one contiguous
+    buffer of `ff08` frames.
+
+    The output is byte-identical to calling Drone.control() once per element,
+    so frame `i` is found at `[i * FRAME_SIZE, (i + 1) * FRAME_SIZE)`.
+
+    All arguments are broadcast against each other, so trims and flags may be
+    given either per-frame or as a single value.
+
+    Parameters:
+        throttle     (array): Throttle %, [0.0 to 1.0]
+        pitch        (array): Pitch angle, [0.0 to 1.0]
+        roll         (array): Roll angle, [0.0 to 1.0]
+        yaw          (array): Yaw amount, [0.0 | 1.0]
+        command      (array): Flags, defaults to 0x01
+        throttleTrim (array): Throttle trim, [0x00 to 0x20]
+        rollTrim     (array): Roll trim, [0x00 to 0x20]
+        pitchTrim    (array): Pitch trim, [0x00 to 0x20]
+
+    Returns:
+        A bytes object of length `n * FRAME_SIZE`
+
+    Raises:
+        ValueError if any value is NaN, or a field or checksum does not fit in a byte
+    """
+
+    # One broadcast across all eight, so any mix of scalars and arrays works.
+    # Trims and flags are passed straight through as integers.
+    throttle, pitch, roll, yaw, command, throttleTrim, rollTrim, pitchTrim = np.broadcast_arrays(
+        *(np.asarray(value, dtype=np.float64).ravel() for value in (throttle, pitch, roll, yaw)),
+        *(np.asarray(value, dtype=np.int64).ravel() for value in (command, throttleTrim, rollTrim, pitchTrim)))
+
+    count = throttle.shape[0]
+
+    # int() on a NaN raises in the scalar path, so do the same here
+    if np.isnan(throttle).any() or np.isnan(pitch).any() or np.isnan(roll).any() or np.isnan(yaw).any():
+        raise ValueError('cannot encode NaN control values')
+
+    throttleScaled = _scale(throttle, 0xff, 0xff, 0xff)
+    pitchScaled    = _scale(pitch, 0x80, 0x7e, 0x7f)
+    rollScaled     = _scale(roll, 0x80, 0x7e, 0x7f)
+    yawScaled      = _scale(yaw, 0x80, 0x7e, 0x7f)
+
+    endByte = (0x87 + (0x7f - throttleScaled) + (0x40 - yawScaled) + (0x40 - pitchScaled) + (0x40 - rollScaled) +
+               (0x10 - throttleTrim) + (0x10 - rollTrim) + (0x10 - pitchTrim) + (0x01 - command))
+
+    # Same wrapping as the scalar path, where the two cases are exclusive: a
+    # negated sum that is still out of range must be refused, not wrapped again
+    endByte = np.where(endByte < 0x0, 0x0 - endByte, np.where(endByte > 0xff, endByte - 0xff - 1, endByte))
+
+    frames = np.empty((count, FRAME_SIZE), dtype=np.int64)
+    frames[:, 0] = 0xff
+    frames[:, 1] = 0x08
+    frames[:, 2] = throttleScaled
+    frames[:, 3] = yawScaled
+    frames[:, 4] = pitchScaled
+    frames[:, 5] = rollScaled
+    frames[:, 6] = throttleTrim
+    frames[:, 7] = pitchTrim
+    frames[:, 8] = rollTrim
+    frames[:, 9] = command
+    frames[:, 10] = endByte
+
+    # struct.pack would raise for these in the scalar path
+    if count > 0 and (frames.min() < 0x00 or frames.max() > 0xff):
+        raise ValueError('control frame field out of range for a byte')
+
+    return frames.astype(np.uint8).tobytes()
+
+def _scale(value, factor, ceiling, maximum):
+    # Mirrors the clamping in Drone: anything at or above `ceiling` becomes
+    # `maximum`, then truncates towards zero like int()
+    scaled = factor * value
+    scaled = np.where(scaled >= ceiling, maximum, scaled)
+    scaled = np.where(scaled < 0x00, 0x00, scaled)
+
+    return scaled.astype(np.int64)
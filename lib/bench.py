@@ -0,0 +1,298 @@
+"""
+Matt Clarke 2021.
+Benchmarks for the Drone class, run against a local Simulator.
+
+Usage:
+    python -m lib.drone bench [--json results.json] [--compare previous.json]
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import argparse
+import json
+import platform
+import sys
+import time
+
+from lib.cache import FrameCache
+from lib.drone import ControlFrame, Drone
+from lib.handshake import handshake
+from lib.pacer import Pacer
+from lib.simulator import Simulator
+
+def benchEncode(iterations = 100000):
+    """
+    Measures the cost of generating each kind of frame.
+
+    Returns:
+        A dict of frame name to ns/op, plus `speedup`: how many times faster
+        than `control` each alternative is
+    """
+
+    drone = Drone()
+
+    cached = Drone()
+    cached.frameCache = FrameCache()
+
+    frame = ControlFrame()
+
+    # Alternates between two setpoints, so every call changes the frame
+    def controlFrame():
+        frame.set(0.7, 0.3, 0.6, 0.5)
+        frame.set(0.4, 0.6, 0.2, 0.5)
+
+    cases = {
+        'control': lambda: drone._generateControlCommand(0.7, 0.3, 0.6, 0.5),
+        'controlCached': lambda: cached._generateControlCommand(0.7, 0.3, 0.6, 0.5),
+        'controlFrame': controlFrame,
+        'controlFrameUnchanged': lambda: frame.set(0.7, 0.3, 0.6, 0.5),
+        'takeoff': drone._generateTakeoffCommand,
+        'idle':    lambda: drone._generateControlCommand(0.5, 0.5, 0.5, 0.5),
+    }
+
+    results = {}
+    for name, fn in cases.items():
+        results[name] = _timePerCall(fn, iterations)
+
+    # Two changes per call
+    results['controlFrame'] /= 2
+
+    results['speedup'] = {
+        'controlCached': results['control'] / results['controlCached'],
+        'controlFrame': results['control'] / results['controlFrame'],
+    }
+
+    return results
+
+def benchSend(rate = 100, duration = 2.0, spin = 0.0):
+    """
+    Sends control frames over loopback UDP to a Simulator, both paced at `rate`
+    and as fast as possible.
+
+    Jitter is the deviation of each inter-packet interval, as seen by the
+    simulator, from the target period.
+
+    Returns:
+        A dict with `paced` and `unpaced` results
+    """
+
+    sim = Simulator('127.0.0.1', 0, 0)
+    sim.start()
+
+    try:
+        drone = Drone()
+        drone.connect(*sim.address())
+
+        drone.pacer = Pacer(rate, spin)
+        paced = _sendFor(drone, sim, duration)
+
+        period = 1.0 / rate
+        paced['target'] = rate
+        paced['jitter'] = _percentiles([abs(interval - period) for interval in paced.pop('intervals')])
+
+        drone.pacer = _Unpaced()
+        unpaced = _sendFor(drone, sim, min(duration, 0.5))
+        unpaced.pop('intervals')
+    finally:
+        sim.stop()
+
+    return { 'paced': paced, 'unpaced': unpaced }
+
+def benchSetup(runs = 10):
+    """
+    Measures the round-trip time of Drone.setup() against a Simulator.
+
+    Returns:
+        Percentiles of setup() duration in seconds
+    """
+
+    sim = Simulator('127.0.0.1', 0, 0)
+    sim.start()
+
+    durations = []
+
+    try:
+        for _ in range(runs):
+            drone = Drone()
+            drone.connect(*sim.address())
+
+            start = time.perf_counter()
+            drone.setup()
+            durations.append(time.perf_counter() - start)
+
+            drone.udpsocket.close()
+            drone.tcpsocket.close()
+    finally:
+        sim.stop()
+
+    return _percentiles(durations)
+
+def benchHandshake(runs = 10):
+    """
+    Measures the duration of lib.handshake.handshake() against a Simulator.
+
+    Returns:
+        Percentiles of handshake() duration in seconds
+    """
+
+    sim = Simulator('127.0.0.1', 0, 0)
+    sim.start()
+
+    durations = []
+
+    try:
+        for _ in range(runs):
+            drone = Drone()
+            result = handshake(drone, *sim.address())
+
+            if not result.ok:
+                raise RuntimeError('handshake failed: ' + result.error)
+
+            durations.append(result.timings['total'])
+
+            drone.udpsocket.close()
+            drone.tcpsocket.close()
+    finally:
+        sim.stop()
+
+    return _percentiles(durations)
+
+def run(rate = 100, duration = 2.0, spin = 0.0, setupRuns = 10):
+    """
+    Runs the full suite.
+
+    Returns:
+        A JSON-serialisable dict of results
+    """
+
+    return {
+        'meta': {
+            'time': time.time(),
+            'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'platform': platform.platform(),
+        },
+        'encode': benchEncode(),
+        'send': benchSend(rate, duration, spin),
+        'setup': benchSetup(setupRuns),
+        'handshake': benchHandshake(setupRuns),
+    }
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog='python -m lib.drone bench', description='Benchmark the drone library against a local simulator.')
+    parser.add_argument('--rate', type=float, default=100, help='paced send rate in Hz (default: 100)')
+    parser.add_argument('--duration', type=float, default=2.0, help='seconds to send for (default: 2)')
+    parser.add_argument('--spin', type=float, default=0.0, help='pacer spin window in seconds (default: 0)')
+    parser.add_argument('--setup-runs', type=int, default=10, help='number of setup() round trips (default: 10)')
+    parser.add_argument('--json', help='write results to this file')
+    parser.add_argument('--compare', help='show changes against a previous results file')
+    args = parser.parse_args(argv)
+
+    results = run(args.rate, args.duration, args.spin, args.setup_runs)
+
+    previous = None
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+
+    for key, value in _flatten(results):
+        if key.startswith('meta.'):
+            continue
+
+        line = '{:<32} {:>14.6g}'.format(key, value)
+
+        before = _lookup(previous, key)
+        if before:
+            line += '  {:+7.1f}%'.format((value - before) / before * 100.0)
+
+        print(line)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    return 0
+
+#############################################################################
+# Private
+#############################################################################
+
+class _Unpaced:
+    # Stands in for a Pacer that never waits
+
+    def wait(self):
+        return 0.0
+
+def _timePerCall(fn, iterations):
+    clock = time.perf_counter_ns
+
+    start = clock()
+    for _ in range(iterations):
+        fn()
+
+    return (clock() - start) / iterations
+
+def _sendFor(drone, sim, duration):
+    before = len(sim.frames())
+
+    sent = 0
+    start = time.perf_counter()
+    end = start + duration
+
+    while time.perf_counter() < end:
+        drone.control(0.5, 0.5, 0.5, 0.5)
+        sent += 1
+
+    elapsed = time.perf_counter() - start
+
+    # Let the simulator catch up with anything still in flight
+    time.sleep(0.1)
+    recieved = [frame[0] for frame in sim.frames()[before:]]
+
+    return {
+        'sent': sent,
+        'recieved': len(recieved),
+        'rate': sent / elapsed,
+        'intervals': [b - a for a, b in zip(recieved, recieved[1:])],
+    }
+
+def _percentiles(values):
+    if not values:
+        return { 'p50': 0.0, 'p90': 0.0, 'p99': 0.0, 'max': 0.0 }
+
+    ordered = sorted(values)
+    last = len(ordered) - 1
+
+    return {
+        'p50': ordered[int(last * 0.50)],
+        'p90': ordered[int(last * 0.90)],
+        'p99': ordered[int(last * 0.99)],
+        'max': ordered[last],
+    }
+
+def _flatten(results, prefix = ''):
+    for key, value in results.items():
+        if isinstance(value, dict):
+            yield from _flatten(value, prefix + key + '.')
+        elif isinstance(value, (int, float)):
+            yield prefix + key, value
+
+def _lookup(results, key):
+    for part in key.split('.'):
+        if not isinstance(results, dict) or part not in results:
+            return None
+        results = results[part]
+
+    return results
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
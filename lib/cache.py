@@ -0,0 +1,128 @@
+"""
+Matt Clarke 2021.
+Caching of prebuilt control frames, keyed on the setpoints they encode.
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from collections import OrderedDict
+import threading
+
+class FrameCache:
+    """
+    A bounded cache of control frames, keyed on the quantized fields they
+    encode: the scaled setpoints, trims and command flags.
+
+    Controllers tend to re-send the same few setpoints, e.g. keyboard bindings
+    or idle. Since nearby inputs quantize to the same fields, a stick moving
+    slowly also lands on frames already built. A hit skips the checksum and
+    packing, and returns the same bytes object each time.
+
+    Lookups take no lock; only misses do, to insert. A hit marks its frame as
+    most recently used, and when full, the least recently used frame is
+    evicted, so frames in constant use such as idle stay cached. One cache may
+    be shared between drones, including across threads, though the hit counter
+    may then undercount.
+
+    Exported methods:
+    - get(key, build)
+    - stats()
+    - clear()
+
+    Example:
+
+        drone.frameCache = FrameCache(256)
+    """
+
+    def __init__(self, size = 256):
+        """
+        Parameters:
+            size (int): Maximum number of frames to hold
+        """
+
+        if size < 1:
+            raise ValueError('size must be at least 1')
+
+        self.size = size
+
+        # Least recently used first. Only inserted into or evicted from under
+        # the lock; hits rely on lookups and move_to_end() being atomic.
+        self._frames = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, build):
+        """
+        Returns the frame for `key`, building and caching it on a miss.
+
+        Parameters:
+            key   (tuple):    Quantized fields the frame is built from
+            build (callable): Called with `key` to build a frame on a miss
+
+        Returns:
+            The frame, as bytes
+        """
+
+        frames = self._frames
+        frame = frames.get(key)
+
+        if frame is not None:
+            try:
+                frames.move_to_end(key)
+            except KeyError:
+                # Evicted by another thread since the lookup; still valid
+                pass
+
+            self.hits += 1
+            return frame
+
+        frame = build(key)
+
+        with self._lock:
+            self.misses += 1
+
+            if key not in self._frames:
+                if len(self._frames) >= self.size:
+                    self._frames.popitem(last=False)
+                    self.evictions += 1
+
+                self._frames[key] = frame
+
+        return frame
+
+    def stats(self):
+        """
+        Returns:
+            A dict with keys `hits`, `misses`, `evictions`, `size` (current) and `capacity`
+        """
+
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'size': len(self._frames),
+            'capacity': self.size,
+        }
+
+    def clear(self):
+        """
+        Empties the cache and resets the counters.
+        """
+
+        with self._lock:
+            self._frames.clear()
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
@@ -0,0 +1,309 @@
+"""
+Matt Clarke 2021.
+Binary capture of everything sent to and recieved from a drone, and
+timing-accurate replay of captures.
+
+Usage:
+    python -m lib.drone replay capture.bin [--ip 192.168.1.1] [--udp-port 8080] [--tcp-port 8888]
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import argparse
+import mmap
+import struct
+import sys
+import threading
+import time
+
+# Directions of a record
+UDP_OUT = 0
+TCP_OUT = 1
+UDP_IN  = 2
+TCP_IN  = 3
+
+# File layout: a header of (magic, record size, record count), then
+# fixed-size records of (timestamp, direction, flags, length, data). `length`
+# is the packet's original length, which may be far beyond MAX_DATA, e.g. for
+# a chunk of video.
+MAGIC         = b'MDCAP\x00\x00\x03'
+FILE_HEADER   = struct.Struct('<8sIQ')
+RECORD_COUNT  = struct.Struct('<Q')
+COUNT_OFFSET  = 12
+RECORD_HEADER = struct.Struct('<dBBI')
+RECORD_SIZE   = 64
+MAX_DATA      = RECORD_SIZE - RECORD_HEADER.size
+
+# Set in flags when data was longer than MAX_DATA
+TRUNCATED = 0x01
+
+class CaptureWriter:
+    """
+    Appends fixed-size records to a memory-mapped capture file.
+
+    The file is grown in large chunks and records are packed straight into the
+    mapping, so recording a packet makes no system calls except when a chunk
+    fills. Records longer than MAX_DATA bytes are truncated and flagged.
+
+    The record count in the header is updated after every record, so a
+    capture that was never closed (e.g. after a crash) still reads back as
+    only the records written, not the unused rest of the last chunk.
+
+    Assign to a drone to capture everything it sends and recieves:
+
+        drone.capture = CaptureWriter('flight.bin')
+        ...
+        drone.capture.close()
+
+    Exported methods:
+    - record(direction, data)
+    - count()
+    - close()
+    """
+
+    def __init__(self, path, chunkSize = 1 << 20, clock = time.perf_counter):
+        """
+        Parameters:
+            path      (string):   File to create. Any existing file is replaced.
+            chunkSize (int):      Bytes to grow the file by when full
+            clock     (callable): Monotonic clock returning seconds
+        """
+
+        self.path = path
+
+        self._clock = clock
+        self._chunkSize = max(RECORD_SIZE, chunkSize - chunkSize % RECORD_SIZE)
+        self._lock = threading.Lock()
+
+        self._file = open(path, 'w+b')
+        self._size = FILE_HEADER.size + self._chunkSize
+        self._file.truncate(self._size)
+
+        self._map = mmap.mmap(self._file.fileno(), self._size)
+        FILE_HEADER.pack_into(self._map, 0, MAGIC, RECORD_SIZE, 0)
+
+        self._offset = FILE_HEADER.size
+        self._count = 0
+
+    def record(self, direction, data):
+        """
+        Appends one record, timestamped now.
+
+        Parameters:
+            direction (int):   UDP_OUT, TCP_OUT, UDP_IN or TCP_IN
+            data      (bytes): Raw packet; any buffer is accepted
+        """
+
+        timestamp = self._clock()
+        length = len(data)
+
+        flags = 0
+        if length > MAX_DATA:
+            flags = TRUNCATED
+            data = data[:MAX_DATA]
+
+        with self._lock:
+            if self._map is None:
+                return
+
+            if self._offset + RECORD_SIZE > self._size:
+                self.__grow()
+
+            offset = self._offset
+            RECORD_HEADER.pack_into(self._map, offset, timestamp, direction, flags, length)
+
+            start = offset + RECORD_HEADER.size
+            self._map[start:start + len(data)] = data
+
+            self._offset = offset + RECORD_SIZE
+            self._count += 1
+
+            # Only after the record itself, so the count never covers a
+            # partly written record
+            RECORD_COUNT.pack_into(self._map, COUNT_OFFSET, self._count)
+
+    def count(self):
+        """
+        Returns:
+            The number of records written
+        """
+
+        return self._count
+
+    def close(self):
+        """
+        Flushes the capture, and trims the file to the records written.
+        """
+
+        with self._lock:
+            if self._map is None:
+                return
+
+            self._map.flush()
+            self._map.close()
+            self._map = None
+
+            self._file.truncate(self._offset)
+            self._file.close()
+
+    def __grow(self):
+        self._map.flush()
+        self._map.close()
+
+        self._size += self._chunkSize
+        self._file.truncate(self._size)
+        self._map = mmap.mmap(self._file.fileno(), self._size)
+
+def readCapture(path):
+    """
+    Reads every record from a capture file, including one that was never
+    closed.
+
+    Parameters:
+        path (string): A file written by CaptureWriter
+
+    Returns:
+        A list of (timestamp, direction, data, truncated) tuples, oldest first.
+        `data` is cut to MAX_DATA bytes if `truncated` is True.
+    """
+
+    with open(path, 'rb') as f:
+        contents = f.read()
+
+    magic, recordSize, count = FILE_HEADER.unpack_from(contents, 0)
+    if magic != MAGIC:
+        if magic[:5] == MAGIC[:5]:
+            raise ValueError('unsupported capture format version: ' + path)
+
+        raise ValueError('not a capture file: ' + path)
+
+    # Anything past the count is unused space in the last chunk
+    end = min(len(contents), FILE_HEADER.size + count * recordSize)
+
+    records = []
+
+    for offset in range(FILE_HEADER.size, end - recordSize + 1, recordSize):
+        timestamp, direction, flags, length = RECORD_HEADER.unpack_from(contents, offset)
+
+        start = offset + RECORD_HEADER.size
+        data = contents[start:start + min(length, recordSize - RECORD_HEADER.size)]
+
+        records.append((timestamp, direction, data, bool(flags & TRUNCATED)))
+
+    return records
+
+def replay(records, drone, speed = 1.0, spin = 0.002, clock = time.perf_counter, sleep = time.sleep):
+    """
+    Sends the outgoing records of a capture to a drone, with their original
+    inter-packet timing.
+
+    Each packet is scheduled against a deadline measured from the start of the
+    replay, so any lateness does not accumulate.
+
+    Parameters:
+        records (list):     As returned from readCapture()
+        drone   (Drone):    A connected drone, or one connected to a Simulator
+        speed   (float):    Playback speed; 2.0 is twice as fast as recorded
+        spin    (float):    Seconds before each deadline to busy-wait instead of sleeping
+        clock   (callable): Monotonic clock returning seconds
+        sleep   (callable): Sleep function taking seconds
+
+    Returns:
+        A dict describing how far the replay deviated from the recorded timing, with keys
+        `sent`, `skipped` (truncated records) and `deviationMean`, `deviationP50`,
+        `deviationP99`, `deviationMax` in seconds
+    """
+
+    outgoing = [record for record in records if record[1] in (UDP_OUT, TCP_OUT)]
+
+    deviations = []
+    skipped = 0
+
+    if not outgoing:
+        return _deviationStats(deviations, 0, skipped)
+
+    first = outgoing[0][0]
+    start = clock()
+
+    for timestamp, direction, data, truncated in outgoing:
+        # A truncated packet would be corrupt on the wire
+        if truncated:
+            skipped += 1
+            continue
+
+        deadline = start + (timestamp - first) / speed
+
+        remaining = deadline - clock()
+        if remaining > spin:
+            sleep(remaining - spin)
+
+        now = clock()
+        while now < deadline:
+            now = clock()
+
+        if direction == UDP_OUT:
+            drone.safeSend(data, paced=False)
+        else:
+            drone.safeSendTcp(data, paced=False)
+
+        # Measured once the packet is out, so includes the send itself
+        deviations.append(clock() - deadline)
+
+    return _deviationStats(deviations, len(deviations), skipped)
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog='python -m lib.drone replay', description='Replay a capture to a drone or simulator.')
+    parser.add_argument('capture', help='capture file to replay')
+    parser.add_argument('--ip', default='192.168.1.1', help='drone address (default: 192.168.1.1)')
+    parser.add_argument('--udp-port', type=int, default=8080, help='UDP port (default: 8080)')
+    parser.add_argument('--tcp-port', type=int, default=8888, help='TCP port (default: 8888)')
+    parser.add_argument('--speed', type=float, default=1.0, help='playback speed (default: 1.0)')
+    args = parser.parse_args(argv)
+
+    from lib.drone import Drone
+
+    records = readCapture(args.capture)
+
+    drone = Drone()
+    if not drone.connect(args.ip, args.udp_port, args.tcp_port, timeout=2.0):
+        print('Failed to connect')
+        return 1
+
+    result = replay(records, drone, args.speed)
+
+    for key, value in result.items():
+        print('{:<16} {:>14.6g}'.format(key, value))
+
+    return 0
+
+#############################################################################
+# Private
+#############################################################################
+
+def _deviationStats(deviations, sent, skipped):
+    if not deviations:
+        return { 'sent': sent, 'skipped': skipped, 'deviationMean': 0.0, 'deviationP50': 0.0, 'deviationP99': 0.0, 'deviationMax': 0.0 }
+
+    ordered = sorted(deviations)
+    last = len(ordered) - 1
+
+    return {
+        'sent': sent,
+        'skipped': skipped,
+        'deviationMean': sum(ordered) / len(ordered),
+        'deviationP50': ordered[int(last * 0.50)],
+        'deviationP99': ordered[int(last * 0.99)],
+        'deviationMax': ordered[last],
+    }
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,359 @@
+"""
+Matt Clarke 2021.
+Continuously drains UDP replies from the drone, and matches them to the
+queries that caused them.
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from collections import deque
+from concurrent.futures import Future
+import socket
+import threading
+import time
+
+from lib.handshake import classifyReply, FIRMWARE, VIDEO_TYPE
+
+class ReplyDemux:
+    """
+    Owns the reading side of a drone's UDP socket.
+
+    A thread drains every datagram into a preallocated buffer, classifies it by
+    which query it answers, and completes any futures waiting on that query.
+    Queries are sent immediately and return a future, so they never wait on a
+    reply in the sending thread, and never stall a control stream sharing the
+    socket. Since replies are matched by content, the stale first reply to
+    `0x28` no longer needs to be thrown away by position.
+
+    The drone's firmware() and videoType() are kept up to date from any reply.
+
+    Replies to the same query can't be told apart, so are matched to sends in
+    order. A query sent with send(), such as a keepalive, or one given up on
+    with cancel(), has its reply discarded rather than completing a later
+    query early.
+
+    Exported methods:
+    - start()
+    - stop()
+    - query(command)
+    - send(command, expiry)
+    - cancel(command, future, expiry)
+    - firmware()
+    - videoType()
+    - stats()
+    - error()
+    - callbackError()
+
+    Example:
+
+        demux = ReplyDemux(drone)
+        demux.start()
+
+        print(demux.firmware().result(timeout=0.5))
+
+    Note: while started, do not call Drone.recieve() or Drone.setup(), as they
+    would compete for the same replies.
+    """
+
+    def __init__(self, drone, onReply = None, bufferSize = 2048, clock = time.perf_counter):
+        """
+        Parameters:
+            drone      (Drone):    A drone that has already been connected
+            onReply    (callable): Optional; called on the demux thread as onReply(kind, data, timestamp)
+                                   for every datagram, where kind is FIRMWARE, VIDEO_TYPE or None.
+                                   `data` is a memoryview only valid during the call.
+            bufferSize (int):      Size of the recieve buffer; longer datagrams are truncated
+            clock      (callable): Monotonic clock used for timestamps
+        """
+
+        self.drone = drone
+        self.onReply = onReply
+
+        self._clock = clock
+        self._buffer = bytearray(bufferSize)
+        self._view = memoryview(self._buffer)
+
+        self._pending = { FIRMWARE: [], VIDEO_TYPE: [] }
+        self._lock = threading.Lock()
+
+        # Expiry times of replies to discard, oldest first
+        self._discard = { FIRMWARE: deque(), VIDEO_TYPE: deque() }
+
+        self._thread = None
+        self._stopped = True
+        self._error = None
+        self._timeout = None
+
+        self._replies = { FIRMWARE: 0, VIDEO_TYPE: 0, None: 0 }
+        self._callbackErrors = 0
+        self._callbackError = None
+
+    def start(self):
+        """
+        Starts the demux thread.
+        """
+
+        if self._thread is not None:
+            return
+
+        # A short timeout lets the thread notice stop() promptly. Sends on a
+        # UDP socket never wait on it.
+        self._timeout = self.drone.udpsocket.gettimeout()
+        self.drone.udpsocket.settimeout(0.1)
+
+        self._stopped = False
+        self._error = None
+
+        self._thread = threading.Thread(target=self.__run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stops the demux thread, failing any pending queries.
+        """
+
+        if self._thread is None:
+            return
+
+        with self._lock:
+            self._stopped = True
+
+        self._thread.join()
+        self._thread = None
+
+        self.drone.udpsocket.settimeout(self._timeout)
+        self.__failPending(RuntimeError('reply demux stopped'))
+
+    def query(self, command):
+        """
+        Sends a query to the drone, without waiting for a reply.
+
+        If a query of the same kind is already pending, both are completed by
+        the next matching reply. If the demux is not running, the future has
+        already failed.
+
+        Parameters:
+            command (int): FIRMWARE (`0x28`) or VIDEO_TYPE (`0x42`)
+
+        Returns:
+            A concurrent.futures.Future, resolving to the reply as a string
+        """
+
+        if command not in self._pending:
+            raise ValueError('unknown query: ' + hex(command))
+
+        future = Future()
+
+        with self._lock:
+            # Nothing would complete it
+            if self._stopped:
+                future.set_exception(RuntimeError('reply demux is not running; call start() first'))
+                return future
+
+            if self._error is not None:
+                future.set_exception(self._error)
+                return future
+
+            self._pending[command].append(future)
+
+        try:
+            self.drone.safeSend(bytes((command,)), paced=False)
+        except Exception as e:
+            with self._lock:
+                if future in self._pending[command]:
+                    self._pending[command].remove(future)
+
+            future.set_exception(e)
+
+        return future
+
+    def send(self, command, expiry = 1.0):
+        """
+        Sends a query whose reply nobody waits for, e.g. a keepalive. Its reply
+        is discarded, so never completes a query().
+
+        Parameters:
+            command (int):   FIRMWARE (`0x28`) or VIDEO_TYPE (`0x42`)
+            expiry  (float): Seconds after which the reply is assumed lost, and no longer discarded
+        """
+
+        if command not in self._pending:
+            raise ValueError('unknown query: ' + hex(command))
+
+        # Before sending, as the reply may arrive before safeSend() returns
+        entry = self._clock() + expiry
+
+        with self._lock:
+            self._discard[command].append(entry)
+
+        try:
+            self.drone.safeSend(bytes((command,)), paced=False)
+        except Exception as e:
+            with self._lock:
+                if entry in self._discard[command]:
+                    self._discard[command].remove(entry)
+
+            raise e
+
+    def cancel(self, command, future, expiry = 1.0):
+        """
+        Gives up on a query, e.g. after a timeout. If its reply still arrives
+        within `expiry` seconds, it is discarded rather than completing a later
+        query early.
+
+        Parameters:
+            command (int):    As passed to query()
+            future  (Future): As returned by query()
+            expiry  (float):  Seconds after which the reply is assumed lost
+        """
+
+        with self._lock:
+            if future not in self._pending[command]:
+                return
+
+            self._pending[command].remove(future)
+            self._discard[command].append(self._clock() + expiry)
+
+        future.cancel()
+
+    def firmware(self):
+        """
+        Queries the firmware version. See query().
+        """
+
+        return self.query(FIRMWARE)
+
+    def videoType(self):
+        """
+        Queries the video type. See query().
+        """
+
+        return self.query(VIDEO_TYPE)
+
+    def stats(self):
+        """
+        Returns:
+            A dict with keys `firmware`, `videoType` and `unknown`: the number of
+            replies recieved of each kind, and `callbackErrors`: the number of
+            exceptions raised by onReply
+        """
+
+        return {
+            'firmware': self._replies[FIRMWARE],
+            'videoType': self._replies[VIDEO_TYPE],
+            'unknown': self._replies[None],
+            'callbackErrors': self._callbackErrors,
+        }
+
+    def error(self):
+        """
+        Returns:
+            The exception that stopped the demux thread, or None
+        """
+
+        return self._error
+
+    def callbackError(self):
+        """
+        Returns:
+            The most recent exception raised by onReply, or None. These are
+            counted, but do not stop the demux thread.
+        """
+
+        return self._callbackError
+
+    #############################################################################
+    # Private
+    #############################################################################
+
+    def __run(self):
+        try:
+            self.__read()
+        except Exception as e:
+            # Anything unexpected; the thread is ending either way
+            self._error = e
+
+        # Nothing will complete these now
+        if not self._stopped:
+            self.__failPending(self._error if self._error is not None else RuntimeError('reply demux stopped'))
+
+    def __read(self):
+        sock = self.drone.udpsocket
+        view = self._view
+        clock = self._clock
+
+        while not self._stopped:
+            try:
+                size = sock.recv_into(self._buffer)
+            except socket.timeout:
+                continue
+            except OSError as e:
+                # e.g. ICMP port unreachable; the drone may be restarting
+                if isinstance(e, ConnectionRefusedError):
+                    continue
+
+                self._error = e
+                return
+
+            timestamp = clock()
+            data = view[:size]
+            kind = classifyReply(data)
+
+            if self.drone.capture is not None:
+                self.drone.capture.record(2, data) # UDP_IN
+
+            self._replies[kind] += 1
+
+            if kind is not None:
+                self.__complete(kind, bytes(data).decode('ascii', 'replace'))
+
+            if self.onReply is not None:
+                try:
+                    self.onReply(kind, data, timestamp)
+                except Exception as e:
+                    # A faulty callback must not stop replies being matched
+                    self._callbackErrors += 1
+                    self._callbackError = e
+
+    def __complete(self, kind, text):
+        if kind == FIRMWARE:
+            self.drone.firmware_ = text
+        else:
+            self.drone.videoType_ = text
+
+        with self._lock:
+            discard = self._discard[kind]
+
+            now = self._clock()
+            while discard and discard[0] < now:
+                discard.popleft()
+
+            if discard:
+                # Answers an earlier send(), or a cancelled query
+                discard.popleft()
+                return
+
+            waiting = self._pending[kind]
+            self._pending[kind] = []
+
+        for future in waiting:
+            if not future.done():
+                future.set_result(text)
+
+    def __failPending(self, error):
+        with self._lock:
+            waiting = self._pending[FIRMWARE] + self._pending[VIDEO_TYPE]
+            self._pending = { FIRMWARE: [], VIDEO_TYPE: [] }
+
+        for future in waiting:
+            if not future.done():
+                future.set_exception(error)
@@ -0,0 +1,213 @@
+"""
+Matt Clarke 2021.
+Finds drones on the network, by probing a whole address range at once.
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import argparse
+from collections import deque
+import ipaddress
+import selectors
+import socket
+import time
+
+from lib.handshake import classifyReply, FIRMWARE
+
+PROBE = b'\x28'
+
+class Endpoint:
+    """
+    A drone that answered discover().
+
+    Attributes:
+        ip       (string): IP address of the drone
+        udpPort  (int):    UDP port it answered on
+        firmware (string): As Drone.firmware()
+        rtt      (float):  Seconds from its latest probe being sent to the firmware reply
+    """
+
+    def __init__(self, ip, udpPort, firmware, rtt):
+        self.ip = ip
+        self.udpPort = udpPort
+        self.firmware = firmware
+        self.rtt = rtt
+
+    def __repr__(self):
+        return 'Endpoint(ip={!r}, udpPort={}, firmware={!r}, rtt={:.6f})'.format(
+            self.ip, self.udpPort, self.firmware, self.rtt)
+
+def addresses(network):
+    """
+    Expands a network into the host addresses to probe.
+
+    Parameters:
+        network (string): e.g. "192.168.1.0/24", or a single address
+
+    Returns:
+        A list of address strings, without the network and broadcast addresses
+    """
+
+    network = ipaddress.ip_network(network, strict=False)
+
+    if network.num_addresses == 1:
+        return [str(network.network_address)]
+
+    return [str(host) for host in network.hosts()]
+
+def discover(network = '192.168.1.0/24', ports = (8080,), timeout = 0.3, interval = 0.1, expected = None, clock = time.perf_counter):
+    """
+    Sends the `0x28` firmware query to every address and port at once, from a
+    single non-blocking socket, and collects the replies until `timeout`.
+
+    - `0x28` is sent twice to each endpoint, as in Drone.setup(), to get past
+      the drone-side bug where the first reply is stale or missing.
+    - Endpoints that have not answered after `interval` are probed again, in
+      case a datagram was lost.
+    - Nothing is connected, so probing an address with no drone costs one
+      datagram, and no per-address timeout.
+
+    Parameters:
+        network  (string|list): A network such as "192.168.1.0/24", or a list of addresses
+        ports    (list):        UDP ports to probe on each address
+        timeout  (float):       Seconds to wait for replies, in total
+        interval (float):       Seconds between probes to an endpoint that has not answered
+        expected (int):         Return as soon as this many drones have answered, or None to wait out `timeout`
+
+    Returns:
+        A list of Endpoint, in the order they were probed. This never raises for
+        network errors on individual addresses.
+    """
+
+    targets = addresses(network) if isinstance(network, str) else list(network)
+    pending = [(ip, port) for ip in targets for port in ports]
+
+    sentAt = {}
+    found = {}
+    queue = deque(pending)
+
+    start = clock()
+    deadline = start + timeout
+    nextProbe = start + interval
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setblocking(False)
+
+    # Room for every reply to a large scan to arrive before it is read
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+    except OSError:
+        pass
+
+    selector = selectors.DefaultSelector()
+    selector.register(sock, selectors.EVENT_READ | selectors.EVENT_WRITE)
+    writing = True
+
+    buffer = bytearray(64)
+
+    try:
+        now = clock()
+        while now < deadline and (expected is None or len(found) < expected):
+            if queue and not writing:
+                selector.modify(sock, selectors.EVENT_READ | selectors.EVENT_WRITE)
+                writing = True
+            elif not queue and writing:
+                selector.modify(sock, selectors.EVENT_READ)
+                writing = False
+
+            wait = min(deadline, nextProbe) - now
+            events = selector.select(wait if wait > 0 else 0)
+
+            for key, mask in events:
+                if mask & selectors.EVENT_READ:
+                    _recieve(sock, buffer, sentAt, found, clock)
+
+                if mask & selectors.EVENT_WRITE:
+                    _send(sock, queue, sentAt, clock)
+
+            now = clock()
+
+            if now >= nextProbe:
+                nextProbe = now + interval
+
+                # Anything still queued has not been sent once yet, so is
+                # not resent here
+                queued = set(queue)
+                queue.extend(endpoint for endpoint in pending if endpoint not in found and endpoint not in queued)
+    finally:
+        selector.close()
+        sock.close()
+
+    return [found[endpoint] for endpoint in pending if endpoint in found]
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog='python -m lib.drone discover', description='Find drones on the network.')
+    parser.add_argument('network', nargs='?', default='192.168.1.0/24', help='network to scan (default: 192.168.1.0/24)')
+    parser.add_argument('--port', type=int, action='append', dest='ports', help='UDP port to probe, may be repeated (default: 8080)')
+    parser.add_argument('--timeout', type=float, default=0.3, help='seconds to wait for replies (default: 0.3)')
+    args = parser.parse_args(argv)
+
+    start = time.perf_counter()
+    endpoints = discover(args.network, args.ports or [8080], args.timeout)
+    elapsed = time.perf_counter() - start
+
+    for endpoint in endpoints:
+        print('{:<16} {:>6} {:<8} {:>8.2f} ms'.format(
+            endpoint.ip, endpoint.udpPort, endpoint.firmware.rstrip('\x00'), endpoint.rtt * 1000))
+
+    print('{} found in {:.3f}s'.format(len(endpoints), elapsed))
+
+    return 0
+
+#############################################################################
+# Private
+#############################################################################
+
+def _send(sock, queue, sentAt, clock):
+    while queue:
+        endpoint = queue[0]
+
+        try:
+            sock.sendto(PROBE, endpoint)
+            sock.sendto(PROBE, endpoint)
+        except (BlockingIOError, InterruptedError):
+            # Send buffer full; carry on once it drains
+            return
+        except OSError:
+            # e.g. no route to this address; skip it
+            pass
+
+        sentAt[endpoint] = clock()
+        queue.popleft()
+
+def _recieve(sock, buffer, sentAt, found, clock):
+    while True:
+        try:
+            size, endpoint = sock.recvfrom_into(buffer)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            # e.g. an ICMP error for an earlier probe
+            continue
+
+        now = clock()
+
+        if endpoint in found or endpoint not in sentAt:
+            continue
+
+        # A stale reply to the first probe may be the video type; wait for
+        # the firmware
+        if classifyReply(buffer[:size]) != FIRMWARE:
+            continue
+
+        firmware = bytes(buffer[:min(size, 6)]).decode('ascii')
+        found[endpoint] = Endpoint(endpoint[0], endpoint[1], firmware, now - sentAt[endpoint])
@@ -17,6 +17,19 @@ import struct
 import time
 import socket
 
+# Millisecond clock, as in remote/throttle.py. MicroPython's ticks wrap
+# around, so must be compared with ticks_diff; elsewhere, a plain monotonic
+# clock does.
+try:
+    ticksMs = time.ticks_ms
+    ticksDiff = time.ticks_diff
+except AttributeError:
+    def ticksMs():
+        return int(time.monotonic() * 1000)
+
+    def ticksDiff(a, b):
+        return a - b
+
 class Drone:
     """
     This class handles sending commands to the remote drone.
@@ -33,11 +46,55 @@ class Drone:
     Note: no internal state keeping is done internally. This means
     you technically can call any method at any time. It is up to you to
     handle the current state!
+
+    By default, each send sleeps for 0.01s first. To hold an exact rate instead,
+    assign a lib.pacer.Pacer to `pacer`; sends then wait for its next deadline.
+
+    Assigning a lib.cache.FrameCache to `frameCache` reuses prebuilt control frames
+    whenever a setpoint quantizes to one already built.
+
+    Assigning a lib.capture.CaptureWriter to `capture` records every packet sent
+    and recieved, for later replay.
+
+    Assigning a lib.metrics.Metrics to `metrics` counts packets, bytes and errors,
+    and times every send.
+
+    Setting `keepaliveFloor` enables send-on-change: control() and idle() only
+    send a frame when it differs from the last one sent, or when `keepaliveFloor`
+    seconds have passed since. Calls keep their usual timing either way.
     """
 
     udpsocket = None
     tcpsocket = None
 
+    # Optional - paces sends instead of the fixed sleep
+    pacer = None
+
+    # Optional - reuses prebuilt control frames for repeated setpoints
+    frameCache = None
+
+    # Reused by control(), unless a frameCache is set
+    controlFrame = None
+
+    # Optional - records all traffic
+    capture = None
+
+    # Optional - times sends and counts packets
+    metrics = None
+
+    # Optional - seconds between repeats of an unchanged control frame. None
+    # sends every frame.
+    keepaliveFloor = None
+
+    # Control frames put on the wire, and skipped by send-on-change
+    framesSent = 0
+    framesSuppressed = 0
+
+    _lastControlSend = None
+
+    # The last frame control() was given, when using a frameCache
+    _lastControlFrame = None
+
     videoType_ = None
     firmware_  = None
 
@@ -45,7 +102,7 @@ class Drone:
         """
         A getter for the type of video output the drone supports.
 
-        Note: no implementation is provided to access this feed.
+        Note: the feed itself can be read with lib.video.VideoReceiver.
 
         Returns:
             A string or None
@@ -66,7 +123,7 @@ class Drone:
 
         return self.firmware_
 
-    def connect(self, ip = '192.168.1.1'):
+    def connect(self, ip = '192.168.1.1', udpPort = 8080, tcpPort = 8888, timeout = None):
         """
         Sets up the sockets used for communication to the drone.
 
@@ -74,20 +131,33 @@ class Drone:
         ahead of calling this method.
 
         Parameters:
-            ip (string): IP address of the drone. This is defaults to 192.168.1.1, but may differ by manufacturer.
+            ip      (string): IP address of the drone. This is defaults to 192.168.1.1, but may differ by manufacturer.
+            udpPort (int):    UDP port of the drone. Only needs changing for e.g. a local Simulator.
+            tcpPort (int):    TCP port of the drone. Only needs changing for e.g. a local Simulator.
+            timeout (float):  Seconds before a blocking connect or recieve gives up. Defaults to waiting forever.
 
         Returns:
             `True` if connection is established, otherwise `False`
+
+        Note: lib.handshake.handshake() does both connect() and setup() concurrently,
+        with deadlines and retries.
         """
 
         self.udpsocket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.udpsocket.connect((ip, 8080))
-
         self.tcpsocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.tcpsocket.connect((ip, 8888))
+
+        # A new connection has been sent nothing yet
+        self._resetControl()
+
+        if timeout is not None:
+            self.udpsocket.settimeout(timeout)
+            self.tcpsocket.settimeout(timeout)
+
+        self.udpsocket.connect((ip, udpPort))
+        self.tcpsocket.connect((ip, tcpPort))
 
         # Validate the connection worked
-        droneIdCommand = self.__generateDroneIdCommand(1)
+        droneIdCommand = self._generateDroneIdCommand(1)
 
         try:
             self.udpsocket.send(droneIdCommand)
@@ -103,9 +173,9 @@ class Drone:
         Note: this will raise an exception if connection has been lost.
         """
 
-        droneIdCommand = self.__generateDroneIdCommand(1)
-        dateCommand    = self.__generateSetDateCommand(None)
-        unknownCommand = self.__generateSecondSetupCommand()
+        droneIdCommand = self._generateDroneIdCommand(1)
+        dateCommand    = self._generateSetDateCommand(None)
+        unknownCommand = self._generateSecondSetupCommand()
 
         # No data to recieve on these two
         self.safeSend(droneIdCommand)
@@ -124,7 +194,7 @@ class Drone:
         self.firmware_ = self.recieve(6).decode('ascii')
 
         # Send first heartbeat
-        self.safeSendTcp(self.__generateHeartbeatCommand())
+        self.safeSendTcp(self._generateHeartbeatCommand())
         self.recieveTcp(20) # ignore
 
 
@@ -133,13 +203,12 @@ class Drone:
         Sends an "idle" control command. This is needed for the drone to recognise
         that you have connected, before calling takeoff() or arm().
 
-        Note: execution time is 0.01s, suitable for calling at 100Hz.
+        Note: execution time is 0.01s, suitable for calling at 100Hz. See `pacer` for other rates.
 
         Note: this will raise an exception if connection has been lost.
         """
 
-        controlPacket = self.__generateControlCommand(0.5, 0.5, 0.5, 0.5)
-        self.safeSend(controlPacket)
+        self.control(0.5, 0.5, 0.5, 0.5)
 
 
     def takeoff(self):
@@ -155,9 +224,12 @@ class Drone:
         Note: this will raise an exception if connection has been lost.
         """
 
-        controlPacket = self.__generateTakeoffCommand()
+        controlPacket = self._generateTakeoffCommand()
         self.safeSend(controlPacket)
 
+        # The next control frame differs from this on the wire
+        self._lastControlSend = None
+
     def arm(self):
         """
         Arms the drone for a manual takeoff, instead of calling takeoff().
@@ -181,7 +253,8 @@ class Drone:
         - roll
         - yaw
 
-        Note: execution time is 0.01s, suitable for calling at 100Hz in a simple loop.
+        Note: execution time is 0.01s, suitable for calling at 100Hz in a simple loop. See `pacer` for other rates.
+        Note: with `keepaliveFloor` set, a frame unchanged since the last send is only resent every `keepaliveFloor` seconds.
         Note: this will raise an exception if connection has been lost.
 
         Parameters:
@@ -191,45 +264,131 @@ class Drone:
             yaw      (float): Yaw amount, [0.0 | 1.0] (0.0 == rotate left, 1.0 == rotate right)
         """
 
-        controlPacket = self.__generateControlCommand(throttle, pitch, roll, yaw)
-        self.safeSend(controlPacket)
+        if self.frameCache is not None:
+            controlPacket = self._generateControlCommand(throttle, pitch, roll, yaw)
+            held = self._holdFrame(controlPacket)
+        else:
+            held = self._holdControl(throttle, pitch, roll, yaw)
+            controlPacket = self.controlFrame.view
+
+        if held:
+            # Hold the same timing as a send
+            self.pace()
+            self.framesSuppressed += 1
+            return
+
+        try:
+            self.safeSend(controlPacket)
+        except BaseException as e:
+            # The frame may never have reached the drone, so the next call
+            # sends it regardless
+            self._lastControlSend = None
+            raise e
+
+        self.framesSent += 1
+
+        if self.keepaliveFloor is not None:
+            self._lastControlSend = ticksMs()
+
+    #############################################################################
+    # Private - Send-on-change
+    #############################################################################
+
+    # Updates controlFrame in place, so nothing is allocated per packet.
+    # Returns True if send-on-change means it need not be sent.
+    def _holdControl(self, throttle, pitch, roll, yaw):
+        if self.controlFrame is None:
+            self.controlFrame = ControlFrame()
+
+        changed = self.controlFrame.set(throttle, pitch, roll, yaw)
+
+        if self.keepaliveFloor is None or changed or self._lastControlSend is None:
+            return False
+
+        return ticksDiff(ticksMs(), self._lastControlSend) < self.keepaliveFloor * 1000
+
+    # As _holdControl(), for a frame from the frameCache. A repeated setpoint
+    # gets the same bytes object back, so the comparison is usually identity.
+    def _holdFrame(self, frame):
+        changed = frame != self._lastControlFrame
+        self._lastControlFrame = frame
+
+        if self.keepaliveFloor is None or changed or self._lastControlSend is None:
+            return False
+
+        return ticksDiff(ticksMs(), self._lastControlSend) < self.keepaliveFloor * 1000
+
+    def _resetControl(self):
+        self.controlFrame = None
+        self._lastControlFrame = None
+        self._lastControlSend = None
 
     #############################################################################
     # Private - Communication
     #############################################################################
 
-    # Sends data to the remote socket. On error, will change state as expected
-    def safeSend(self, data):
-        try:
+    # Waits until the next send is due
+    def pace(self):
+        if self.pacer is None:
             time.sleep(0.01)
-            self.udpsocket.send(data)
+        else:
+            self.pacer.wait()
+
+    # Sends data to the remote socket. On error, will change state as expected.
+    # Pass paced=False when the caller handles timing itself
+    def safeSend(self, data, paced = True):
+        try:
+            if paced: self.pace()
+
+            if self.metrics is None:
+                self.udpsocket.send(data)
+            else:
+                started = self.metrics.clock()
+                self.udpsocket.send(data)
+                self.metrics.sent('udp', len(data), started)
+
+            if self.capture is not None: self.capture.record(0, data) # UDP_OUT
         except KeyboardInterrupt as e:
             raise e
         except Exception as e:
+            if self.metrics is not None: self.metrics.error('udp')
             print('send ' + str(e))
             raise e
 
-    def safeSendTcp(self, data):
+    def safeSendTcp(self, data, paced = True):
         try:
-            time.sleep(0.01)
-            self.tcpsocket.send(data)
+            if paced: self.pace()
+
+            if self.metrics is None:
+                self.tcpsocket.send(data)
+            else:
+                started = self.metrics.clock()
+                self.tcpsocket.send(data)
+                self.metrics.sent('tcp', len(data), started)
+
+            if self.capture is not None: self.capture.record(1, data) # TCP_OUT
         except KeyboardInterrupt as e:
             raise e
         except Exception as e:
+            if self.metrics is not None: self.metrics.error('tcp')
             print('send (tcp) ' + str(e))
             raise e
 
     # Recieves data from the remote
     def recieve(self, bufferSize):
         try:
-            return self.udpsocket.recv(bufferSize)
+            data = self.udpsocket.recv(bufferSize)
+            if self.capture is not None: self.capture.record(2, data) # UDP_IN
+            return data
         except Exception as e:
             print('recv ' + str(e))
             return None
 
     def recieveTcp(self, bufferSize):
         try:
-            return self.tcpsocket.recv(bufferSize)
+            data = self.tcpsocket.recv(bufferSize)
+            if self.capture is not None: self.capture.record(3, data) # TCP_IN
+            return data
         except Exception as e:
             print('recv ' + str(e))
             return None
@@ -238,18 +397,18 @@ class Drone:
     # Private - Command generation
     #############################################################################
 
-    def __generateDroneIdCommand(self, id):
+    def _generateDroneIdCommand(self, id):
         return b'\x0f\xc0\xa8\x01' + struct.pack('B', id)
 
-    def __generateSetDateCommand(self, now):
+    def _generateSetDateCommand(self, now):
         # This command is a straight-up binary version of the below
         payload = 'date -s \"' + '2021-11-06 18:22:35' + '\"'
         return payload.encode()
 
-    def __generateHeartbeatCommand(self):
+    def _generateHeartbeatCommand(self):
         return b'\x00\x01\x02\x03\x04\x05\x06\x07\x08\x09\x25\x25'
 
-    def __generateSecondSetupCommand(self):
+    def _generateSecondSetupCommand(self):
         # No idea what these do
         param1 = 0x0b
         param2 = 0x06
@@ -260,11 +419,19 @@ class Drone:
 
         return b'\x26\xe5\x07\x00\x00' + struct.pack('IIIIII', int(param1), int(param2), int(param3), int(param4), int(param5), int(param6))
 
-    def __generateControlCommand(self, throttle, pitch, roll, yaw, command = 0x01, throttleTrim = 0x10, rollTrim = 0x10, pitchTrim = 0x10):
+    def _generateControlCommand(self, throttle, pitch, roll, yaw, command = 0x01, throttleTrim = 0x10, rollTrim = 0x10, pitchTrim = 0x10):
         # params are floats between 0.0 and 1.0
 
-        header = b'\xff\x08'
+        fields = self._quantizeControlCommand(throttle, pitch, roll, yaw, command, throttleTrim, rollTrim, pitchTrim)
+
+        if self.frameCache is None:
+            return self._packControlCommand(fields)
 
+        # Keyed on the wire values, so inputs that quantize alike share a frame
+        return self.frameCache.get(fields, self._packControlCommand)
+
+    # Scales and clamps inputs to the values sent on the wire, in wire order
+    def _quantizeControlCommand(self, throttle, pitch, roll, yaw, command, throttleTrim, rollTrim, pitchTrim):
         throttleScaled = 0xff * throttle
         if throttleScaled > 0xff: throttleScaled = 0xff
         elif throttleScaled < 0x00: throttleScaled = 0x00
@@ -281,17 +448,215 @@ class Drone:
         if yawScaled >= 0x7e: yawScaled = 0x7f
         elif yawScaled < 0x00: yawScaled = 0x00
 
-        endByte = self.__endByteCalc(int(throttleScaled), int(yawScaled), int(pitchScaled), int(rollScaled), throttleTrim, rollTrim, pitchTrim, command)
+        return (int(throttleScaled), int(yawScaled), int(pitchScaled), int(rollScaled), throttleTrim, pitchTrim, rollTrim, command)
+
+    def _packControlCommand(self, fields):
+        header = b'\xff\x08'
+
+        throttle, yaw, pitch, roll, throttleTrim, pitchTrim, rollTrim, command = fields
+
+        endByte = self._endByteCalc(throttle, yaw, pitch, roll, throttleTrim, rollTrim, pitchTrim, command)
         if endByte < 0x0:
             endByte = 0x0 - endByte
         elif endByte > 0xff:
             endByte = endByte - 0xff - 1
 
-        return header + struct.pack('BBBBBBBBB', int(throttleScaled), int(yawScaled), int(pitchScaled), int(rollScaled), throttleTrim, pitchTrim, rollTrim, command, int(endByte))
+        return header + struct.pack('BBBBBBBBB', throttle, yaw, pitch, roll, throttleTrim, pitchTrim, rollTrim, command, int(endByte))
 
     # No idea what this value represents, but this appears to calculate it correctly
-    def __endByteCalc(self, throttle, yaw, pitch, roll, throttleTrim, rollTrim, pitchTrim, command):
+    def _endByteCalc(self, throttle, yaw, pitch, roll, throttleTrim, rollTrim, pitchTrim, command):
         return 0x87 + (0x7f - throttle) + (0x40 - yaw) + (0x40 - pitch) + (0x40 - roll) + (0x10 - throttleTrim) + (0x10 - rollTrim) + (0x10 - pitchTrim) + (0x01 - command)
 
-    def __generateTakeoffCommand(self):
-        return b'\xff\x08\x7f\x40\x40\x40\x90\x10\x10\x41\xc7'
\ No newline at end of file
+    def _generateTakeoffCommand(self):
+        return b'\xff\x08\x7f\x40\x40\x40\x90\x10\x10\x41\xc7'
+
+class ControlFrame:
+    """
+    A control frame held in a single preallocated buffer, and updated in place.
+
+    Only fields that change are written, and the checksum is adjusted by the
+    difference each one makes rather than being recomputed. Sending `view`
+    then needs no per-packet allocation of header, body or concatenation.
+
+    Exported methods:
+    - set(throttle, pitch, roll, yaw)
+    - setTrims(throttleTrim, pitchTrim, rollTrim)
+    - setCommand(command)
+
+    Example:
+
+        frame = ControlFrame()
+        frame.set(0.7, 0.5, 0.5, 0.5)
+        sock.send(frame.view)
+
+    Note: anything holding `view` sees later updates. Copy with bytes(frame.view)
+    if a snapshot is needed.
+    """
+
+    # Offsets of each field within the frame
+    THROTTLE      = 2
+    YAW           = 3
+    PITCH         = 4
+    ROLL          = 5
+    THROTTLE_TRIM = 6
+    PITCH_TRIM    = 7
+    ROLL_TRIM     = 8
+    COMMAND       = 9
+    CHECKSUM      = 10
+
+    def __init__(self):
+        # Starts as the idle frame, whose unfolded checksum is exactly 0x87
+        self.buffer = bytearray(b'\xff\x08\x7f\x40\x40\x40\x10\x10\x10\x01\x87')
+        self.view = memoryview(self.buffer)
+        self._sum = 0x87
+
+    def set(self, throttle, pitch, roll, yaw):
+        """
+        Updates the frame to the given control values, scaled exactly as
+        Drone.control() does.
+
+        Parameters: as for Drone.control()
+
+        Returns:
+            `True` if any byte of the frame changed
+        """
+
+        throttleScaled = 0xff * throttle
+        if throttleScaled > 0xff: throttleScaled = 0xff
+        elif throttleScaled < 0x00: throttleScaled = 0x00
+
+        pitchScaled = 0x80 * pitch
+        if pitchScaled >= 0x7e: pitchScaled = 0x7f
+        elif pitchScaled < 0x00: pitchScaled = 0x00
+
+        rollScaled = 0x80 * roll
+        if rollScaled >= 0x7e: rollScaled = 0x7f
+        elif rollScaled < 0x00: rollScaled = 0x00
+
+        yawScaled = 0x80 * yaw
+        if yawScaled >= 0x7e: yawScaled = 0x7f
+        elif yawScaled < 0x00: yawScaled = 0x00
+
+        throttleScaled = int(throttleScaled)
+        yawScaled = int(yawScaled)
+        pitchScaled = int(pitchScaled)
+        rollScaled = int(rollScaled)
+
+        # The hot path, so inlined rather than going through __update(). The
+        # values are clamped above, so can't be out of range for a byte.
+        buffer = self.buffer
+
+        oldThrottle = buffer[2]
+        oldYaw = buffer[3]
+        oldPitch = buffer[4]
+        oldRoll = buffer[5]
+
+        if oldThrottle == throttleScaled and oldYaw == yawScaled and oldPitch == pitchScaled and oldRoll == rollScaled:
+            return False
+
+        total = self._sum + (oldThrottle - throttleScaled) + (oldYaw - yawScaled) + (oldPitch - pitchScaled) + (oldRoll - rollScaled)
+
+        endByte = total
+        if endByte < 0x0:
+            endByte = 0x0 - endByte
+        elif endByte > 0xff:
+            endByte = endByte - 0xff - 1
+
+        if endByte > 0xff:
+            raise ValueError('control frame checksum out of range for a byte')
+
+        buffer[2] = throttleScaled
+        buffer[3] = yawScaled
+        buffer[4] = pitchScaled
+        buffer[5] = rollScaled
+        buffer[10] = endByte
+
+        self._sum = total
+
+        return True
+
+    def setTrims(self, throttleTrim = 0x10, pitchTrim = 0x10, rollTrim = 0x10):
+        """
+        Updates the trims, each in [0x00 to 0x20].
+
+        Returns:
+            `True` if any byte of the frame changed
+        """
+
+        return self.__update(ControlFrame.THROTTLE_TRIM, throttleTrim, ControlFrame.PITCH_TRIM, pitchTrim,
+                             ControlFrame.ROLL_TRIM, rollTrim, ControlFrame.COMMAND, self.buffer[ControlFrame.COMMAND])
+
+    def setCommand(self, command = 0x01):
+        """
+        Updates the flags field. See README for values.
+
+        Returns:
+            `True` if any byte of the frame changed
+        """
+
+        buffer = self.buffer
+        return self.__update(ControlFrame.COMMAND, command, ControlFrame.THROTTLE_TRIM, buffer[ControlFrame.THROTTLE_TRIM],
+                             ControlFrame.PITCH_TRIM, buffer[ControlFrame.PITCH_TRIM], ControlFrame.ROLL_TRIM, buffer[ControlFrame.ROLL_TRIM])
+
+    # Writes four fields at once. Every field contributes (base - value) to the
+    # checksum, so a change from old to new moves it by (old - new)
+    def __update(self, offsetA, valueA, offsetB, valueB, offsetC, valueC, offsetD, valueD):
+        buffer = self.buffer
+
+        oldA = buffer[offsetA]
+        oldB = buffer[offsetB]
+        oldC = buffer[offsetC]
+        oldD = buffer[offsetD]
+
+        delta = (oldA - valueA) + (oldB - valueB) + (oldC - valueC) + (oldD - valueD)
+        if delta == 0 and oldA == valueA and oldB == valueB and oldC == valueC and oldD == valueD:
+            return False
+
+        total = self._sum + delta
+
+        endByte = total
+        if endByte < 0x0:
+            endByte = 0x0 - endByte
+        elif endByte > 0xff:
+            endByte = endByte - 0xff - 1
+
+        # Validate before writing anything, so a failure leaves the frame intact
+        if not (0x00 <= endByte <= 0xff and 0x00 <= valueA <= 0xff and 0x00 <= valueB <= 0xff and
+                0x00 <= valueC <= 0xff and 0x00 <= valueD <= 0xff):
+            raise ValueError('control frame field out of range for a byte')
+
+        buffer[offsetA] = valueA
+        buffer[offsetB] = valueB
+        buffer[offsetC] = valueC
+        buffer[offsetD] = valueD
+        buffer[ControlFrame.CHECKSUM] = endByte
+
+        self._sum = total
+
+        return True
+
+
+if __name__ == '__main__':
+    # Host-side tooling, e.g. `python -m lib.drone bench`
+    import sys
+
+    command = sys.argv[1] if len(sys.argv) > 1 else None
+
+    if command == 'bench':
+        from lib.bench import main
+        sys.exit(main(sys.argv[2:]))
+
+    if command == 'replay':
+        from lib.capture import main
+        sys.exit(main(sys.argv[2:]))
+
+    if command == 'discover':
+        from lib.discovery import main
+        sys.exit(main(sys.argv[2:]))
+
+    if command == 'verify':
+        from lib.verify import main
+        sys.exit(main(sys.argv[2:]))
+
+    print('usage: python -m lib.drone bench|replay|discover|verify [options]')
+    sys.exit(2)
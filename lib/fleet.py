@@ -0,0 +1,336 @@
+"""
+Matt Clarke 2021.
+Drives many drones from a single selector loop.
+
+Dependencies:
+    - numpy
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import selectors
+import socket
+import threading
+import time
+
+import numpy as np
+
+from lib.batch import encodeControlFrames, FRAME_SIZE
+
+class Fleet:
+    """
+    Sends control commands to many drones from one thread.
+
+    Drones are connected and setup as usual, then registered with add(). From
+    then on, the fleet owns their sockets: a single selector loop drains
+    anything the drones send back, and at every tick the control frames for
+    all drones are encoded in one pass and sent back-to-back.
+
+    add() and set() may be called from other threads while the fleet runs. A
+    drone added mid-tick is first sent a frame on the next tick.
+
+    Exported methods:
+    - add(drone)
+    - set(index, throttle, pitch, roll, yaw)
+    - idle(index)
+    - run(duration)
+    - stop()
+    - tick()
+    - stats(index)
+    - missedTicks()
+    - close()
+
+    Example:
+
+        fleet = Fleet(rate=100)
+        for drone in drones:
+            fleet.add(drone)
+
+        fleet.set(0, 0.7, 0.5, 0.5, 0.5)
+        fleet.run(10.0)
+    """
+
+    def __init__(self, rate = 100, clock = time.perf_counter):
+        """
+        Parameters:
+            rate  (float):    Tick rate in Hz
+            clock (callable): Monotonic clock returning seconds
+        """
+
+        if rate <= 0:
+            raise ValueError('rate must be positive')
+
+        self.period = 1.0 / rate
+
+        self._clock = clock
+        self._selector = selectors.DefaultSelector()
+
+        # Guards the drones and setpoints, so a tick never sees them half
+        # updated. The list is replaced rather than appended to, so a tick can
+        # send from its own snapshot without holding the lock.
+        self._lock = threading.Lock()
+        self._drones = []
+        self._stopped = False
+        self._scratch = bytearray(2048)
+
+        # Setpoints, one element per drone
+        self._throttle = np.empty(0)
+        self._pitch = np.empty(0)
+        self._roll = np.empty(0)
+        self._yaw = np.empty(0)
+
+        self._frames = None
+        self._dirty = True
+
+        self._missedTicks = 0
+
+    def add(self, drone):
+        """
+        Registers a drone with the fleet. Its initial setpoint is idle.
+
+        Parameters:
+            drone (Drone): A drone that has already been connected and setup
+
+        Returns:
+            The index used to refer to this drone
+        """
+
+        drone.udpsocket.setblocking(False)
+        if drone.tcpsocket is not None:
+            drone.tcpsocket.setblocking(False)
+
+        with self._lock:
+            index = len(self._drones)
+
+            self._throttle = np.append(self._throttle, 0.5)
+            self._pitch = np.append(self._pitch, 0.5)
+            self._roll = np.append(self._roll, 0.5)
+            self._yaw = np.append(self._yaw, 0.5)
+            self._dirty = True
+
+            self._drones = self._drones + [_Member(drone)]
+
+            # Only once the drone is known, as its replies are drained by index
+            self._selector.register(drone.udpsocket, selectors.EVENT_READ, index)
+            if drone.tcpsocket is not None:
+                self._selector.register(drone.tcpsocket, selectors.EVENT_READ, index)
+
+        return index
+
+    def set(self, index, throttle, pitch, roll, yaw):
+        """
+        Updates the setpoint for one drone, sent from the next tick.
+
+        Parameters:
+            index (int): As returned from add()
+            Others: as for Drone.control()
+        """
+
+        with self._lock:
+            self._throttle[index] = throttle
+            self._pitch[index] = pitch
+            self._roll[index] = roll
+            self._yaw[index] = yaw
+            self._dirty = True
+
+    def idle(self, index):
+        """
+        Sends idle commands to one drone from the next tick.
+        """
+
+        self.set(index, 0.5, 0.5, 0.5, 0.5)
+
+    def run(self, duration = None):
+        """
+        Runs the selector loop in the calling thread, until stop() is called or
+        `duration` elapses.
+
+        Parameters:
+            duration (float): Seconds to run for, or None to run until stopped
+        """
+
+        self._stopped = False
+
+        clock = self._clock
+        now = clock()
+        deadline = now
+        end = None if duration is None else now + duration
+
+        while not self._stopped:
+            if end is not None and now >= end:
+                break
+
+            timeout = deadline - now
+            events = self._selector.select(timeout if timeout > 0 else 0)
+
+            for key, _ in events:
+                self.__drain(key.fileobj, key.data)
+
+            now = clock()
+            if now < deadline:
+                continue
+
+            # Any whole periods already elapsed past this deadline are ticks
+            # that never happened
+            missed = int((now - deadline) / self.period)
+            if missed > 0:
+                self._missedTicks += missed
+                for member in self._drones:
+                    member.missed += missed
+
+                deadline += missed * self.period
+
+            self.tick(deadline)
+
+            deadline += self.period
+            now = clock()
+
+    def stop(self):
+        """
+        Stops run() after its current tick. Safe to call from another thread.
+        """
+
+        self._stopped = True
+
+    def tick(self, deadline = None):
+        """
+        Encodes and sends one control frame to every drone.
+
+        Called by run() at each tick, but may also be called directly when
+        driving the fleet from your own loop.
+
+        Parameters:
+            deadline (float): When this tick was due, on the fleet's clock. Defaults to now.
+        """
+
+        with self._lock:
+            if self._dirty:
+                self._dirty = False
+                self._frames = memoryview(encodeControlFrames(self._throttle, self._pitch, self._roll, self._yaw))
+
+            # Frames and drones always match, even if add() runs during the sends
+            frames = self._frames
+            drones = self._drones
+
+        clock = self._clock
+
+        if deadline is None:
+            deadline = clock()
+
+        for index, member in enumerate(drones):
+            offset = index * FRAME_SIZE
+
+            try:
+                member.drone.udpsocket.send(frames[offset:offset + FRAME_SIZE])
+            except BlockingIOError:
+                # Socket buffer full; this tick is lost for this drone
+                member.missed += 1
+                continue
+            except OSError:
+                member.errors += 1
+                continue
+
+            latency = clock() - deadline
+
+            member.sent += 1
+            member.latencySum += latency
+            if latency > member.latencyMax: member.latencyMax = latency
+
+    def stats(self, index = None):
+        """
+        Per-drone send statistics.
+
+        Parameters:
+            index (int): A drone index, or None for all drones
+
+        Returns:
+            A dict (or list of dicts when `index` is None) with keys:
+            - `sent`: frames sent
+            - `missed`: ticks where no frame was sent
+            - `errors`: sends that failed
+            - `latencyMean`: mean seconds from tick deadline to send completing
+            - `latencyMax`: worst seconds from tick deadline to send completing
+        """
+
+        if index is None:
+            return [member.stats() for member in self._drones]
+
+        return self._drones[index].stats()
+
+    def missedTicks(self):
+        """
+        Returns:
+            How many ticks the loop as a whole has missed, e.g. due to overrunning
+        """
+
+        return self._missedTicks
+
+    def close(self):
+        """
+        Releases all sockets back to their drones, in blocking mode.
+        """
+
+        with self._lock:
+            drones = self._drones
+            self._drones = []
+
+        for member in drones:
+            for sock in (member.drone.udpsocket, member.drone.tcpsocket):
+                if sock is None:
+                    continue
+
+                try:
+                    self._selector.unregister(sock)
+                except KeyError:
+                    pass
+
+                sock.setblocking(True)
+
+        self._selector.close()
+
+    #############################################################################
+    # Private
+    #############################################################################
+
+    def __drain(self, sock, index):
+        # Discard anything a drone sends back, so that its buffers never fill
+        try:
+            while True:
+                if sock.recv_into(self._scratch) == 0 and sock.type == socket.SOCK_STREAM:
+                    # Remote closed the connection; stop watching it
+                    self._selector.unregister(sock)
+                    self._drones[index].errors += 1
+                    return
+        except BlockingIOError:
+            pass
+        except OSError:
+            self._drones[index].errors += 1
+
+class _Member:
+    # Book-keeping for one drone in the fleet
+
+    def __init__(self, drone):
+        self.drone = drone
+        self.sent = 0
+        self.missed = 0
+        self.errors = 0
+        self.latencySum = 0.0
+        self.latencyMax = 0.0
+
+    def stats(self):
+        return {
+            'sent': self.sent,
+            'missed': self.missed,
+            'errors': self.errors,
+            'latencyMean': self.latencySum / self.sent if self.sent > 0 else 0.0,
+            'latencyMax': self.latencyMax,
+        }
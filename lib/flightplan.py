@@ -0,0 +1,338 @@
+"""
+Matt Clarke 2021.
+Compiles scripted manoeuvres into ready-to-send control frames, and plays
+them back.
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import mmap
+import struct
+import threading
+import time
+
+import numpy as np
+
+from lib.batch import encodeControlFrames, FRAME_SIZE
+from lib.drone import ControlFrame
+from lib.pacer import Pacer
+
+# File layout: a header of (magic, rate, frame count), then the frames
+MAGIC  = b'MDPLAN\x00\x01'
+HEADER = struct.Struct('<8sdI')
+
+# Ways to get from one keyframe to the next
+LINEAR = 'linear'
+STEP   = 'step'
+
+class FlightPlan:
+    """
+    A contiguous buffer of `ff08` control frames, one per tick at `rate`.
+
+    Frame `i` is sent at `i / rate` seconds into the plan, and is found at
+    `[i * FRAME_SIZE, (i + 1) * FRAME_SIZE)` in `data`.
+
+    Exported methods:
+    - count()
+    - duration()
+    - frame(index)
+    - save(path)
+    - close()
+    """
+
+    def __init__(self, data, rate, source = None):
+        """
+        Parameters:
+            data   (buffer): The frames; bytes, or a view of a mapped file
+            rate   (float):  Frames per second
+            source (mmap):   Optional; mapping `data` is a view of, closed by close()
+        """
+
+        if len(data) % FRAME_SIZE != 0:
+            raise ValueError('plan data is not a whole number of frames')
+
+        self.data = memoryview(data)
+        self.rate = rate
+
+        self._source = source
+
+    def count(self):
+        """
+        Returns:
+            The number of frames
+        """
+
+        return len(self.data) // FRAME_SIZE
+
+    def duration(self):
+        """
+        Returns:
+            Seconds taken to play the plan
+        """
+
+        return self.count() / self.rate
+
+    def frame(self, index):
+        """
+        Returns:
+            A memoryview of frame `index`. For a plan from loadPlan(), release
+            it before calling close().
+        """
+
+        return self.data[index * FRAME_SIZE:(index + 1) * FRAME_SIZE]
+
+    def save(self, path):
+        """
+        Writes the plan to a file, to be loaded again with loadPlan().
+        """
+
+        with open(path, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, self.rate, self.count()))
+            f.write(self.data)
+
+    def close(self):
+        """
+        Releases the file mapping, if loaded with loadPlan(). The plan cannot
+        be used afterwards.
+
+        Views of a mapped plan, from frame() or slices of `data`, must be
+        released first.
+
+        Raises:
+            BufferError if a view is still alive, in which case the plan is left
+            open and usable
+        """
+
+        if self._source is None:
+            self.data.release()
+            return
+
+        # The mapping can only be closed once no view of it is left, including
+        # `data`; there is no way to ask first
+        length = len(self.data)
+        self.data.release()
+
+        try:
+            self._source.close()
+        except BufferError:
+            # As mapped by loadPlan()
+            self.data = memoryview(self._source)[HEADER.size:HEADER.size + length]
+            raise BufferError('a view of the plan is still alive; release it before close()')
+
+        self._source = None
+
+def compilePlan(keyframes, rate = 100, interpolation = LINEAR):
+    """
+    Compiles timed setpoints into a FlightPlan.
+
+    Parameters:
+        keyframes     (list):   (time, throttle, pitch, roll, yaw) tuples, with time in seconds from
+                                the start of the plan. Values are as for Drone.control().
+        rate          (float):  Frames per second
+        interpolation (string): LINEAR to move smoothly between keyframes, or STEP to hold each
+                                keyframe until the next
+
+    Returns:
+        A FlightPlan lasting until the last keyframe, inclusive
+
+    Raises:
+        ValueError if keyframes are empty or out of order, or a value cannot be encoded
+    """
+
+    if not keyframes:
+        raise ValueError('a plan needs at least one keyframe')
+
+    keys = np.asarray(keyframes, dtype=np.float64)
+    if keys.ndim != 2 or keys.shape[1] != 5:
+        raise ValueError('keyframes must be (time, throttle, pitch, roll, yaw)')
+
+    times = keys[:, 0]
+    if (np.diff(times) < 0).any():
+        raise ValueError('keyframes must be in time order')
+
+    count = int(round((times[-1] - times[0]) * rate)) + 1
+    ticks = times[0] + np.arange(count) / rate
+
+    if interpolation == LINEAR:
+        channels = [np.interp(ticks, times, keys[:, column]) for column in range(1, 5)]
+    elif interpolation == STEP:
+        # Index of the last keyframe at or before each tick
+        index = np.searchsorted(times, ticks + 1e-9, side='right') - 1
+        channels = [keys[index, column] for column in range(1, 5)]
+    else:
+        raise ValueError('unknown interpolation: ' + str(interpolation))
+
+    return FlightPlan(encodeControlFrames(*channels), rate)
+
+def loadPlan(path):
+    """
+    Maps a plan saved with FlightPlan.save(). Frames are read straight from
+    the page cache, without copying the file into memory.
+
+    Returns:
+        A FlightPlan; call close() once finished with it
+    """
+
+    with open(path, 'rb') as f:
+        source = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    magic, rate, count = HEADER.unpack_from(source, 0)
+    if magic != MAGIC:
+        source.close()
+        raise ValueError('not a flight plan: ' + path)
+
+    data = memoryview(source)[HEADER.size:HEADER.size + count * FRAME_SIZE]
+
+    return FlightPlan(data, rate, source)
+
+class PlanPlayer:
+    """
+    Streams a FlightPlan to a drone from a background thread.
+
+    Each tick sends a slice of the plan's buffer, so nothing is encoded while
+    flying. Once the plan finishes, or abort() is called, idle frames are sent
+    until stop(), so the drone is never left without control.
+
+    Exported methods:
+    - start()
+    - stop()
+    - abort()
+    - position()
+    - finished()
+    - error()
+
+    Example:
+
+        player = PlanPlayer(drone, compilePlan([(0, 0.5, 0.5, 0.5, 0.5), (2, 0.8, 0.5, 0.5, 0.5)]))
+        player.start()
+
+        while not player.finished():
+            if emergency:
+                player.abort()
+
+        player.stop()
+    """
+
+    def __init__(self, drone, plan, spin = 0.0, clock = time.perf_counter, sleep = time.sleep):
+        """
+        Parameters:
+            drone (Drone):      A drone that has already been connected and setup
+            plan  (FlightPlan): The plan to play
+            spin  (float):      See Pacer
+            clock (callable):   Monotonic clock returning seconds
+            sleep (callable):   Sleep function taking seconds
+        """
+
+        self.drone = drone
+        self.plan = plan
+
+        self._pacer = Pacer(plan.rate, spin, clock=clock, sleep=sleep)
+        self._idle = bytes(ControlFrame().view)
+
+        self._position = 0
+        self._aborted = False
+        self._finished = False
+
+        self._thread = None
+        self._stopped = True
+        self._error = None
+
+    def start(self):
+        """
+        Starts playing from the beginning of the plan.
+        """
+
+        if self._thread is not None:
+            return
+
+        self._stopped = False
+        self._aborted = False
+        self._finished = False
+        self._position = 0
+        self._error = None
+
+        self._thread = threading.Thread(target=self.__run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stops sending anything, waiting for any in-flight send to complete.
+        """
+
+        if self._thread is None:
+            return
+
+        self._stopped = True
+        self._thread.join()
+        self._thread = None
+
+    def abort(self):
+        """
+        Abandons the rest of the plan, sending idle frames from the next tick.
+        Never blocks.
+        """
+
+        self._aborted = True
+
+    def position(self):
+        """
+        Returns:
+            The number of plan frames sent so far
+        """
+
+        return self._position
+
+    def finished(self):
+        """
+        Returns:
+            `True` once the plan has been played to the end or aborted, or the player failed
+        """
+
+        return self._finished
+
+    def error(self):
+        """
+        Returns:
+            The exception that stopped the player thread, or None
+        """
+
+        return self._error
+
+    #############################################################################
+    # Private
+    #############################################################################
+
+    def __run(self):
+        data = self.plan.data
+        end = len(data)
+        send = self.drone.safeSend
+        pacer = self._pacer
+        pacer.reset()
+
+        offset = 0
+
+        try:
+            while not self._stopped and not self._aborted and offset < end:
+                pacer.wait()
+                send(data[offset:offset + FRAME_SIZE], paced=False)
+
+                offset += FRAME_SIZE
+                self._position += 1
+
+            self._finished = True
+
+            while not self._stopped:
+                pacer.wait()
+                send(self._idle, paced=False)
+        except Exception as e:
+            self._error = e
+            self._finished = True
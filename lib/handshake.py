@@ -0,0 +1,277 @@
+"""
+Matt Clarke 2021.
+A concurrent, time-bounded alternative to Drone.connect() and Drone.setup().
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import errno
+import selectors
+import socket
+import time
+
+# Query command bytes
+VIDEO_TYPE = 0x42
+FIRMWARE   = 0x28
+
+def classifyReply(data):
+    """
+    Works out which query a UDP reply answers, from its contents alone.
+
+    Firmware versions are of the form "V6.1": digits with a dot. Video types
+    are of the form "VSVGA" or "V720P", so may also start with a digit, but
+    never contain a dot.
+
+    Parameters:
+        data (bytes): A datagram recieved from the drone
+
+    Returns:
+        FIRMWARE, VIDEO_TYPE, or None if the reply is not recognised
+    """
+
+    text = bytes(data).rstrip(b'\x00')
+
+    if len(text) < 2 or text[0:1] != b'V':
+        return None
+
+    parts = text[1:].split(b'.')
+    if len(parts) > 1 and all(part.isdigit() for part in parts):
+        return FIRMWARE
+
+    if text.isalnum():
+        return VIDEO_TYPE
+
+    return None
+
+class HandshakeResult:
+    """
+    The outcome of handshake().
+
+    Attributes:
+        ok        (bool):   `True` if the drone is ready for control commands
+        videoType (string): As Drone.videoType(), or None
+        firmware  (string): As Drone.firmware(), or None
+        timings   (dict):   Seconds from the start of the handshake until each step completed:
+                            `udp`, `tcp`, `videoType`, `firmware`, `heartbeat` and `total`.
+                            A step that did not complete is None.
+        attempts  (int):    How many times queries were sent
+        error     (string): Why the handshake failed, or None
+    """
+
+    def __init__(self):
+        self.ok = False
+        self.videoType = None
+        self.firmware = None
+        self.timings = {
+            'udp': None,
+            'tcp': None,
+            'videoType': None,
+            'firmware': None,
+            'heartbeat': None,
+            'total': None,
+        }
+        self.attempts = 0
+        self.error = None
+
+    def __repr__(self):
+        return 'HandshakeResult(ok={}, firmware={!r}, videoType={!r}, attempts={}, error={!r}, timings={})'.format(
+            self.ok, self.firmware, self.videoType, self.attempts, self.error, self.timings)
+
+def handshake(drone, ip = '192.168.1.1', udpPort = 8080, tcpPort = 8888, timeout = 0.25, retries = 3, clock = time.perf_counter):
+    """
+    Connects to the drone and runs the setup handshake, as connect() followed
+    by setup() would, but without ever blocking indefinitely.
+
+    - UDP and TCP are brought up concurrently.
+    - The setup commands and both queries are sent back-to-back, without
+      waiting between them. Replies are matched to queries by their contents.
+    - Any query without a reply after `timeout` is sent again, up to
+      `retries` more times.
+    - The heartbeat is sent as soon as TCP is up. Its reply is waited for,
+      but is not required.
+
+    On success, `drone` is left connected and setup, with its sockets in
+    blocking mode, exactly as after connect() and setup().
+
+    Parameters:
+        drone   (Drone):  The drone to connect
+        ip      (string): IP address of the drone
+        udpPort (int):    UDP port of the drone
+        tcpPort (int):    TCP port of the drone
+        timeout (float):  Seconds to wait for each attempt
+        retries (int):    How many times to resend unanswered queries
+
+    Returns:
+        A HandshakeResult. This never raises for network errors; check `ok` instead.
+    """
+
+    result = HandshakeResult()
+    start = clock()
+    deadline = start + timeout * (retries + 1)
+
+    selector = selectors.DefaultSelector()
+    udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    tcp = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+
+    def fail(error):
+        result.error = error
+        result.timings['total'] = clock() - start
+
+        if drone.metrics is not None:
+            drone.metrics.handshake(result.timings)
+
+        selector.close()
+        udp.close()
+        tcp.close()
+
+        return result
+
+    try:
+        udp.setblocking(False)
+        udp.connect((ip, udpPort))
+
+        tcp.setblocking(False)
+        status = tcp.connect_ex((ip, tcpPort))
+    except OSError as e:
+        return fail('connect: ' + str(e))
+
+    if status not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY):
+        return fail('tcp: ' + errno.errorcode.get(status, str(status)))
+
+    result.timings['udp'] = clock() - start
+
+    selector.register(udp, selectors.EVENT_READ)
+    selector.register(tcp, selectors.EVENT_WRITE)
+
+    # Everything goes out at once. `0x28` is sent twice to get past the
+    # drone-side bug where the first reply is stale.
+    queries = {
+        VIDEO_TYPE: b'\x42',
+        FIRMWARE: b'\x28',
+    }
+
+    try:
+        udp.send(drone._generateDroneIdCommand(1))
+        udp.send(drone._generateSetDateCommand(None))
+        udp.send(drone._generateSecondSetupCommand())
+        udp.send(queries[VIDEO_TYPE])
+        udp.send(queries[FIRMWARE])
+        udp.send(queries[FIRMWARE])
+    except OSError as e:
+        return fail('udp: ' + str(e))
+
+    result.attempts = 1
+    attemptDeadline = clock() + timeout
+
+    replies = {}
+    tcpConnected = False
+    heartbeatDone = False
+    buffer = bytearray(64)
+
+    now = clock()
+    while now < deadline and (len(replies) < len(queries) or not heartbeatDone):
+        wait = min(attemptDeadline, deadline) - now
+        events = selector.select(wait if wait > 0 else 0)
+
+        for key, mask in events:
+            if key.fileobj is udp:
+                try:
+                    while True:
+                        size = udp.recv_into(buffer)
+                        kind = classifyReply(buffer[:size])
+
+                        # Only the latest answer to each query is kept, so a
+                        # stale reply is overwritten by the fresh one
+                        if kind is not None:
+                            replies[kind] = bytes(buffer[:min(size, 6)])
+
+                            name = 'firmware' if kind == FIRMWARE else 'videoType'
+                            result.timings[name] = clock() - start
+                except (BlockingIOError, InterruptedError):
+                    pass
+                except OSError as e:
+                    return fail('udp: ' + str(e))
+
+            elif not tcpConnected:
+                error = tcp.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if error != 0:
+                    return fail('tcp: ' + errno.errorcode.get(error, str(error)))
+
+                tcpConnected = True
+                result.timings['tcp'] = clock() - start
+
+                try:
+                    tcp.send(drone._generateHeartbeatCommand())
+                except OSError as e:
+                    return fail('tcp: ' + str(e))
+
+                selector.modify(tcp, selectors.EVENT_READ)
+
+            else:
+                # Heartbeat reply; contents are ignored, as in setup()
+                try:
+                    tcp.recv(20)
+                except (BlockingIOError, InterruptedError):
+                    continue
+                except OSError as e:
+                    return fail('tcp: ' + str(e))
+
+                heartbeatDone = True
+                result.timings['heartbeat'] = clock() - start
+                selector.unregister(tcp)
+
+        now = clock()
+
+        if now >= attemptDeadline and now < deadline:
+            # The heartbeat reply is optional, so stop waiting for it once
+            # everything else has had a full attempt to arrive
+            if tcpConnected and len(replies) == len(queries):
+                heartbeatDone = True
+                break
+
+            missing = [queries[kind] for kind in queries if kind not in replies]
+
+            try:
+                for query in missing:
+                    udp.send(query)
+            except OSError as e:
+                return fail('udp: ' + str(e))
+
+            result.attempts += 1
+            attemptDeadline = now + timeout
+
+    if not tcpConnected:
+        return fail('tcp: timed out connecting')
+
+    if FIRMWARE not in replies or VIDEO_TYPE not in replies:
+        return fail('udp: timed out waiting for replies')
+
+    result.videoType = replies[VIDEO_TYPE].decode('ascii')
+    result.firmware = replies[FIRMWARE].decode('ascii')
+
+    selector.close()
+    udp.setblocking(True)
+    tcp.setblocking(True)
+
+    drone.udpsocket = udp
+    drone.tcpsocket = tcp
+    drone._resetControl()
+    drone.videoType_ = result.videoType
+    drone.firmware_ = result.firmware
+
+    result.ok = True
+    result.timings['total'] = clock() - start
+
+    if drone.metrics is not None:
+        drone.metrics.handshake(result.timings)
+
+    return result
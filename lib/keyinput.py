@@ -0,0 +1,270 @@
+"""
+Matt Clarke 2021.
+Keyboard control input, turning key presses into setpoints.
+
+Dependencies:
+    - getkey
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import threading
+import time
+
+IDLE = (0.5, 0.5, 0.5, 0.5)
+
+# Key to (throttle, pitch, roll, yaw). Upper case names are looked up in
+# getkey.keys, anything else is a literal key.
+DEFAULT_BINDINGS = {
+    'UP':    (0.85, 0.5, 0.5, 0.5),
+    'DOWN':  (0.0, 0.5, 0.5, 0.5),
+    'LEFT':  (0.5, 0.5, 0.3, 0.5),
+    'RIGHT': (0.5, 0.5, 0.7, 0.5),
+    'w':     (0.5, 0.3, 0.5, 0.5),
+    's':     (0.5, 0.7, 0.5, 0.5),
+    # Yaw is 100% or 0%, no scaling
+    'a':     (0.5, 0.5, 0.5, 0.0),
+    'd':     (0.5, 0.5, 0.5, 1.0),
+}
+
+class KeyboardInput:
+    """
+    Reads key presses on a background thread, and publishes the setpoint for
+    the most recent one.
+
+    Terminals only report key presses, not releases, and a held key repeats.
+    So a key counts as released once no press has been seen for
+    `releaseTimeout` seconds, at which point the setpoint returns to idle. The
+    release is a deadline waited on by a second thread, which sleeps until it
+    is due, or until another press moves it.
+
+    The setpoint is published as a single tuple, so readers always see all four
+    values from the same key press. Its timestamp is the moment the key was
+    read, or None if the setpoint did not come from a key press (at startup,
+    and after a release). Passing it to delivered() once the setpoint has been
+    sent measures key-to-send latency; skip() leaves out a press whose send was
+    held up on purpose, e.g. by a takeoff.
+
+    Exported methods:
+    - start()
+    - stop()
+    - setpoint()
+    - current()
+    - delivered(timestamp)
+    - skip()
+    - stats()
+
+    Example:
+
+        keyboard = KeyboardInput()
+        keyboard.start()
+
+        while True:
+            setpoint, timestamp = keyboard.current()
+            drone.control(*setpoint)
+            keyboard.delivered(timestamp)
+    """
+
+    def __init__(self, bindings = None, releaseTimeout = 0.2, clock = time.perf_counter, readKey = None):
+        """
+        Parameters:
+            bindings       (dict):     Key to (throttle, pitch, roll, yaw). Defaults to DEFAULT_BINDINGS.
+                                       Any other key returns to idle.
+            releaseTimeout (float):    Seconds without a press before the key counts as released
+            clock          (callable): Monotonic clock returning seconds
+            readKey        (callable): Blocks until a key is pressed, and returns it. Defaults to getkey.
+        """
+
+        self.releaseTimeout = releaseTimeout
+
+        self._bindings = DEFAULT_BINDINGS if bindings is None else bindings
+        self._resolved = {}
+        self._clock = clock
+        self._readKey = readKey
+
+        # (setpoint, timestamp), replaced whole on every change. Only key
+        # presses have a timestamp.
+        self._current = (IDLE, None)
+
+        self._deadline = None
+        self._condition = threading.Condition()
+
+        self._stopped = True
+        self._threads = []
+
+        self._presses = 0
+        self._releases = 0
+        self._latencySum = 0.0
+        self._latencyMax = 0.0
+        self._latencyCount = 0
+        self._lastDelivered = None
+        self._skippedUntil = None
+
+    def start(self):
+        """
+        Starts reading keys.
+        """
+
+        if self._threads:
+            return
+
+        bindings = self._bindings
+
+        if self._readKey is None:
+            # Only needed on the ground station, so imported here
+            from getkey import getkey, keys
+
+            self._readKey = lambda: getkey(blocking=True)
+            bindings = { (getattr(keys, key) if key.isupper() else key): value for key, value in bindings.items() }
+
+        self._resolved = bindings
+        self._stopped = False
+
+        self._threads = [
+            threading.Thread(target=self.__readKeys, daemon=True),
+            threading.Thread(target=self.__releaseKeys, daemon=True),
+        ]
+
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self, timeout = 0.5):
+        """
+        Stops reading keys, returns the setpoint to idle, and waits for both
+        threads to exit.
+
+        The reader thread may be blocked on the terminal until the next key
+        press, so is only waited on for up to `timeout` seconds. It is a daemon,
+        so never holds up the process exiting.
+
+        Parameters:
+            timeout (float): Seconds to wait for the reader thread
+
+        Returns:
+            `True` if both threads have exited
+        """
+
+        self._stopped = True
+
+        with self._condition:
+            self._condition.notify_all()
+
+        reader, releaser = self._threads if self._threads else (None, None)
+
+        if releaser is not None:
+            releaser.join()
+        if reader is not None:
+            reader.join(timeout)
+
+        self._current = (IDLE, None)
+        self._threads = []
+
+        return reader is None or not reader.is_alive()
+
+    def setpoint(self):
+        """
+        Returns:
+            The current (throttle, pitch, roll, yaw), as for Drone.control()
+        """
+
+        return self._current[0]
+
+    def current(self):
+        """
+        Returns:
+            A tuple of (setpoint, timestamp), where timestamp is when the key that
+            produced the setpoint was read, or None if it was not produced by a key
+        """
+
+        return self._current
+
+    def delivered(self, timestamp):
+        """
+        Records that the setpoint from current() has been sent. Only the first
+        call for each key press counts towards latency.
+
+        Parameters:
+            timestamp (float): As returned by current(); None is ignored
+        """
+
+        if timestamp is None or timestamp == self._lastDelivered:
+            return
+
+        if self._skippedUntil is not None and timestamp <= self._skippedUntil:
+            return
+
+        self._lastDelivered = timestamp
+
+        latency = self._clock() - timestamp
+        self._latencySum += latency
+        self._latencyCount += 1
+        if latency > self._latencyMax: self._latencyMax = latency
+
+    def skip(self):
+        """
+        Marks every key press so far as delivered, without counting their
+        latency. Call this when sends were held up deliberately, e.g. while
+        taking off.
+        """
+
+        self._skippedUntil = self._clock()
+
+    def stats(self):
+        """
+        Returns:
+            A dict with keys:
+            - `presses`: key presses read
+            - `releases`: times the setpoint returned to idle after a release
+            - `latencyMean`: mean seconds from a key being read to its setpoint being delivered
+            - `latencyMax`: worst such latency in seconds
+        """
+
+        return {
+            'presses': self._presses,
+            'releases': self._releases,
+            'latencyMean': self._latencySum / self._latencyCount if self._latencyCount > 0 else 0.0,
+            'latencyMax': self._latencyMax,
+        }
+
+    #############################################################################
+    # Private
+    #############################################################################
+
+    def __readKeys(self):
+        while not self._stopped:
+            key = self._readKey()
+            now = self._clock()
+
+            if self._stopped:
+                break
+
+            with self._condition:
+                self._current = (self._resolved.get(key, IDLE), now)
+                self._presses += 1
+                self._deadline = now + self.releaseTimeout
+                self._condition.notify()
+
+    def __releaseKeys(self):
+        with self._condition:
+            while not self._stopped:
+                if self._deadline is None:
+                    self._condition.wait()
+                    continue
+
+                remaining = self._deadline - self._clock()
+                if remaining > 0:
+                    self._condition.wait(remaining)
+                    continue
+
+                self._deadline = None
+                self._current = (IDLE, None)
+                self._releases += 1
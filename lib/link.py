@@ -0,0 +1,275 @@
+"""
+Matt Clarke 2021.
+Estimates link quality from `0x28` echoes, and adapts the control stream to it.
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from collections import deque
+from concurrent.futures import TimeoutError
+import threading
+import time
+
+from lib.handshake import FIRMWARE
+
+# Ways LinkMonitor can relieve a congested link
+RATE      = 'rate'
+ON_CHANGE = 'onChange'
+
+class LinkMonitor:
+    """
+    Measures round-trip time and loss to a drone, using its reply to `0x28` as
+    an echo.
+
+    One probe is in flight at a time. Each is sent through a ReplyDemux, and
+    counts as lost if unanswered within `interval`, in which case its reply is
+    discarded if it arrives late. Other `0x28` traffic on the same drone, such
+    as DroneStreams keepalives, must be sent through the same demux, or its
+    replies are taken for the probe's. Round-trip times are
+    smoothed with an EWMA as TCP does (RFC 6298), and the last `window` probes
+    are kept for percentiles and the loss rate.
+
+    Optionally, a ControlStream can be adapted to the link. While the smoothed
+    RTT or loss rate is above its threshold, the stream is degraded: either its
+    rate is lowered, or it switches to send-on-change. Once both fall below
+    half their thresholds, the stream's rate or the drone's `keepaliveFloor`
+    is put back as it was before. On a congested link this sends fewer,
+    fresher frames instead of queueing stale ones.
+
+    Exported methods:
+    - start()
+    - stop()
+    - degraded()
+    - stats()
+
+    Example:
+
+        demux = ReplyDemux(drone)
+        demux.start()
+
+        stream = ControlStream(drone)
+        stream.start()
+
+        monitor = LinkMonitor(demux, stream)
+        monitor.start()
+
+        print(monitor.stats())
+    """
+
+    def __init__(self, demux, stream = None, interval = 0.1, window = 100, alpha = 0.125, beta = 0.25, mode = RATE,
+                 fullRate = None, degradedRate = 25, onChangeFloor = 0.1, rttThreshold = 0.05, lossThreshold = 0.1,
+                 clock = time.perf_counter, sleep = time.sleep):
+        """
+        Parameters:
+            demux         (ReplyDemux):    A started demux for the drone
+            stream        (ControlStream): Optional; a stream to adapt to the link
+            interval      (float):  Seconds between probes, and how long each may wait for its reply
+            window        (int):    Number of recent probes used for percentiles and loss
+            alpha         (float):  EWMA gain for the smoothed RTT
+            beta          (float):  EWMA gain for the RTT variation
+            mode          (string): RATE to lower the stream's rate when degraded, or ON_CHANGE to switch to send-on-change
+            fullRate      (float):  Stream rate in Hz to restore once healthy, or None for the rate it had when degraded
+            degradedRate  (float):  Stream rate in Hz while degraded, in RATE mode
+            onChangeFloor (float):  Longest gap between sends while degraded, in ON_CHANGE mode
+            rttThreshold  (float):  Smoothed RTT in seconds above which the link is congested
+            lossThreshold (float):  Loss rate (0 to 1) above which the link is congested
+            clock         (callable): Monotonic clock returning seconds
+            sleep         (callable): Sleep function taking seconds
+        """
+
+        if mode not in (RATE, ON_CHANGE):
+            raise ValueError('unknown mode: ' + str(mode))
+
+        self.demux = demux
+        self.stream = stream
+        self.interval = interval
+        self.alpha = alpha
+        self.beta = beta
+        self.mode = mode
+        self.fullRate = fullRate
+        self.degradedRate = degradedRate
+        self.onChangeFloor = onChangeFloor
+        self.rttThreshold = rttThreshold
+        self.lossThreshold = lossThreshold
+
+        self._clock = clock
+        self._sleep = sleep
+
+        # Each probe's RTT in seconds, or None if lost
+        self._window = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+        self._srtt = None
+        self._rttvar = None
+        self._sent = 0
+        self._lost = 0
+        self._degraded = False
+        self._changes = 0
+
+        # The stream's settings from before it was degraded
+        self._savedRate = None
+        self._savedFloor = None
+
+        self._thread = None
+        self._stopped = True
+
+    def start(self):
+        """
+        Starts probing on a background thread.
+        """
+
+        if self._thread is not None:
+            return
+
+        self._stopped = False
+        self._thread = threading.Thread(target=self.__run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stops probing. If the stream was degraded, its settings are restored.
+        """
+
+        if self._thread is None:
+            return
+
+        self._stopped = True
+        self._thread.join()
+        self._thread = None
+
+        if self._degraded:
+            self.__restore()
+
+    def degraded(self):
+        """
+        Returns:
+            `True` if the stream is currently degraded because of congestion
+        """
+
+        return self._degraded
+
+    def stats(self):
+        """
+        Returns:
+            A dict with keys:
+            - `srtt`: smoothed round-trip time in seconds, or None before the first reply
+            - `rttvar`: smoothed round-trip time variation in seconds, or None
+            - `p50`, `p90`, `p99`: RTT percentiles over the window in seconds, or None
+            - `loss`: fraction of probes lost over the window
+            - `sent`: total probes sent
+            - `lost`: total probes lost
+            - `degraded`: whether the stream is degraded
+            - `changes`: number of times the stream was degraded or restored
+        """
+
+        with self._lock:
+            window = list(self._window)
+
+        rtts = sorted(rtt for rtt in window if rtt is not None)
+        last = len(rtts) - 1
+
+        def percentile(fraction):
+            return rtts[int(last * fraction)] if rtts else None
+
+        return {
+            'srtt': self._srtt,
+            'rttvar': self._rttvar,
+            'p50': percentile(0.50),
+            'p90': percentile(0.90),
+            'p99': percentile(0.99),
+            'loss': (len(window) - len(rtts)) / len(window) if window else 0.0,
+            'sent': self._sent,
+            'lost': self._lost,
+            'degraded': self._degraded,
+            'changes': self._changes,
+        }
+
+    #############################################################################
+    # Private
+    #############################################################################
+
+    def __run(self):
+        clock = self._clock
+
+        while not self._stopped:
+            sent = clock()
+            future = self.demux.firmware()
+            self._sent += 1
+
+            try:
+                future.result(timeout=self.interval)
+                self.__sample(clock() - sent)
+            except TimeoutError:
+                # Otherwise its late reply would complete the next probe early
+                self.demux.cancel(FIRMWARE, future)
+                self.__sample(None)
+            except Exception:
+                # Demux stopped or failed; nothing more can be measured
+                return
+
+            if self.stream is not None:
+                self.__adapt()
+
+            remaining = sent + self.interval - clock()
+            if remaining > 0:
+                self._sleep(remaining)
+
+    def __sample(self, rtt):
+        with self._lock:
+            self._window.append(rtt)
+
+        if rtt is None:
+            self._lost += 1
+            return
+
+        if self._srtt is None:
+            self._srtt = rtt
+            self._rttvar = rtt / 2
+        else:
+            self._rttvar += self.beta * (abs(self._srtt - rtt) - self._rttvar)
+            self._srtt += self.alpha * (rtt - self._srtt)
+
+    def __adapt(self):
+        with self._lock:
+            window = list(self._window)
+
+        loss = window.count(None) / len(window)
+
+        # A link that answers nothing has no srtt, but is certainly congested
+        srtt = self._srtt if self._srtt is not None else float('inf')
+
+        if not self._degraded:
+            if srtt > self.rttThreshold or loss > self.lossThreshold:
+                self.__degrade()
+
+        elif srtt < self.rttThreshold / 2 and loss < self.lossThreshold / 2:
+            self.__restore()
+
+    def __degrade(self):
+        if self.mode == RATE:
+            self._savedRate = 1.0 / self.stream.pacer.period
+            self.stream.setRate(self.degradedRate)
+        else:
+            self._savedFloor = self.stream.drone.keepaliveFloor
+            self.stream.setSendOnChange(self.onChangeFloor)
+
+        self._degraded = True
+        self._changes += 1
+
+    def __restore(self):
+        if self.mode == RATE:
+            self.stream.setRate(self.fullRate if self.fullRate is not None else self._savedRate)
+        else:
+            self.stream.setSendOnChange(self._savedFloor)
+
+        self._degraded = False
+        self._changes += 1
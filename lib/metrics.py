@@ -0,0 +1,287 @@
+"""
+Matt Clarke 2021.
+Low-overhead metrics for the send path: latency histograms and counters.
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from bisect import bisect_left
+import math
+import threading
+import time
+
+class Metrics:
+    """
+    Collects metrics from a drone's sends.
+
+    Per socket (`udp` and `tcp`), this counts packets, bytes and errors, and
+    keeps log-bucketed histograms of how long each send call took and of the
+    interval between sends. Bucket upper bounds double from `base` seconds. The
+    timings of the last handshake are kept too.
+
+    Recording a send takes no lock: it reads the clock, finds both buckets by
+    bisecting a precomputed tuple of bounds, and updates flat per-socket
+    counters. Even so, it adds about 0.7us to each send on a slow CPU, where a
+    UDP send alone takes about 2.5us, so leave `metrics` unset where every
+    microsecond counts. Should two threads send on the same socket at the
+    same instant, one of their counts may rarely be lost.
+
+    Assign to a drone to enable:
+
+        drone.metrics = Metrics()
+        ...
+        print(drone.metrics.prometheus())
+
+    Other methods take a lock, and are safe to call from any thread.
+
+    Exported methods:
+    - sent(name, size, started)
+    - error(name)
+    - handshake(timings)
+    - event(name, value)
+    - snapshot()
+    - reset()
+    - prometheus(prefix)
+    """
+
+    def __init__(self, base = 1e-6, buckets = 24, clock = time.perf_counter):
+        """
+        Parameters:
+            base    (float):    Upper bound of the first bucket, in seconds
+            buckets (int):      Number of buckets, including the last unbounded one
+            clock   (callable): Monotonic clock returning seconds. Also used by Drone to time sends.
+        """
+
+        self.clock = clock
+        self.base = base
+        self.bounds = [base * 2 ** i for i in range(buckets - 1)] + [math.inf]
+
+        # Finite bounds only; bisect_left() past the last gives the unbounded bucket
+        self._bounds = tuple(self.bounds[:-1])
+
+        self._lock = threading.Lock()
+        self._sockets = {}
+        self._handshake = {}
+        self._events = {}
+
+    def sent(self, name, size, started):
+        """
+        Records a successful send. Called by Drone after each send.
+
+        Parameters:
+            name    (string): Socket the packet was sent on, e.g. `udp`
+            size    (int):    Bytes sent
+            started (float):  Time from `clock` just before the send call
+        """
+
+        finished = self.clock()
+
+        metrics = self._sockets.get(name)
+        if metrics is None:
+            with self._lock:
+                metrics = self.__socket(name)
+
+        metrics.packets += 1
+        metrics.bytes += size
+
+        latency = finished - started
+        metrics.latency[bisect_left(self._bounds, latency)] += 1
+        metrics.latencySum += latency
+
+        last = metrics.last
+        metrics.last = started
+
+        if last is not None:
+            interval = started - last
+            metrics.interval[bisect_left(self._bounds, interval)] += 1
+            metrics.intervalSum += interval
+
+    def error(self, name):
+        """
+        Records a failed send.
+
+        Parameters:
+            name (string): Socket the send failed on
+        """
+
+        with self._lock:
+            self.__socket(name).errors += 1
+
+    def handshake(self, timings):
+        """
+        Records the timings of a handshake, replacing any previous ones.
+
+        Parameters:
+            timings (dict): Step name to seconds, e.g. HandshakeResult.timings
+        """
+
+        with self._lock:
+            self._handshake = dict(timings)
+
+    def event(self, name, value):
+        """
+        Records a duration in a named histogram, e.g. an outage.
+
+        Parameters:
+            name  (string): Name of the histogram
+            value (float):  Seconds
+        """
+
+        with self._lock:
+            histogram = self._events.get(name)
+            if histogram is None:
+                histogram = self._events[name] = _Histogram(len(self.bounds))
+
+            histogram.buckets[bisect_left(self._bounds, value)] += 1
+            histogram.sum += value
+            histogram.count += 1
+
+    def snapshot(self):
+        """
+        Returns:
+            A dict with keys:
+            - `bounds`: upper bound of each histogram bucket, in seconds
+            - `sockets`: socket name to a dict of `packets`, `bytes`, `errors`, `latency` and `interval`
+            - `handshake`: step name to seconds, from the last handshake
+            - `events`: histogram name to histogram
+
+            Each histogram is a dict of `buckets` (count per bucket, not cumulative),
+            `sum` (seconds) and `count`.
+        """
+
+        with self._lock:
+            sockets = { name: metrics.copy() for name, metrics in self._sockets.items() }
+            events = { name: histogram.copy() for name, histogram in self._events.items() }
+
+            return {
+                'bounds': list(self.bounds),
+                'sockets': sockets,
+                'handshake': dict(self._handshake),
+                'events': events,
+            }
+
+    def reset(self):
+        """
+        Clears all metrics.
+        """
+
+        with self._lock:
+            self._sockets = {}
+            self._handshake = {}
+            self._events = {}
+
+    def prometheus(self, prefix = 'drone'):
+        """
+        Formats a snapshot in the Prometheus text exposition format.
+
+        Parameters:
+            prefix (string): Prefix for every metric name
+
+        Returns:
+            A string, ending in a newline
+        """
+
+        snapshot = self.snapshot()
+        bounds = snapshot['bounds']
+        sockets = snapshot['sockets']
+        lines = []
+
+        for name, description in (('packets', 'Packets sent.'), ('bytes', 'Bytes sent.'), ('errors', 'Failed sends.')):
+            metric = '{}_{}_total'.format(prefix, name)
+            lines.append('# HELP {} {}'.format(metric, description))
+            lines.append('# TYPE {} counter'.format(metric))
+
+            for socketName, metrics in sorted(sockets.items()):
+                lines.append('{}{{socket="{}"}} {}'.format(metric, socketName, metrics[name]))
+
+        for name, description in (('latency', 'Time spent in each send call.'), ('interval', 'Time between consecutive sends.')):
+            metric = '{}_send_{}_seconds'.format(prefix, name)
+            lines.append('# HELP {} {}'.format(metric, description))
+            lines.append('# TYPE {} histogram'.format(metric))
+
+            for socketName, metrics in sorted(sockets.items()):
+                _formatHistogram(lines, metric, 'socket="{}"'.format(socketName), bounds, metrics[name])
+
+        if snapshot['handshake']:
+            metric = '{}_handshake_seconds'.format(prefix)
+            lines.append('# HELP {} Time from the start of the last handshake until each step completed.'.format(metric))
+            lines.append('# TYPE {} gauge'.format(metric))
+
+            for step, value in sorted(snapshot['handshake'].items()):
+                if value is not None:
+                    lines.append('{}{{step="{}"}} {!r}'.format(metric, step, value))
+
+        for name, histogram in sorted(snapshot['events'].items()):
+            metric = '{}_{}_seconds'.format(prefix, name)
+            lines.append('# TYPE {} histogram'.format(metric))
+            _formatHistogram(lines, metric, None, bounds, histogram)
+
+        return '\n'.join(lines) + '\n'
+
+    #############################################################################
+    # Private
+    #############################################################################
+
+    def __socket(self, name):
+        metrics = self._sockets.get(name)
+        if metrics is None:
+            metrics = self._sockets[name] = _SocketMetrics(len(self.bounds))
+
+        return metrics
+
+class _Histogram:
+    def __init__(self, buckets):
+        self.buckets = [0] * buckets
+        self.sum = 0.0
+        self.count = 0
+
+    def copy(self):
+        return { 'buckets': list(self.buckets), 'sum': self.sum, 'count': self.count }
+
+class _SocketMetrics:
+    # Histograms are held flat, rather than as _Histogram, to save an attribute
+    # lookup per send. Each histogram's count is the sum of its buckets.
+
+    def __init__(self, buckets):
+        self.packets = 0
+        self.bytes = 0
+        self.errors = 0
+        self.latency = [0] * buckets
+        self.latencySum = 0.0
+        self.interval = [0] * buckets
+        self.intervalSum = 0.0
+        self.last = None
+
+    def copy(self):
+        latency = list(self.latency)
+        interval = list(self.interval)
+
+        return {
+            'packets': self.packets,
+            'bytes': self.bytes,
+            'errors': self.errors,
+            'latency': { 'buckets': latency, 'sum': self.latencySum, 'count': sum(latency) },
+            'interval': { 'buckets': interval, 'sum': self.intervalSum, 'count': sum(interval) },
+        }
+
+def _formatHistogram(lines, metric, labels, bounds, histogram):
+    prefix = labels + ',' if labels else ''
+    cumulative = 0
+
+    for bound, count in zip(bounds, histogram['buckets']):
+        cumulative += count
+        le = '+Inf' if bound == math.inf else repr(bound)
+        lines.append('{}_bucket{{{}le="{}"}} {}'.format(metric, prefix, le, cumulative))
+
+    suffix = '{' + labels + '}' if labels else ''
+    lines.append('{}_sum{} {!r}'.format(metric, suffix, histogram['sum']))
+    lines.append('{}_count{} {}'.format(metric, suffix, histogram['count']))
@@ -0,0 +1,142 @@
+"""
+Matt Clarke 2021.
+Deadline-based pacing for sending packets at a fixed rate.
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import time
+
+class Pacer:
+    """
+    Holds a loop to a fixed rate, using deadlines on a monotonic clock rather
+    than a fixed sleep per iteration.
+
+    Deadlines sit on a fixed grid, so time spent by the caller between calls to
+    wait() is absorbed rather than added to the period. If the caller falls
+    behind, wait() returns immediately until the grid is caught up again; if it
+    falls more than `maxCatchUp` periods behind, the grid is restarted from now
+    instead of bursting out the backlog.
+
+    Exported methods:
+    - wait()
+    - reset()
+    - stats()
+
+    Example:
+
+        drone.pacer = Pacer(200)
+    """
+
+    def __init__(self, rate = 100, spin = 0.0, maxCatchUp = 2, clock = time.perf_counter, sleep = time.sleep):
+        """
+        Parameters:
+            rate       (float): Target rate in Hz, typically 100 to 500
+            spin       (float): Seconds before each deadline to stop sleeping and busy-wait instead.
+                                0.0 disables spinning; ~0.002 gives sub-millisecond jitter at the cost of CPU.
+            maxCatchUp (int):   How many periods behind the caller may fall before the grid is restarted
+            clock      (callable): Monotonic clock returning seconds
+            sleep      (callable): Sleep function taking seconds
+        """
+
+        if rate <= 0:
+            raise ValueError('rate must be positive')
+
+        self.period = 1.0 / rate
+        self.spin = spin
+        self.maxCatchUp = maxCatchUp
+
+        self._clock = clock
+        self._sleep = sleep
+
+        self.reset()
+
+    def reset(self):
+        """
+        Restarts the deadline grid from the next call to wait(), and clears
+        statistics.
+        """
+
+        self._deadline = None
+
+        self._count = 0
+        self._first = 0.0
+        self._last = 0.0
+        self._jitterSum = 0.0
+        self._jitterMax = 0.0
+        self._restarts = 0
+
+    def wait(self):
+        """
+        Blocks until the next deadline.
+
+        The first call returns immediately and anchors the grid.
+
+        Returns:
+            The lateness in seconds of this release relative to its deadline
+        """
+
+        clock = self._clock
+        now = clock()
+
+        if self._deadline is None:
+            self._deadline = now
+            self._first = now
+        else:
+            remaining = self._deadline - now
+
+            if remaining < -self.maxCatchUp * self.period:
+                # Too far behind; drop the backlog rather than burst
+                self._deadline = now
+                self._restarts += 1
+            elif remaining > 0:
+                if remaining > self.spin:
+                    self._sleep(remaining - self.spin)
+
+                now = clock()
+                while now < self._deadline:
+                    now = clock()
+
+        lateness = now - self._deadline
+        if lateness < 0.0: lateness = 0.0
+
+        self._count += 1
+        self._last = now
+        self._jitterSum += lateness
+        if lateness > self._jitterMax: self._jitterMax = lateness
+
+        self._deadline += self.period
+
+        return lateness
+
+    def stats(self):
+        """
+        A snapshot of how well the target rate is being held.
+
+        Returns:
+            A dict with keys:
+            - `rate`: achieved rate in Hz since the last reset
+            - `jitterMean`: mean lateness of each release, in seconds
+            - `jitterMax`: worst lateness of a release, in seconds
+            - `count`: number of releases
+            - `restarts`: how many times the grid was restarted after falling behind
+        """
+
+        elapsed = self._last - self._first
+
+        return {
+            'rate': (self._count - 1) / elapsed if elapsed > 0 else 0.0,
+            'jitterMean': self._jitterSum / self._count if self._count > 0 else 0.0,
+            'jitterMax': self._jitterMax,
+            'count': self._count,
+            'restarts': self._restarts,
+        }
@@ -0,0 +1,324 @@
+"""
+Matt Clarke 2021.
+A timing-wheel scheduler for all periodic traffic to a drone.
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import threading
+import time
+
+from lib.drone import ControlFrame
+from lib.pacer import Pacer
+
+class Scheduler:
+    """
+    Multiplexes any number of periodic send streams onto one thread.
+
+    Time is divided into ticks of `resolution` seconds. Each stream's period is
+    rounded to a whole number of ticks, and streams are held in a hashed timing
+    wheel keyed on the tick they are next due. Streams due on the same tick are
+    sent back-to-back in that tick, highest priority first, then rescheduled
+    from when they were due rather than when they ran, so periods never drift.
+
+    Exported methods:
+    - add(name, period, send, priority)
+    - remove(name)
+    - start()
+    - stop()
+    - run(duration)
+    - stats()
+
+    Example:
+
+        scheduler = Scheduler()
+        streams = DroneStreams(scheduler, drone)
+        scheduler.start()
+
+        streams.set(throttle, pitch, roll, yaw)
+    """
+
+    def __init__(self, resolution = 0.002, slots = 256, spin = 0.0, clock = time.perf_counter, sleep = time.sleep):
+        """
+        Parameters:
+            resolution (float): Seconds per tick
+            slots      (int):   Size of the wheel. Streams with periods longer than this many ticks still work,
+                                but are looked at once per revolution.
+            spin       (float): See Pacer
+            clock      (callable): Monotonic clock returning seconds
+            sleep      (callable): Sleep function taking seconds
+        """
+
+        self.resolution = resolution
+
+        self._pacer = Pacer(1.0 / resolution, spin, clock=clock, sleep=sleep)
+        self._clock = clock
+        self._wheel = [[] for _ in range(slots)]
+        self._streams = {}
+        self._lock = threading.Lock()
+        self._tick = 0
+
+        self._thread = None
+        self._stopped = True
+
+    def add(self, name, period, send, priority = 0):
+        """
+        Adds a periodic stream. It is first sent on the next tick.
+
+        Parameters:
+            name     (string):   Unique name of the stream
+            period   (float):    Seconds between sends; rounded to a whole number of ticks
+            send     (callable): Called with no arguments to send
+            priority (int):      Streams due in the same tick are sent highest priority first
+        """
+
+        stream = _Stream(name, max(1, int(round(period / self.resolution))), send, priority)
+
+        with self._lock:
+            if name in self._streams:
+                raise ValueError('stream already exists: ' + name)
+
+            self._streams[name] = stream
+            self.__schedule(stream, self._tick + 1)
+
+    def remove(self, name):
+        """
+        Removes a stream. Safe to call while running.
+        """
+
+        with self._lock:
+            stream = self._streams.pop(name)
+            self._wheel[stream.due % len(self._wheel)].remove(stream)
+
+    def start(self):
+        """
+        Runs the scheduler on a background thread.
+        """
+
+        if self._thread is not None:
+            return
+
+        self._stopped = False
+        self._thread = threading.Thread(target=self.run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stops the scheduler after its current tick.
+        """
+
+        self._stopped = True
+
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def run(self, duration = None):
+        """
+        Runs the scheduler in the calling thread, until stop() is called or
+        `duration` elapses.
+
+        Parameters:
+            duration (float): Seconds to run for, or None to run until stopped
+        """
+
+        self._stopped = False
+        self._pacer.reset()
+
+        clock = self._clock
+        end = None if duration is None else clock() + duration
+
+        while not self._stopped:
+            lateness = self._pacer.wait()
+            released = clock()
+
+            if end is not None and released >= end:
+                break
+
+            self.__runTick(released - lateness)
+
+    def stats(self):
+        """
+        Per-stream statistics. Lateness is measured from when the tick a stream
+        was due on started, so includes time spent sending higher priority
+        streams in the same tick.
+
+        Returns:
+            A dict of stream name to a dict with keys:
+            - `period`: actual period in seconds, after rounding to ticks
+            - `sent`: number of sends
+            - `errors`: number of sends that raised
+            - `lateMean`: mean lateness in seconds
+            - `lateMax`: worst lateness in seconds
+        """
+
+        with self._lock:
+            streams = list(self._streams.values())
+
+        return { stream.name: stream.stats(self.resolution) for stream in streams }
+
+    #############################################################################
+    # Private
+    #############################################################################
+
+    def __schedule(self, stream, due):
+        stream.due = due
+        self._wheel[due % len(self._wheel)].append(stream)
+
+    def __runTick(self, deadline):
+        with self._lock:
+            self._tick += 1
+            tick = self._tick
+
+            slot = self._wheel[tick % len(self._wheel)]
+            due = [stream for stream in slot if stream.due == tick]
+
+            if not due:
+                return
+
+            for stream in due:
+                slot.remove(stream)
+                self.__schedule(stream, tick + stream.periodTicks)
+
+        if len(due) > 1:
+            due.sort(key=lambda stream: -stream.priority)
+
+        clock = self._clock
+
+        for stream in due:
+            try:
+                stream.send()
+            except Exception as e:
+                stream.errors += 1
+                stream.lastError = e
+                continue
+
+            late = clock() - deadline
+
+            stream.sent += 1
+            stream.lateSum += late
+            if late > stream.lateMax: stream.lateMax = late
+
+class DroneStreams:
+    """
+    The periodic traffic the official app sends to a drone, registered on a
+    Scheduler:
+
+    - `control`: the latest setpoint, every 10ms
+    - `keepalive`: a `0x28` query, every 10ms
+    - `heartbeat`: the TCP heartbeat, every 100ms
+
+    Setpoints are swapped in atomically with set(), and encoded on the
+    scheduler thread.
+
+    Exported methods:
+    - set(throttle, pitch, roll, yaw)
+    - idle()
+    - remove()
+    """
+
+    def __init__(self, scheduler, drone, control = 0.01, keepalive = 0.01, heartbeat = 0.1, prefix = '', demux = None):
+        """
+        Parameters:
+            scheduler (Scheduler): Scheduler to register on
+            drone     (Drone):     A drone that has already been connected and setup
+            control   (float):     Control period in seconds, or None to not send
+            keepalive (float):     Keepalive period in seconds, or None to not send
+            heartbeat (float):     Heartbeat period in seconds, or None to not send
+            prefix    (string):    Prefix for stream names, to register several drones on one scheduler
+            demux     (ReplyDemux): Optional; sends keepalives through it, so their replies are not taken
+                                    for those of its queries, e.g. LinkMonitor probes
+        """
+
+        self.scheduler = scheduler
+        self.drone = drone
+        self.demux = demux
+
+        self._frame = ControlFrame()
+        self._setpoint = (0.5, 0.5, 0.5, 0.5)
+        self._names = []
+
+        if control is not None:
+            self.__add(prefix + 'control', control, self.__sendControl, 2)
+        if keepalive is not None:
+            self.__add(prefix + 'keepalive', keepalive, self.__sendKeepalive, 1)
+        if heartbeat is not None:
+            self.__add(prefix + 'heartbeat', heartbeat, self.__sendHeartbeat, 0)
+
+    def set(self, throttle, pitch, roll, yaw):
+        """
+        Updates the setpoint sent by the control stream. Never blocks.
+
+        Parameters: as for Drone.control()
+        """
+
+        self._setpoint = (throttle, pitch, roll, yaw)
+
+    def idle(self):
+        """
+        Sends idle commands from the next control tick. Never blocks.
+        """
+
+        self._setpoint = (0.5, 0.5, 0.5, 0.5)
+
+    def remove(self):
+        """
+        Removes this drone's streams from the scheduler.
+        """
+
+        for name in self._names:
+            self.scheduler.remove(name)
+
+        self._names = []
+
+    def __add(self, name, period, send, priority):
+        self.scheduler.add(name, period, send, priority)
+        self._names.append(name)
+
+    def __sendControl(self):
+        frame = self._frame
+        frame.set(*self._setpoint)
+        self.drone.safeSend(frame.view, paced=False)
+
+    def __sendKeepalive(self):
+        if self.demux is not None:
+            self.demux.send(0x28)
+        else:
+            self.drone.safeSend(b'\x28', paced=False)
+
+    def __sendHeartbeat(self):
+        self.drone.safeSendTcp(self.drone._generateHeartbeatCommand(), paced=False)
+
+class _Stream:
+    # A periodic stream and its statistics
+
+    def __init__(self, name, periodTicks, send, priority):
+        self.name = name
+        self.periodTicks = periodTicks
+        self.send = send
+        self.priority = priority
+        self.due = 0
+
+        self.sent = 0
+        self.errors = 0
+        self.lastError = None
+        self.lateSum = 0.0
+        self.lateMax = 0.0
+
+    def stats(self, resolution):
+        return {
+            'period': self.periodTicks * resolution,
+            'sent': self.sent,
+            'errors': self.errors,
+            'lateMean': self.lateSum / self.sent if self.sent > 0 else 0.0,
+            'lateMax': self.lateMax,
+        }
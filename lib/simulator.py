@@ -0,0 +1,414 @@
+"""
+Matt Clarke 2021.
+A local stand-in for a drone, speaking the MINI RC protocol. Useful for
+testing and benchmarking without hardware.
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import selectors
+import socket
+import threading
+import time
+
+from lib.drone import Drone
+
+# Kinds of packet recorded by the simulator
+CONTROL   = 'control'
+DRONE_ID  = 'id'
+DATE      = 'date'
+SETUP     = 'setup'
+QUERY     = 'query'
+HEARTBEAT = 'heartbeat'
+UNKNOWN   = 'unknown'
+
+HEARTBEAT_COMMAND = b'\x00\x01\x02\x03\x04\x05\x06\x07\x08\x09\x25\x25'
+
+class Simulator:
+    """
+    Accepts connections as a drone would, on UDP and TCP, and records every
+    packet recieved.
+
+    Replies are given to the `0x42` (video type) and `0x28` (firmware) queries.
+    By default, the first `0x28` from each client is answered with a stale copy
+    of the previous reply to that client, or not at all, mimicking the
+    drone-side bug that Drone.setup() works around. Control frames have their
+    checksum validated.
+
+    Optionally, a fake video stream is sent to each TCP client after its first
+    heartbeat: JPEG-delimited frames (`ffd8` ... `ffd9`) of a fixed size, at a
+    fixed rate.
+
+    Each simulator runs its own thread, so any number can be started in one
+    process. Binding to port 0 picks a free port.
+
+    Exported methods:
+    - start()
+    - stop()
+    - address()
+    - records()
+    - frames()
+    - badChecksums()
+    - heartbeats()
+    - videoStats()
+
+    Example:
+
+        sim = Simulator('127.0.0.1', 0, 0)
+        sim.start()
+
+        drone = Drone()
+        drone.connect(*sim.address())
+        drone.setup()
+
+        sim.stop()
+    """
+
+    def __init__(self, host = '127.0.0.1', udpPort = 8080, tcpPort = 8888, videoType = 'VSVGA', firmware = 'V6.1', quirk = True,
+                 videoRate = 0, videoFrameSize = 20000, clock = time.perf_counter):
+        """
+        Parameters:
+            host      (string): Address to bind to
+            udpPort   (int):    UDP port to bind to, or 0 for any
+            tcpPort   (int):    TCP port to bind to, or 0 for any
+            videoType (string): Reply to `0x42`
+            firmware  (string): Reply to `0x28`
+            quirk     (bool):   Whether to mimic the double `0x28` bug
+            videoRate (float):  Video frames per second, or 0 to not send video
+            videoFrameSize (int): Size of each video frame in bytes, including markers
+            clock     (callable): Clock used to timestamp records
+        """
+
+        self.host = host
+        self.udpPort = udpPort
+        self.tcpPort = tcpPort
+        self.videoType = videoType
+        self.firmware = firmware
+        self.quirk = quirk
+        self.videoRate = videoRate
+        self.videoFrameSize = videoFrameSize
+
+        self._clock = clock
+        self._reference = Drone()
+
+        self._udp = None
+        self._tcp = None
+        self._selector = None
+        self._thread = None
+        self._stopped = True
+
+        self._records = []
+        self._badChecksums = 0
+        self._heartbeats = 0
+
+        # Per-client state for the `0x28` quirk
+        self._lastReply = {}
+        self._firmwareQueried = set()
+
+        self._tcpClients = []
+        self._videoFrame = None
+        self._videoSent = 0
+        self._videoDropped = 0
+
+    def start(self):
+        """
+        Binds the sockets and starts serving.
+        """
+
+        self._udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._udp.bind((self.host, self.udpPort))
+        self._udp.setblocking(False)
+        self.udpPort = self._udp.getsockname()[1]
+
+        self._tcp = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._tcp.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._tcp.bind((self.host, self.tcpPort))
+        self._tcp.listen(8)
+        self._tcp.setblocking(False)
+        self.tcpPort = self._tcp.getsockname()[1]
+
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(self._udp, selectors.EVENT_READ, self.__onDatagram)
+        self._selector.register(self._tcp, selectors.EVENT_READ, self.__onAccept)
+
+        self._stopped = False
+        self._thread = threading.Thread(target=self.__run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stops serving and closes all sockets.
+        """
+
+        if self._thread is None:
+            return
+
+        self._stopped = True
+        self._thread.join()
+        self._thread = None
+
+        for key in list(self._selector.get_map().values()):
+            key.fileobj.close()
+
+        self._selector.close()
+
+    def address(self):
+        """
+        Returns:
+            A tuple of (host, udpPort, tcpPort), suitable for Drone.connect(*address)
+        """
+
+        return (self.host, self.udpPort, self.tcpPort)
+
+    def records(self, kind = None):
+        """
+        Every packet recieved so far.
+
+        Parameters:
+            kind (string): Only return records of this kind, e.g. CONTROL
+
+        Returns:
+            A list of (timestamp, kind, data) tuples, oldest first
+        """
+
+        if kind is None:
+            return list(self._records)
+
+        return [record for record in self._records if record[1] == kind]
+
+    def frames(self):
+        """
+        Returns:
+            A list of (timestamp, data) tuples for every control frame recieved
+        """
+
+        return [(record[0], record[2]) for record in self._records if record[1] == CONTROL]
+
+    def badChecksums(self):
+        """
+        Returns:
+            The number of control frames recieved with an invalid checksum
+        """
+
+        return self._badChecksums
+
+    def heartbeats(self):
+        """
+        Returns:
+            The number of TCP heartbeats recieved
+        """
+
+        return self._heartbeats
+
+    def videoStats(self):
+        """
+        Returns:
+            A dict with keys `sent` and `dropped`: video frames sent to clients, and
+            frames skipped because a client was not reading fast enough
+        """
+
+        return { 'sent': self._videoSent, 'dropped': self._videoDropped }
+
+    #############################################################################
+    # Private
+    #############################################################################
+
+    def __run(self):
+        clock = self._clock
+        nextVideo = clock()
+
+        if self.videoRate > 0:
+            # Payload avoids 0xff, so it never contains a marker
+            payload = bytes(i % 0xff for i in range(self.videoFrameSize - 4))
+            self._videoFrame = b'\xff\xd8' + payload + b'\xff\xd9'
+
+        while not self._stopped:
+            timeout = 0.05
+            if self.videoRate > 0:
+                timeout = min(timeout, max(0.0, nextVideo - clock()))
+
+            for key, mask in self._selector.select(timeout):
+                key.data(key.fileobj, mask)
+
+            if self.videoRate > 0 and clock() >= nextVideo:
+                nextVideo += 1.0 / self.videoRate
+                self.__sendVideo()
+
+    def __sendVideo(self):
+        for client in self._tcpClients:
+            if not client.streaming:
+                continue
+
+            # Like a real encoder, skip frames rather than queue without bound
+            if len(client.outgoing) > 4 * len(self._videoFrame):
+                self._videoDropped += 1
+                continue
+
+            client.write(self._videoFrame)
+            self._videoSent += 1
+
+    def __record(self, kind, data):
+        self._records.append((self._clock(), kind, bytes(data)))
+
+    def __onDatagram(self, sock, mask):
+        try:
+            data, client = sock.recvfrom(2048)
+        except OSError:
+            return
+
+        if len(data) == 11 and data[0:2] == b'\xff\x08':
+            self.__record(CONTROL, data)
+            if not self.__validChecksum(data):
+                self._badChecksums += 1
+
+        elif data == b'\x42':
+            self.__record(QUERY, data)
+            self.__reply(sock, client, self.videoType.encode('ascii') + b'\x00')
+
+        elif data == b'\x28':
+            self.__record(QUERY, data)
+
+            if self.quirk and client not in self._firmwareQueried:
+                self._firmwareQueried.add(client)
+
+                stale = self._lastReply.get(client)
+                if stale is not None:
+                    self.__reply(sock, client, stale)
+            else:
+                self.__reply(sock, client, self.firmware.encode('ascii') + b'\x00')
+
+        elif len(data) == 5 and data[0] == 0x0f:
+            self.__record(DRONE_ID, data)
+        elif data.startswith(b'date -s'):
+            self.__record(DATE, data)
+        elif data.startswith(b'\x26\xe5'):
+            self.__record(SETUP, data)
+        else:
+            self.__record(UNKNOWN, data)
+
+    def __reply(self, sock, client, data):
+        self._lastReply[client] = data
+
+        try:
+            sock.sendto(data, client)
+        except OSError:
+            pass
+
+    def __validChecksum(self, frame):
+        throttle, yaw, pitch, roll, throttleTrim, pitchTrim, rollTrim, command, endByte = frame[2:]
+        raw = self._reference._endByteCalc(throttle, yaw, pitch, roll, throttleTrim, rollTrim, pitchTrim, command)
+
+        # The app wraps modulo 256 (see the takeoff command), whereas Drone
+        # negates negative values. Accept either.
+        folded = raw
+        if folded < 0x0:
+            folded = 0x0 - folded
+        elif folded > 0xff:
+            folded = folded - 0xff - 1
+
+        return endByte == raw & 0xff or endByte == folded
+
+    def __onAccept(self, sock, mask):
+        try:
+            connection, _ = sock.accept()
+        except OSError:
+            return
+
+        connection.setblocking(False)
+
+        client = _TcpClient(self, connection)
+        self._tcpClients.append(client)
+        self._selector.register(connection, selectors.EVENT_READ, client.onEvent)
+
+    def _onHeartbeat(self, client, data):
+        self._heartbeats += 1
+        self.__record(HEARTBEAT, data)
+
+        # Drone.setup() reads 20 bytes after its heartbeat
+        client.write(bytes(20))
+        client.streaming = True
+
+    def _onTcpUnknown(self, data):
+        self.__record(UNKNOWN, data)
+
+    def _onTcpWritable(self, client, writable):
+        events = selectors.EVENT_READ | selectors.EVENT_WRITE if writable else selectors.EVENT_READ
+        self._selector.modify(client.connection, events, client.onEvent)
+
+    def _onTcpClosed(self, client):
+        self._tcpClients.remove(client)
+        self._selector.unregister(client.connection)
+        client.connection.close()
+
+class _TcpClient:
+    # Splits a TCP byte stream into heartbeats, and buffers anything sent back
+
+    def __init__(self, simulator, connection):
+        self.simulator = simulator
+        self.connection = connection
+        self.pending = b''
+        self.outgoing = bytearray()
+        self.streaming = False
+
+    def onEvent(self, connection, mask):
+        if mask & selectors.EVENT_WRITE:
+            self.flush()
+
+        if mask & selectors.EVENT_READ:
+            self.onReadable()
+
+    def write(self, data):
+        waiting = len(self.outgoing) > 0
+
+        self.outgoing += data
+        self.flush()
+
+        if not waiting and len(self.outgoing) > 0:
+            self.simulator._onTcpWritable(self, True)
+
+    def flush(self):
+        if not self.outgoing:
+            return
+
+        try:
+            sent = self.connection.send(self.outgoing)
+        except BlockingIOError:
+            return
+        except OSError:
+            return
+
+        del self.outgoing[:sent]
+
+        if not self.outgoing:
+            self.simulator._onTcpWritable(self, False)
+
+    def onReadable(self):
+        try:
+            data = self.connection.recv(2048)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b''
+
+        if not data:
+            self.simulator._onTcpClosed(self)
+            return
+
+        self.pending += data
+
+        while len(self.pending) >= len(HEARTBEAT_COMMAND):
+            if self.pending.startswith(HEARTBEAT_COMMAND):
+                self.simulator._onHeartbeat(self, HEARTBEAT_COMMAND)
+                self.pending = self.pending[len(HEARTBEAT_COMMAND):]
+            else:
+                self.simulator._onTcpUnknown(self.pending)
+                self.pending = b''
@@ -0,0 +1,194 @@
+"""
+Matt Clarke 2021.
+Background streaming of control commands, so that slow work in the
+application cannot delay sending.
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import threading
+
+from lib.pacer import Pacer
+
+class ControlStream:
+    """
+    Owns a sender thread that transmits the most recent setpoint to a drone at
+    a fixed rate.
+
+    The application updates the setpoint with set(), idle() or takeoff(). These
+    only swap a single reference, so never block and take no lock; the sender
+    picks up whichever setpoint is current at its next tick.
+
+    Exported methods:
+    - start()
+    - stop()
+    - set(throttle, pitch, roll, yaw)
+    - idle()
+    - takeoff()
+    - setRate(rate)
+    - setSendOnChange(floor)
+    - suppressed()
+    - running()
+    - error()
+
+    Example:
+
+        stream = ControlStream(drone)
+        stream.start()
+
+        while flying:
+            stream.set(throttle, pitch, roll, yaw)
+            doSlowWork()
+
+        stream.stop()
+
+    Note: while started, the stream owns the drone's pacer. Do not send from
+    other threads at the same time.
+    """
+
+    def __init__(self, drone, rate = 100, spin = 0.0):
+        """
+        Parameters:
+            drone (Drone): A drone that has already been connected and setup
+            rate  (float): Send rate in Hz
+            spin  (float): See Pacer
+        """
+
+        self.drone = drone
+        self.pacer = Pacer(rate, spin)
+
+        self._setpoint = (drone.idle, ())
+
+        self._thread = None
+        self._stopped = True
+        self._error = None
+        self._previousPacer = None
+
+    def start(self):
+        """
+        Starts the sender thread. The initial setpoint is idle.
+        """
+
+        if self._thread is not None:
+            return
+
+        self._stopped = False
+        self._error = None
+
+        self._previousPacer = self.drone.pacer
+        self.pacer.reset()
+        self.drone.pacer = self.pacer
+
+        self._thread = threading.Thread(target=self.__run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stops the sender thread, waiting for any in-flight send to complete.
+        """
+
+        if self._thread is None:
+            return
+
+        self._stopped = True
+        self._thread.join()
+        self._thread = None
+
+        self.drone.pacer = self._previousPacer
+
+    def set(self, throttle, pitch, roll, yaw):
+        """
+        Updates the setpoint sent at each tick. Never blocks.
+
+        Parameters: as for Drone.control()
+        """
+
+        self._setpoint = (self.drone.control, (throttle, pitch, roll, yaw))
+
+    def idle(self):
+        """
+        Sends idle commands from the next tick. Never blocks.
+        """
+
+        self._setpoint = (self.drone.idle, ())
+
+    def takeoff(self):
+        """
+        Sends takeoff commands from the next tick, until the setpoint is next
+        changed. Never blocks.
+        """
+
+        self._setpoint = (self.drone.takeoff, ())
+
+    def setRate(self, rate):
+        """
+        Changes the send rate, from the next tick. Never blocks.
+
+        Parameters:
+            rate (float): Send rate in Hz
+        """
+
+        if rate <= 0:
+            raise ValueError('rate must be positive')
+
+        self.pacer.period = 1.0 / rate
+
+    def setSendOnChange(self, floor):
+        """
+        Enables or disables send-on-change, by setting the drone's
+        `keepaliveFloor`. When enabled, a tick whose frame is unchanged since
+        the last send is skipped, unless `floor` seconds have passed since that
+        send.
+
+        Parameters:
+            floor (float): Longest gap between sends in seconds, or None to send every tick
+        """
+
+        self.drone.keepaliveFloor = floor
+
+    def suppressed(self):
+        """
+        Returns:
+            The number of frames the drone has skipped with send-on-change
+        """
+
+        return self.drone.framesSuppressed
+
+    def running(self):
+        """
+        Returns:
+            `True` if the sender thread is running, `False` if stopped or failed
+        """
+
+        return self._thread is not None and self._thread.is_alive()
+
+    def error(self):
+        """
+        Returns:
+            The exception that stopped the sender thread, or None
+        """
+
+        return self._error
+
+    #############################################################################
+    # Private
+    #############################################################################
+
+    def __run(self):
+        while not self._stopped:
+            send, args = self._setpoint
+
+            try:
+                send(*args)
+            except Exception as e:
+                self._error = e
+                return
@@ -0,0 +1,409 @@
+"""
+Matt Clarke 2021.
+Keeps a drone under control across link loss, reconnecting in the background.
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import select
+import threading
+import time
+
+from lib.drone import ControlFrame
+from lib.handshake import handshake
+from lib.pacer import Pacer
+
+# States reported by Supervisor.state()
+STOPPED      = 'stopped'
+STREAMING    = 'streaming'
+PROBING      = 'probing'
+RECONNECTING = 'reconnecting'
+
+class Supervisor:
+    """
+    Streams the latest setpoint to a drone from a background thread, and
+    recovers the link when it is lost.
+
+    Each tick sends the setpoint, and at their own periods a `0x28` keepalive
+    and the TCP heartbeat. The drone answers every keepalive, so the link is
+    considered lost once a send fails, or no reply has been seen for
+    `lossTimeout` seconds.
+
+    Recovery is attempted in order of cost:
+    1. Keep streaming on the same sockets for up to `probeTimeout`. If replies
+       resume, so does control, with nothing redone.
+    2. Recreate the sockets and query the firmware. If the drone answers, it is
+       still set up, so streaming resumes without a handshake.
+    3. A full handshake, as lib.handshake.handshake().
+
+    Steps 2 and 3 repeat until the drone is back or the supervisor is stopped.
+    The setpoint can be changed throughout, and the latest one is sent as soon
+    as the link is back.
+
+    If the drone has a `metrics` attribute, each outage (from the last reply
+    before the loss until the link is back) and each reconnect (from detecting
+    the loss until the link is back) is recorded with Metrics.event().
+
+    Exported methods:
+    - start()
+    - stop()
+    - set(throttle, pitch, roll, yaw)
+    - idle()
+    - takeoff()
+    - state()
+    - stats()
+
+    Example:
+
+        drone = Drone()
+        drone.connect()
+        drone.setup()
+
+        supervisor = Supervisor(drone)
+        supervisor.start()
+
+        while flying:
+            supervisor.set(throttle, pitch, roll, yaw)
+
+    Note: while started, the supervisor reads the drone's UDP replies, and
+    reads and discards everything on TCP, including any video. Do not use it
+    alongside a ReplyDemux, ControlStream or VideoReceiver.
+    """
+
+    def __init__(self, drone, ip = '192.168.1.1', udpPort = 8080, tcpPort = 8888, rate = 100, keepalive = 0.01, heartbeat = 0.1,
+                 lossTimeout = 0.25, probeTimeout = 0.25, backoff = 0.1, spin = 0.0, clock = time.perf_counter, sleep = time.sleep):
+        """
+        Parameters:
+            drone        (Drone):  A drone that has already been connected and setup
+            ip           (string): IP address of the drone, used to reconnect
+            udpPort      (int):    UDP port of the drone
+            tcpPort      (int):    TCP port of the drone
+            rate         (float):  Setpoint send rate in Hz
+            keepalive    (float):  Seconds between `0x28` keepalives; rounded to whole ticks
+            heartbeat    (float):  Seconds between TCP heartbeats, or None to not send them
+            lossTimeout  (float):  Seconds without a reply before the link is considered lost
+            probeTimeout (float):  Seconds to wait for the drone to answer during each recovery step
+            backoff      (float):  Seconds to wait between failed reconnect attempts
+            spin         (float):  See Pacer
+            clock        (callable): Monotonic clock returning seconds
+            sleep        (callable): Sleep function taking seconds
+        """
+
+        self.drone = drone
+        self.ip = ip
+        self.udpPort = udpPort
+        self.tcpPort = tcpPort
+        self.lossTimeout = lossTimeout
+        self.probeTimeout = probeTimeout
+        self.backoff = backoff
+
+        self._pacer = Pacer(rate, spin, clock=clock, sleep=sleep)
+        self._clock = clock
+        self._sleep = sleep
+
+        self._keepaliveTicks = max(1, int(round(keepalive * rate)))
+        self._heartbeatTicks = None if heartbeat is None else max(1, int(round(heartbeat * rate)))
+
+        self._frame = ControlFrame()
+        self._takeoff = drone._generateTakeoffCommand()
+        self._heartbeat = drone._generateHeartbeatCommand()
+        self._buffer = bytearray(64)
+
+        # TCP carries heartbeat replies and possibly video, all unused here
+        self._tcpBuffer = bytearray(4096)
+
+        # None means takeoff, otherwise (throttle, pitch, roll, yaw)
+        self._setpoint = (0.5, 0.5, 0.5, 0.5)
+
+        self._thread = None
+        self._stopped = True
+        self._state = STOPPED
+        self._timeout = None
+        self._tcpTimeout = None
+
+        self._lastReply = 0.0
+        self._outages = 0
+        self._reconnects = 0
+        self._handshakes = 0
+        self._lastOutage = None
+        self._lastReconnect = None
+        self._lastError = None
+
+    def start(self):
+        """
+        Starts the supervisor thread. The initial setpoint is idle.
+        """
+
+        if self._thread is not None:
+            return
+
+        self._stopped = False
+        self._state = STREAMING
+
+        self._timeout = self.drone.udpsocket.gettimeout()
+        self._tcpTimeout = self.drone.tcpsocket.gettimeout()
+        self.__nonBlocking()
+
+        self._thread = threading.Thread(target=self.__run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stops the supervisor thread, including any reconnect in progress once
+        its current step completes.
+        """
+
+        if self._thread is None:
+            return
+
+        self._stopped = True
+        self._thread.join()
+        self._thread = None
+        self._state = STOPPED
+
+        try:
+            self.drone.udpsocket.settimeout(self._timeout)
+            self.drone.tcpsocket.settimeout(self._tcpTimeout)
+        except OSError:
+            pass
+
+    def set(self, throttle, pitch, roll, yaw):
+        """
+        Updates the setpoint. Never blocks, even while reconnecting.
+
+        Parameters: as for Drone.control()
+        """
+
+        self._setpoint = (throttle, pitch, roll, yaw)
+
+    def idle(self):
+        """
+        Sends idle commands from the next tick. Never blocks.
+        """
+
+        self._setpoint = (0.5, 0.5, 0.5, 0.5)
+
+    def takeoff(self):
+        """
+        Sends takeoff commands from the next tick, until the setpoint is next
+        changed. Never blocks.
+        """
+
+        self._setpoint = None
+
+    def state(self):
+        """
+        Returns:
+            STOPPED, STREAMING, PROBING (link lost, waiting on the same sockets)
+            or RECONNECTING
+        """
+
+        return self._state
+
+    def stats(self):
+        """
+        Returns:
+            A dict with keys:
+            - `outages`: number of times the link was lost
+            - `reconnects`: number of outages that needed new sockets
+            - `handshakes`: number of full handshakes attempted
+            - `lastOutage`: seconds without replies during the last outage, or None
+            - `lastReconnect`: seconds from detecting the last outage to resuming, or None
+            - `lastError`: string describing the last send or reconnect error, or None
+        """
+
+        return {
+            'outages': self._outages,
+            'reconnects': self._reconnects,
+            'handshakes': self._handshakes,
+            'lastOutage': self._lastOutage,
+            'lastReconnect': self._lastReconnect,
+            'lastError': self._lastError,
+        }
+
+    #############################################################################
+    # Private
+    #############################################################################
+
+    def __run(self):
+        clock = self._clock
+        pacer = self._pacer
+        pacer.reset()
+
+        self._lastReply = clock()
+        detected = 0.0
+        probeDeadline = 0.0
+        tick = 0
+
+        while not self._stopped:
+            pacer.wait()
+            now = clock()
+
+            try:
+                self.__sendTick(tick)
+                replied = self.__drain()
+                self.__drainTcp()
+            except OSError as e:
+                self._lastError = str(e)
+                replied = False
+
+                if self._state == STREAMING:
+                    detected = self.__lost(now)
+
+                # The sockets are broken, so waiting on them is pointless
+                self.__reconnect(detected)
+                continue
+            finally:
+                tick += 1
+
+            if replied:
+                self._lastReply = now
+
+                if self._state == PROBING:
+                    self.__resumed(detected, reconnected=False)
+
+            elif self._state == STREAMING and now - self._lastReply > self.lossTimeout:
+                detected = self.__lost(now)
+                probeDeadline = now + self.probeTimeout
+
+            elif self._state == PROBING and now > probeDeadline:
+                self.__reconnect(detected)
+
+    def __sendTick(self, tick):
+        drone = self.drone
+        setpoint = self._setpoint
+
+        if setpoint is None:
+            drone.safeSend(self._takeoff, paced=False)
+        else:
+            self._frame.set(*setpoint)
+            drone.safeSend(self._frame.view, paced=False)
+
+        if tick % self._keepaliveTicks == 0:
+            drone.safeSend(b'\x28', paced=False)
+
+        if self._heartbeatTicks is not None and tick % self._heartbeatTicks == 0:
+            drone.safeSendTcp(self._heartbeat, paced=False)
+
+    def __drain(self):
+        # Reads every waiting reply, returning whether there were any
+        sock = self.drone.udpsocket
+        replied = False
+
+        while True:
+            try:
+                sock.recv_into(self._buffer)
+            except BlockingIOError:
+                return replied
+
+            replied = True
+
+    def __drainTcp(self):
+        # Discards everything waiting, so the drone never stalls on a full
+        # recieve buffer over a long flight
+        sock = self.drone.tcpsocket
+
+        while True:
+            try:
+                size = sock.recv_into(self._tcpBuffer)
+            except BlockingIOError:
+                return
+
+            if size == 0:
+                raise ConnectionResetError('TCP connection closed by the drone')
+
+    def __nonBlocking(self):
+        self.drone.udpsocket.setblocking(False)
+        self.drone.tcpsocket.setblocking(False)
+
+    def __lost(self, now):
+        self._state = PROBING
+        self._outages += 1
+
+        return now
+
+    def __resumed(self, detected, reconnected):
+        now = self._clock()
+
+        self._lastOutage = now - self._lastReply
+        self._lastReply = now
+        self._state = STREAMING
+        self._pacer.reset()
+
+        metrics = self.drone.metrics
+        if metrics is not None:
+            metrics.event('outage', self._lastOutage)
+
+        if reconnected:
+            self._lastReconnect = now - detected
+
+            if metrics is not None:
+                metrics.event('reconnect', self._lastReconnect)
+
+    def __reconnect(self, detected):
+        self._state = RECONNECTING
+        self._reconnects += 1
+
+        drone = self.drone
+
+        while not self._stopped:
+            self.__close()
+
+            try:
+                drone.connect(self.ip, self.udpPort, self.tcpPort, timeout=self.probeTimeout)
+                self.__nonBlocking()
+
+                if self.__probe():
+                    self.__resumed(detected, reconnected=True)
+                    return
+            except OSError as e:
+                self._lastError = str(e)
+
+            self.__close()
+            self._handshakes += 1
+
+            result = handshake(drone, self.ip, self.udpPort, self.tcpPort, timeout=self.probeTimeout, clock=self._clock)
+            if result.ok:
+                self.__nonBlocking()
+                self.__resumed(detected, reconnected=True)
+                return
+
+            self._lastError = result.error
+            self._sleep(self.backoff)
+
+    def __probe(self):
+        # Queries the firmware until the drone answers, or probeTimeout passes.
+        # The first `0x28` on a new socket may go unanswered, so it is resent.
+        sock = self.drone.udpsocket
+        clock = self._clock
+        deadline = clock() + self.probeTimeout
+
+        while not self._stopped:
+            remaining = deadline - clock()
+            if remaining <= 0:
+                return False
+
+            sock.send(b'\x28')
+
+            readable, _, _ = select.select([sock], [], [], min(remaining, 0.02))
+            if readable and self.__drain():
+                return True
+
+        return False
+
+    def __close(self):
+        for sock in (self.drone.udpsocket, self.drone.tcpsocket):
+            if sock is not None:
+                try:
+                    sock.close()
+                except OSError:
+                    pass
@@ -0,0 +1,165 @@
+"""
+Matt Clarke 2021.
+Correctness checks for the library, run against a local Simulator. Where
+benchmarks measure how fast things are, these check they are still right.
+
+Usage:
+    python -m lib.drone verify
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import struct
+import sys
+
+from lib.drone import Drone
+from lib.handshake import classifyReply, handshake, FIRMWARE, VIDEO_TYPE
+from lib.simulator import Simulator
+from lib.video import FRAME_SIZES
+
+def verifyClassifyReply():
+    """
+    Checks every known video type and some firmware versions are told apart.
+
+    Returns:
+        A list of failure descriptions, empty if all passed
+    """
+
+    cases = [(videoType.encode('ascii') + b'\x00', VIDEO_TYPE) for videoType in FRAME_SIZES]
+    cases += [
+        (b'V6.1\x00', FIRMWARE),
+        (b'V10.12', FIRMWARE),
+        (b'V6.1', FIRMWARE),
+        (b'V', None),
+        (b'V6.', None),
+        (b'\x00\x00', None),
+        (b'hello', None),
+    ]
+
+    return ['classifyReply({!r}) == {}, expected {}'.format(data, classifyReply(data), expected)
+            for data, expected in cases if classifyReply(data) != expected]
+
+def verifyHandshake():
+    """
+    Runs handshake() against a Simulator for every known video type.
+
+    Returns:
+        A list of failure descriptions, empty if all passed
+    """
+
+    failures = []
+
+    for videoType in FRAME_SIZES:
+        sim = Simulator('127.0.0.1', 0, 0, videoType=videoType)
+        sim.start()
+
+        drone = Drone()
+        result = handshake(drone, *sim.address())
+
+        if not result.ok:
+            failures.append('handshake with {}: {}'.format(videoType, result.error))
+        elif result.videoType.rstrip('\x00') != videoType or result.firmware.rstrip('\x00') != sim.firmware:
+            failures.append('handshake with {}: got {!r}, {!r}'.format(videoType, result.videoType, result.firmware))
+
+        if result.ok:
+            drone.udpsocket.close()
+            drone.tcpsocket.close()
+
+        sim.stop()
+
+    return failures
+
+def verifyBatchEncoding(count = 20000, seed = 1):
+    """
+    Checks encodeControlFrames() is byte-identical to encoding each frame
+    with Drone, across random setpoints (including out of range values), and
+    across mixes of scalar and per-frame arguments. Skipped without NumPy.
+
+    Returns:
+        A list of failure descriptions, empty if all passed
+    """
+
+    try:
+        import numpy as np
+        from lib.batch import encodeControlFrames, FRAME_SIZE
+    except ImportError:
+        return []
+
+    drone = Drone()
+    generator = np.random.default_rng(seed)
+
+    setpoints = generator.uniform(-0.2, 1.2, size=(4, count))
+    # Exact boundaries too, where the clamping changes
+    setpoints[:, :8] = [[0.0, 0.5, 1.0, 0x7e / 0x80, 0x7d / 0x80, 0.999, -0.0, 0.25]] * 4
+
+    # Flags whose checksums always fit in a byte; those that don't are checked below
+    command = generator.choice([0x00, 0x01, 0x02, 0x04], size=count)
+    trims = generator.integers(0x00, 0x21, size=(3, count))
+
+    cases = {
+        'arrays': (setpoints, (command, trims[0], trims[1], trims[2])),
+        'scalar flags and trims': (setpoints, (0x01, 0x10, 0x10, 0x10)),
+        'scalar setpoint, array flags': ((0.7, 0.3, 0.6, 0.5), (command, 0x10, trims[1], 0x10)),
+    }
+
+    failures = []
+
+    for name, (values, extra) in cases.items():
+        frames = encodeControlFrames(*values, *extra)
+
+        rows = np.broadcast_arrays(*(np.asarray(value).ravel() for value in tuple(values) + tuple(extra)))
+        rows = [row.tolist() for row in rows]
+
+        if len(frames) != len(rows[0]) * FRAME_SIZE:
+            failures.append('{}: {} bytes for {} frames'.format(name, len(frames), len(rows[0])))
+            continue
+
+        for i in range(len(rows[0])):
+            throttle, pitch, roll, yaw, flags, throttleTrim, rollTrim, pitchTrim = (row[i] for row in rows)
+            expected = drone._generateControlCommand(throttle, pitch, roll, yaw, flags, throttleTrim, rollTrim, pitchTrim)
+
+            if frames[i * FRAME_SIZE:(i + 1) * FRAME_SIZE] != expected:
+                failures.append('{}: frame {} differs for {}'.format(name, i, (throttle, pitch, roll, yaw, flags, throttleTrim, rollTrim, pitchTrim)))
+                break
+
+    # Both paths must refuse a frame whose checksum does not fit in a byte
+    overflow = (1.0, 1.0, 1.0, 1.0, 0x40, 0x20, 0x20, 0x20)
+    for encode in (lambda: drone._generateControlCommand(*overflow), lambda: encodeControlFrames(*overflow)):
+        try:
+            encode()
+            failures.append('checksum overflow: encoded {}'.format(overflow))
+        except (ValueError, struct.error):
+            pass
+
+    return failures
+
+CHECKS = {
+    'classifyReply': verifyClassifyReply,
+    'handshake': verifyHandshake,
+    'batchEncoding': verifyBatchEncoding,
+}
+
+def main(argv):
+    failed = 0
+
+    for name, check in CHECKS.items():
+        failures = check()
+        failed += len(failures)
+
+        print('{:<16} {}'.format(name, 'ok' if not failures else 'FAILED'))
+        for failure in failures:
+            print('    ' + failure)
+
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
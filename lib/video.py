@@ -0,0 +1,329 @@
+"""
+Matt Clarke 2021.
+Recieves the video stream from the drone's TCP socket.
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from collections import deque
+import threading
+import time
+
+# Largest expected frame for each video type reported by `0x42`
+FRAME_SIZES = {
+    'VVGA':  128 * 1024,
+    'VSVGA': 256 * 1024,
+    'V720P': 512 * 1024,
+}
+
+DEFAULT_FRAME_SIZE = 256 * 1024
+
+JPEG_START = b'\xff\xd8'
+JPEG_END   = b'\xff\xd9'
+
+class VideoReceiver:
+    """
+    Reads the video stream from TCP 8888 on its own thread, and hands complete
+    frames to a consumer without copying them.
+
+    Frames are delimited by JPEG start (`ffd8`) and end (`ffd9`) markers; the
+    drones seen so far stream MJPEG, with the resolution given by videoType().
+    Anything between frames (e.g. heartbeat replies) is skipped.
+
+    The stream is read with recv_into directly into a ring of preallocated
+    slots, each large enough for one frame. A completed frame stays in its slot
+    until the consumer releases it. If the consumer falls behind and every slot
+    is full, the oldest frame it has not yet taken is dropped, so the receiver
+    never stalls and the socket is always drained.
+
+    Reading happens on a separate socket and thread to control commands, and
+    the thread spends its time blocked in recv_into, so it does not hold up
+    the control path.
+
+    Exported methods:
+    - start()
+    - stop()
+    - get(timeout)
+    - release(frame)
+    - stats()
+
+    Example:
+
+        video = VideoReceiver(drone)
+        video.start()
+
+        frame = video.get()
+        decode(frame.data)
+        video.release(frame)
+    """
+
+    def __init__(self, drone, slots = 4, frameSize = None, clock = time.perf_counter):
+        """
+        Parameters:
+            drone     (Drone):    A drone that has already been connected and setup
+            slots     (int):      Number of frames held at once, including any held by the consumer
+            frameSize (int):      Largest frame in bytes. Defaults to a size suited to drone.videoType().
+            clock     (callable): Monotonic clock returning seconds
+        """
+
+        if slots < 2:
+            raise ValueError('at least 2 slots are needed')
+
+        if frameSize is None:
+            videoType = (drone.videoType() or '').rstrip('\x00')
+            frameSize = FRAME_SIZES.get(videoType, DEFAULT_FRAME_SIZE)
+
+        self.drone = drone
+        self.frameSize = frameSize
+
+        self._clock = clock
+        self._buffers = [bytearray(frameSize) for _ in range(slots)]
+        self._views = [memoryview(buffer) for buffer in self._buffers]
+
+        # Slots are free, being written, ready for the consumer, or held by it
+        self._free = deque(range(1, slots))
+        self._ready = deque()
+        self._condition = threading.Condition()
+
+        self._thread = None
+        self._stopped = True
+        self._error = None
+
+        self._bytes = 0
+        self._frames = 0
+        self._dropped = 0
+
+        # Bounds of the run that rates are computed over
+        self._started = None
+        self._finished = None
+
+    def start(self):
+        """
+        Starts the receiver thread.
+        """
+
+        if self._thread is not None:
+            return
+
+        self._stopped = False
+        self._started = self._clock()
+        self._finished = None
+
+        self._thread = threading.Thread(target=self.__run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stops the receiver thread. The socket is shut down for reading to
+        unblock it, so the stream cannot be resumed afterwards.
+        """
+
+        if self._thread is None:
+            return
+
+        self._stopped = True
+
+        try:
+            self.drone.tcpsocket.shutdown(0) # SHUT_RD
+        except OSError:
+            pass
+
+        self._thread.join()
+        self._thread = None
+
+        with self._condition:
+            self._condition.notify_all()
+
+    def get(self, timeout = None):
+        """
+        Waits for the oldest frame the consumer has not yet taken.
+
+        The returned frame must be passed to release() once finished with.
+
+        Parameters:
+            timeout (float): Seconds to wait, or None to wait forever
+
+        Returns:
+            A VideoFrame, or None on timeout or once stopped
+        """
+
+        with self._condition:
+            if not self._ready and not self._stopped:
+                self._condition.wait(timeout)
+
+            if not self._ready:
+                return None
+
+            slot, start, end, timestamp = self._ready.popleft()
+
+        return VideoFrame(slot, self._views[slot][start:end], timestamp)
+
+    def release(self, frame):
+        """
+        Returns a frame's slot to the receiver. `frame.data` must not be used
+        afterwards.
+        """
+
+        frame.data.release()
+
+        with self._condition:
+            self._free.append(frame.slot)
+
+    def stats(self):
+        """
+        Returns:
+            A dict with keys:
+            - `bytesPerSecond`: stream bytes recieved per second, from start() until now, or
+              until the stream ended or stop() was called
+            - `framesPerSecond`: complete frames per second, over the same time
+            - `bytes`: total bytes recieved
+            - `frames`: total complete frames
+            - `dropped`: frames dropped because the consumer fell behind, or that were too large
+        """
+
+        elapsed = 0.0
+        if self._started is not None:
+            finished = self._finished
+            elapsed = (finished if finished is not None else self._clock()) - self._started
+
+        return {
+            'bytesPerSecond': self._bytes / elapsed if elapsed > 0 else 0.0,
+            'framesPerSecond': self._frames / elapsed if elapsed > 0 else 0.0,
+            'bytes': self._bytes,
+            'frames': self._frames,
+            'dropped': self._dropped,
+        }
+
+    def error(self):
+        """
+        Returns:
+            The exception that stopped the receiver thread, or None
+        """
+
+        return self._error
+
+    #############################################################################
+    # Private
+    #############################################################################
+
+    def __run(self):
+        sock = self.drone.tcpsocket
+        clock = self._clock
+
+        slot = 0
+        buffer = self._buffers[slot]
+        view = self._views[slot]
+
+        filled = 0
+        start = -1   # offset of the current frame's start marker, if seen
+        scanned = 0  # offset searched up to so far
+
+        while not self._stopped:
+            if filled == self.frameSize:
+                # Nothing found, or a frame too large for a slot
+                if start >= 0:
+                    self._dropped += 1
+
+                filled = 0
+                start = -1
+                scanned = 0
+
+            try:
+                size = sock.recv_into(view[filled:])
+            except OSError as e:
+                if not self._stopped:
+                    self._error = e
+                break
+
+            if size == 0:
+                break
+
+            filled += size
+            self._bytes += size
+
+            while True:
+                if start < 0:
+                    start = buffer.find(JPEG_START, max(0, scanned - 1), filled)
+
+                    if start < 0:
+                        # Keep only a possible half-marker at the end
+                        if filled > 0 and buffer[filled - 1] == 0xff:
+                            buffer[0] = 0xff
+                            filled = 1
+                        else:
+                            filled = 0
+
+                        scanned = filled
+                        break
+
+                    scanned = start + 2
+
+                end = buffer.find(JPEG_END, max(start + 2, scanned - 1), filled)
+                if end < 0:
+                    scanned = filled
+                    break
+
+                end += 2
+                self._frames += 1
+
+                nextSlot = self.__publish(slot, start, end, clock())
+
+                # Carry anything after the frame into the next slot. This is
+                # normally nothing, or the start of the next frame.
+                remaining = filled - end
+                nextBuffer = self._buffers[nextSlot]
+                nextBuffer[0:remaining] = buffer[end:filled]
+
+                slot = nextSlot
+                buffer = nextBuffer
+                view = self._views[slot]
+
+                filled = remaining
+                start = -1
+                scanned = 0
+
+        with self._condition:
+            self._stopped = True
+            self._finished = clock()
+            self._condition.notify_all()
+
+    def __publish(self, slot, start, end, timestamp):
+        # Hands a completed slot to the consumer, and returns the next slot
+        # to write into
+        with self._condition:
+            self._ready.append((slot, start, end, timestamp))
+
+            if self._free:
+                nextSlot = self._free.popleft()
+            else:
+                # Consumer is behind; drop its oldest untaken frame
+                nextSlot = self._ready.popleft()[0]
+                self._dropped += 1
+
+            self._condition.notify()
+
+        return nextSlot
+
+class VideoFrame:
+    """
+    A complete frame from VideoReceiver.get().
+
+    Attributes:
+        slot      (int):        Slot holding the frame; used by release()
+        data      (memoryview): The frame, including its JPEG markers
+        timestamp (float):      When the frame completed, on the receiver's clock
+    """
+
+    def __init__(self, slot, data, timestamp):
+        self.slot = slot
+        self.data = data
+        self.timestamp = timestamp
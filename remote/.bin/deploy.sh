@@ -1,4 +1,4 @@
 #!/bin/bash
 
 .bin/deps.sh $1
-.bin/pyboard.py -d $1 -f cp main.py :main.py
\ No newline at end of file
+.bin/sync.py $1 main.py
@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+"""
+Matt Clarke 2021.
+Incremental deployment to the board, on top of pyboard.py. Files are hashed
+with sha256 on the host and on the board, and only those that differ are
+uploaded.
+
+A manifest of the hashes last deployed is kept on the board. Files are
+grouped by their directory on the host; a directory whose files all match the
+manifest is skipped without touching the board. Only in a changed directory
+are the files hashed on the board itself, so a file changed behind the
+manifest's back (e.g. by a plain `pyboard.py cp`) is still caught there. Pass
+--full to hash every file on the board, ignoring the manifest.
+
+Usage:
+    .bin/sync.py /dev/<tty of your board> main.py throttle.py ../lib/drone.py:drone.py
+
+Each file is given as `local:device`, or just `local` to use the same name
+on the board.
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import sys
+
+from pyboard import Pyboard, PyboardError
+
+MANIFEST = '.sync.json'
+
+# Run on the board. Prints one line per path: its sha256 in hex, or '-' if
+# it can't be read.
+DEVICE_HASH = """
+try:
+    import uhashlib as hashlib
+    import ubinascii as binascii
+except ImportError:
+    import hashlib
+    import binascii
+def _syncHash(path):
+    try:
+        f = open(path, 'rb')
+    except OSError:
+        print('-')
+        return
+    h = hashlib.sha256()
+    b = bytearray(512)
+    m = memoryview(b)
+    while True:
+        n = f.readinto(b)
+        if not n:
+            break
+        h.update(m[:n])
+    f.close()
+    print(binascii.hexlify(h.digest()).decode())
+"""
+
+def hashFile(path):
+    """
+    Returns:
+        The sha256 of a file on the host, in hex
+    """
+
+    digest = hashlib.sha256()
+
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 16), b''):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+def parseFiles(specs):
+    """
+    Parameters:
+        specs (list): `local:device` or `local` strings
+
+    Returns:
+        A list of (local path, device path) tuples
+    """
+
+    files = []
+
+    for spec in specs:
+        local, separator, device = spec.partition(':')
+        files.append((local, device if separator else os.path.basename(local)))
+
+    return files
+
+class Sync:
+    """
+    Uploads files to a board, skipping any it already has.
+
+    Exported methods:
+    - run(files, full = False)
+
+    Example:
+
+        board = Pyboard('/dev/ttyUSB0')
+        board.enter_raw_repl()
+
+        result = Sync(board).run([('main.py', 'main.py'), ('../lib/drone.py', 'drone.py')])
+        print(result['saved'])
+    """
+
+    def __init__(self, board, chunkSize = 256):
+        """
+        Parameters:
+            board     (Pyboard): A board already in the raw REPL
+            chunkSize (int):     Bytes sent to the board per command when uploading
+        """
+
+        self.board = board
+        self.chunkSize = chunkSize
+
+    def run(self, files, full = False):
+        """
+        Parameters:
+            files (list): (local path, device path) tuples
+            full  (bool): Hash every file on the board, rather than trusting the manifest
+
+        Returns:
+            A dict with keys:
+            - `uploaded`: device paths uploaded
+            - `skipped`: device paths already up to date
+            - `skippedDirectories`: host directories skipped using the manifest alone
+            - `bytes`: total size of all files
+            - `sent`: bytes uploaded
+            - `saved`: bytes not uploaded
+        """
+
+        manifest = {} if full else self.__readManifest()
+
+        hashes = {}
+        sizes = {}
+        for local, device in files:
+            hashes[device] = hashFile(local)
+            sizes[device] = os.path.getsize(local)
+
+        # Group by host directory, keeping the order given
+        directories = {}
+        for local, device in files:
+            directories.setdefault(os.path.dirname(os.path.abspath(local)), []).append((local, device))
+
+        uploaded = []
+        skipped = []
+        skippedDirectories = []
+
+        for directory, group in directories.items():
+            if all(manifest.get(device) == hashes[device] for _, device in group):
+                skippedDirectories.append(directory)
+                skipped.extend(device for _, device in group)
+                continue
+
+            onBoard = self.__hashOnBoard([device for _, device in group])
+
+            for local, device in group:
+                if onBoard.get(device) == hashes[device]:
+                    skipped.append(device)
+                else:
+                    self.board.fs_put(local, device, chunk_size=self.chunkSize)
+                    uploaded.append(device)
+
+                manifest[device] = hashes[device]
+
+        self.__writeManifest(manifest)
+
+        total = sum(sizes.values())
+        sent = sum(sizes[device] for device in uploaded)
+
+        return {
+            'uploaded': uploaded,
+            'skipped': skipped,
+            'skippedDirectories': skippedDirectories,
+            'bytes': total,
+            'sent': sent,
+            'saved': total - sent,
+        }
+
+    #############################################################################
+    # Private
+    #############################################################################
+
+    def __readManifest(self):
+        output = self.board.exec_(
+            "try:\n with open('%s') as f: print(f.read())\nexcept OSError:\n print('{}')" % MANIFEST)
+
+        try:
+            manifest = json.loads(output.decode('utf-8'))
+        except ValueError:
+            # Corrupt, e.g. from an interrupted write; hash everything instead
+            return {}
+
+        return manifest if isinstance(manifest, dict) else {}
+
+    def __writeManifest(self, manifest):
+        text = json.dumps(manifest, sort_keys=True)
+        self.board.exec_("with open('%s', 'w') as f: f.write(%r)" % (MANIFEST, text))
+
+    def __hashOnBoard(self, paths):
+        self.board.exec_(DEVICE_HASH)
+
+        output = self.board.exec_(''.join('_syncHash(%r)\n' % path for path in paths))
+        lines = output.decode('ascii').split()
+
+        return { path: line for path, line in zip(paths, lines) if line != '-' }
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Upload changed files to the board.')
+    parser.add_argument('device', help='serial device or IP address of the board')
+    parser.add_argument('files', nargs='+', help='files to deploy, as local:device or local')
+    parser.add_argument('--full', action='store_true', help='hash every file on the board, ignoring the manifest')
+    parser.add_argument('--chunk-size', type=int, default=256, help='bytes per upload command (default: 256)')
+    args = parser.parse_args(argv)
+
+    files = parseFiles(args.files)
+
+    board = Pyboard(args.device)
+
+    try:
+        board.enter_raw_repl()
+        result = Sync(board, args.chunk_size).run(files, args.full)
+        board.exit_raw_repl()
+    except PyboardError as e:
+        print('sync failed: {}'.format(e))
+        return 1
+    finally:
+        board.close()
+
+    for device in result['uploaded']:
+        print('uploaded {}'.format(device))
+
+    print('{} uploaded, {} unchanged ({} directories skipped); sent {} of {} bytes, {} saved'.format(
+        len(result['uploaded']), len(result['skipped']), len(result['skippedDirectories']),
+        result['sent'], result['bytes'], result['saved']))
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,290 @@
+"""
+Matt Clarke 2021.
+Turns IMU samples into drone control values. Has no dependency on the IMU
+itself, so runs on the board against live samples, or on a workstation
+against recorded ones.
+
+On a workstation, a recorded trace can be checked and timed with:
+
+    python controlstate.py trace.csv
+
+where the trace is a CSV file with a header row, then one row per sample:
+
+    time,x,y,z,heading,roll,pitch
+
+with `time` in milliseconds, `x,y,z` from imu.lin_acc() and `heading,roll,pitch`
+from imu.euler().
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import math
+
+from throttle import Throttle
+
+ACCEL_VEL_TRANSITION = 10.0 / 1000.0
+DEG_2_RAD = 0.01745329251
+
+# Control values when the IMU is flipped over, to force a landing
+LANDING = [0.0, 0.5, 0.5, 0.5]
+
+class ControlState():
+    """
+    The pipeline from one IMU sample to [throttle, pitch, roll, yaw]:
+
+    - z linear acceleration becomes a velocity, which drives the Throttle
+      gesture model
+    - roll and pitch angles are scaled to [0.0 to 1.0], with deadbands
+      around level
+    - flipping the IMU over forces a landing
+
+    Exported methods:
+    - compute(linAcc, euler)
+    - computeThrottle(zVel)
+    - computeBatch(times, linAcc, euler)
+
+    Example:
+
+        controlState = ControlState(Throttle())
+
+        while True:
+            [throttle, pitch, roll, yaw] = controlState.compute(imu.lin_acc(), imu.euler())
+    """
+
+    def __init__(self, throttle = None, midpoint = 4, rollFactor = 180, pitchFactor = 155):
+        """
+        Parameters:
+            throttle    (Throttle): Gesture model, holding state between samples. Defaults to a new Throttle.
+            midpoint    (float):    Velocity that starts a throttle gesture
+            rollFactor  (float):    Degrees of roll for full deflection
+            pitchFactor (float):    Degrees of pitch for full deflection
+        """
+
+        self.throttle = Throttle() if throttle is None else throttle
+        self.midpoint = midpoint
+        self.rollFactor = rollFactor
+        self.pitchFactor = pitchFactor
+
+    def compute(self, linAcc, euler):
+        """
+        Processes one IMU sample.
+
+        Parameters:
+            linAcc (list): [x, y, z] linear acceleration, as from imu.lin_acc()
+            euler  (list): [heading, roll, pitch] in degrees, as from imu.euler()
+
+        Returns:
+            [throttle, pitch, roll, yaw], as for Drone.control()
+        """
+
+        yaw = 0.5
+
+        z = linAcc[2]
+        roll = euler[1]
+        pitch = euler[2]
+
+        zVel = (ACCEL_VEL_TRANSITION * z / math.cos(DEG_2_RAD * z)) * 1000.0
+
+        throttle = self.computeThrottle(zVel)
+
+        if abs(pitch) > 140:
+            return list(LANDING)
+
+        # Euler angle handling
+        roll = 1.0 - ((roll / self.rollFactor) + 0.5)
+        if roll > 1.0: roll = 1.0
+        elif roll < 0.0: roll = 0.0
+        elif roll > 0.44 and roll < 0.56: roll = 0.5
+
+        pitch = 1.0 - ((pitch / self.pitchFactor) + 0.5)
+        if pitch > 1.0: pitch = 1.0
+        elif pitch < 0.0: pitch = 0.0
+        elif pitch > 0.44 and pitch < 0.56: pitch = 0.5
+
+        return [throttle, pitch, roll, yaw]
+
+    def computeThrottle(self, zVel):
+        """
+        Steps the throttle gesture model by one sample, as compute() does.
+
+        Parameters:
+            zVel (float): z velocity, derived from linear acceleration as in compute()
+
+        Returns:
+            The throttle value, limited to [0.0 to 1.0], with a deadband around 0.5
+        """
+
+        self.throttle.tick(zVel, self.midpoint)
+        throttle = self.throttle.compute()
+
+        if throttle > 1.0: throttle = 1.0
+        elif throttle < 0.0: throttle = 0.0
+        elif throttle > 0.48 and throttle < 0.52: throttle = 0.5
+
+        return throttle
+
+    def computeBatch(self, times, linAcc, euler):
+        """
+        Processes a whole recorded trace in one call, giving the same results
+        as compute() once per sample. Workstation only; requires NumPy.
+
+        Everything but the throttle gesture model is vectorised. The gesture
+        model is a state machine, so is stepped through the precomputed
+        velocities in order, on a clock reading `times`.
+
+        The throttle state is continued from, and left in, this instance's
+        Throttle, as if compute() had been called; but its clock is replaced
+        for the duration of the call.
+
+        Parameters:
+            times  (array): Sample times in milliseconds, shape (n,)
+            linAcc (array): Linear acceleration, shape (n, 3)
+            euler  (array): Euler angles in degrees, shape (n, 3)
+
+        Returns:
+            A float64 array of shape (n, 4), with columns throttle, pitch, roll, yaw
+        """
+
+        # Not available on the board, so only imported here
+        import numpy as np
+
+        linAcc = np.asarray(linAcc, dtype=np.float64)
+        euler = np.asarray(euler, dtype=np.float64)
+        times = np.asarray(times)
+
+        count = linAcc.shape[0]
+        z = linAcc[:, 2]
+
+        zVel = (ACCEL_VEL_TRANSITION * z / np.cos(DEG_2_RAD * z)) * 1000.0
+
+        out = np.empty((count, 4), dtype=np.float64)
+        out[:, 0] = self.__runThrottle(times.tolist(), zVel.tolist())
+        out[:, 1] = _scale(np, euler[:, 2], self.pitchFactor, 0.44, 0.56)
+        out[:, 2] = _scale(np, euler[:, 1], self.rollFactor, 0.44, 0.56)
+        out[:, 3] = 0.5
+
+        throttle = out[:, 0]
+        throttle[throttle > 1.0] = 1.0
+        throttle[throttle < 0.0] = 0.0
+        throttle[(throttle > 0.48) & (throttle < 0.52)] = 0.5
+
+        out[np.abs(euler[:, 2]) > 140] = LANDING
+
+        return out
+
+    #############################################################################
+    # Private
+    #############################################################################
+
+    def __runThrottle(self, times, velocities):
+        throttle = self.throttle
+        midpoint = self.midpoint
+        tick = throttle.tick
+        compute = throttle.compute
+
+        now = [0]
+        clock = throttle._clock
+        diff = throttle._diff
+
+        throttle._clock = lambda: now[0]
+        throttle._diff = _subtract
+
+        values = [0.0] * len(velocities)
+
+        try:
+            for i in range(len(velocities)):
+                now[0] = times[i]
+                tick(velocities[i], midpoint)
+                values[i] = compute()
+        finally:
+            throttle._clock = clock
+            throttle._diff = diff
+
+        return values
+
+def verify(times, linAcc, euler, **kwargs):
+    """
+    Runs a trace through both compute() and computeBatch(), each from a fresh
+    ControlState, and checks they agree exactly. Workstation only.
+
+    Parameters:
+        times, linAcc, euler: as for ControlState.computeBatch()
+        kwargs: passed to ControlState, e.g. midpoint
+
+    Returns:
+        A tuple of (equal, batch output, per-sample output)
+    """
+
+    import numpy as np
+
+    batch = ControlState(**kwargs).computeBatch(times, linAcc, euler)
+
+    # Plain floats, as the IMU driver gives
+    times = np.asarray(times).tolist()
+    linAcc = np.asarray(linAcc, dtype=np.float64).tolist()
+    euler = np.asarray(euler, dtype=np.float64).tolist()
+
+    now = [0]
+    single = ControlState(Throttle(clock=lambda: now[0]), **kwargs)
+    rows = []
+
+    for i in range(len(times)):
+        now[0] = times[i]
+        rows.append(single.compute(linAcc[i], euler[i]))
+
+    perSample = np.array(rows, dtype=np.float64).reshape(-1, 4)
+
+    return (np.array_equal(batch, perSample), batch, perSample)
+
+def loadTrace(path):
+    """
+    Reads a recorded IMU trace, as described at the top of this file.
+    Workstation only.
+
+    Returns:
+        A tuple of (times, linAcc, euler) arrays
+    """
+
+    import numpy as np
+
+    data = np.loadtxt(path, delimiter=',', skiprows=1, ndmin=2)
+
+    return (data[:, 0].astype(np.int64), data[:, 1:4], data[:, 4:7])
+
+#############################################################################
+# Private
+#############################################################################
+
+def _subtract(a, b):
+    return a - b
+
+def _scale(np, angle, factor, low, high):
+    # As compute(), for roll and pitch
+    value = 1.0 - ((angle / factor) + 0.5)
+    value = np.where(value > 1.0, 1.0, value)
+    value = np.where(value < 0.0, 0.0, value)
+    return np.where((value > low) & (value < high), 0.5, value)
+
+if __name__ == '__main__':
+    import sys
+    import time
+
+    times, linAcc, euler = loadTrace(sys.argv[1])
+
+    start = time.perf_counter()
+    equal, batch, perSample = verify(times, linAcc, euler)
+    elapsed = time.perf_counter() - start
+
+    print('{} samples, batch and per-sample {}, {:.3f}s for both'.format(
+        len(times), 'agree' if equal else 'DISAGREE', elapsed))
+
+    sys.exit(0 if equal else 1)
@@ -19,13 +19,13 @@ this program. If not, see <http://www.gnu.org/licenses/>.
 """
 
 import time
-import math
 import network
 
 from bno055 import *
 import machine
 from dotstar import DotStar
 from throttle import Throttle
+from controlstate import ControlState
 
 from drone import Drone
 
@@ -52,46 +52,11 @@ spi = machine.SoftSPI(sck=machine.Pin(12), mosi=machine.Pin(2), miso=machine.Pin
 imu = BNO055(i2c)
 dotstar = DotStar(spi, 1)
 throttleManager = Throttle()
+controlState = ControlState(throttleManager, midpoint=4)
 drone = Drone()
 
 def computeControlState():
-    global throttleManager
-
-    rollFactor = 180
-    pitchFactor = 155
-
-    yaw = 0.5
-
-    [x,y,z] = imu.lin_acc()
-    [heading, roll, pitch] = imu.euler()
-
-    ACCEL_VEL_TRANSITION =  10.0 / 1000.0
-    DEG_2_RAD = 0.01745329251
-
-    zVel = (ACCEL_VEL_TRANSITION * z / math.cos(DEG_2_RAD * z)) * 1000.0
-
-    throttleManager.tick(zVel, 4)
-    throttle = throttleManager.compute()
-
-    if throttle > 1.0: throttle = 1.0
-    elif throttle < 0.0: throttle = 0.0
-    elif throttle > 0.48 and throttle < 0.52: throttle = 0.5
-
-    if abs(pitch) > 140:
-        return [0.0, 0.5, 0.5, 0.5]
-
-    # Euler angle handling
-    roll = 1.0 - ((roll / rollFactor) + 0.5)
-    if roll > 1.0: roll = 1.0
-    elif roll < 0.0: roll = 0.0
-    elif roll > 0.44 and roll < 0.56: roll = 0.5
-
-    pitch = 1.0 - ((pitch / pitchFactor) + 0.5)
-    if pitch > 1.0: pitch = 1.0
-    elif pitch < 0.0: pitch = 0.0
-    elif pitch > 0.44 and pitch < 0.56: pitch = 0.5
-
-    return [throttle, pitch, roll, yaw]
+    return controlState.compute(imu.lin_acc(), imu.euler())
 
 if __name__ == '__main__':
     # Turn on LED
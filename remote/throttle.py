@@ -15,6 +15,21 @@ this program. If not, see <http://www.gnu.org/licenses/>.
 
 import time
 
+# Millisecond clock, as in lib/drone.py. MicroPython's ticks wrap around, so
+# must be compared with ticks_diff; elsewhere, a plain monotonic clock does.
+try:
+    ticksMs = time.ticks_ms
+    ticksDiff = time.ticks_diff
+except AttributeError:
+    def ticksMs():
+        return int(time.monotonic() * 1000)
+
+    def ticksDiff(a, b):
+        return a - b
+
+def _subtract(a, b):
+    return a - b
+
 class Throttle():
     """
     Throttle is driven by linear acceleration in the z axis.
@@ -26,24 +41,78 @@ class Throttle():
     The greater the acceleration, the longer this decay occurs, resulting
     in a longer period of acceleration on the remote hardware. As a result,
     this produces a larger vertical translation.
+
+    tick() allocates no lists, so can run at IMU rate without garbage
+    collection pauses. The clock is injectable, so recorded traces can be run
+    through faster than real time on a workstation:
+
+        t = 0
+        throttle = Throttle(clock=lambda: t)
+
+        for vel in trace:
+            throttle.tick(vel, 4)
+            t += 10
     """
 
     BASE          = 0
     PEAK          = 1
     WAIT          = 2
 
-    state         = BASE
-    direction     = 0
-    value         = 0.5
-    previous      = []
-    peakValue     = 0.0
-    waitStart     = 0
-    waitDuration  = 0
-    peakStart     = 0
-    peakToggled   = False
-
     PEAK_TIMEOUT  = 500
 
+    __slots__ = (
+        'state', 'direction', 'value', 'peakValue', 'waitStart', 'waitDuration', 'peakStart', 'peakToggled',
+        'previous', 'previousIndex', 'previousCount',
+        'peakTimeout', 'peakGain', 'waitScale', 'waitBase',
+        '_clock', '_diff',
+    )
+
+    def __init__(self, clock = None, peakTimeout = PEAK_TIMEOUT, peakGain = 1.82, waitScale = 120, waitBase = 60, history = 3):
+        """
+        Parameters:
+            clock       (callable): Returns the time in milliseconds. Defaults to time.ticks_ms
+                                    on MicroPython, or a monotonic clock elsewhere.
+            peakTimeout (int):      Milliseconds after which a peak is abandoned
+            peakGain    (float):    Scales peak velocity into throttle
+            waitScale   (float):    Milliseconds of decay for a full throttle peak
+            waitBase    (float):    Milliseconds of decay for any peak
+            history     (int):      Number of previous velocities that must settle before decaying
+        """
+
+        if clock is None:
+            self._clock = ticksMs
+            self._diff = ticksDiff
+        else:
+            self._clock = clock
+            self._diff = _subtract
+
+        self.peakTimeout = peakTimeout
+        self.peakGain = peakGain
+        self.waitScale = waitScale
+        self.waitBase = waitBase
+
+        # Ring buffer of the most recent velocities, oldest overwritten first
+        self.previous = [0.0] * history
+
+        self.reset()
+
+    def reset(self):
+        """
+        Returns to the base state, forgetting any previous velocities.
+        """
+
+        self.state = Throttle.BASE
+        self.direction = 0
+        self.value = 0.5
+        self.peakValue = 0.0
+        self.waitStart = 0
+        self.waitDuration = 0
+        self.peakStart = 0
+        self.peakToggled = False
+
+        self.previousIndex = 0
+        self.previousCount = 0
+
     def sign(self, value):
         return (value > 0) - (value < 0)
 
@@ -54,11 +123,11 @@ class Throttle():
             if vel > midpoint:
                 self.state = Throttle.PEAK
                 self.direction = 1
-                self.peakStart = time.ticks_ms()
+                self.peakStart = self._clock()
             elif vel < 0 - midpoint:
                 self.state = Throttle.PEAK
                 self.direction = -1
-                self.peakStart = time.ticks_ms()
+                self.peakStart = self._clock()
 
         elif self.state == Throttle.PEAK:
             directionCheck = False
@@ -73,17 +142,22 @@ class Throttle():
             # Only change current throttle when heading towards peak, and ignore
             # lower values when velocity is dropped due to reduced motion.
             if not directionCheck:
-                self.value = ((self.peakValue * 1.82) + 100) / 200.0
+                self.value = ((self.peakValue * self.peakGain) + 100) / 200.0
 
             # Check previous and current, then see if we're in the endgame
             allInBounds = True
-            for prev in self.previous:
+            previous = self.previous
+            i = 0
+            while i < self.previousCount:
+                prev = previous[i]
                 if not (prev > 0 - midpoint and prev < midpoint):
                     allInBounds = False
+                    break
+                i += 1
 
-            diff = time.ticks_diff(time.ticks_ms(), self.peakStart)
+            diff = self._diff(self._clock(), self.peakStart)
 
-            if diff > Throttle.PEAK_TIMEOUT:
+            if diff > self.peakTimeout:
                 self.state = Throttle.BASE
                 self.value = 0.5
                 self.peakValue = 0.0
@@ -97,12 +171,12 @@ class Throttle():
                   vel < (midpoint / 2) and
                   allInBounds):
 
-                self.waitStart = time.ticks_ms()
-                self.waitDuration = abs(((self.value - 0.5) * 2) * 120) + 60
+                self.waitStart = self._clock()
+                self.waitDuration = abs(((self.value - 0.5) * 2) * self.waitScale) + self.waitBase
                 self.state = Throttle.WAIT
 
         elif self.state == Throttle.WAIT:
-            diff = time.ticks_diff(time.ticks_ms(), self.waitStart)
+            diff = self._diff(self._clock(), self.waitStart)
 
             if diff > self.waitDuration:
                 self.waitStart = 0
@@ -111,10 +185,13 @@ class Throttle():
                 self.peakValue = 0.0
                 self.peakToggled = False
 
-        if len(self.previous) >= 3:
-            self.previous.pop()
-
-        self.previous.append(vel)
+        # Overwrite the oldest velocity
+        self.previous[self.previousIndex] = vel
+        self.previousIndex += 1
+        if self.previousIndex == len(self.previous):
+            self.previousIndex = 0
+        if self.previousCount < len(self.previous):
+            self.previousCount += 1
 
     def compute(self):
-        return self.value
\ No newline at end of file
+        return self.value
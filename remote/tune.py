@@ -0,0 +1,199 @@
+"""
+Matt Clarke 2021.
+Offline tuner for the Throttle gesture model. Replays recorded z-velocity
+traces through Throttle, across many parameter sets in parallel, and ranks
+each set by how closely it follows a target throttle curve.
+
+Runs on a workstation, not on the board.
+
+Usage:
+    python tune.py trace.csv [trace.csv ...] [--random 5000] [--seed 1] [--top 20]
+
+Each trace is a CSV file with a header row, then one row per IMU sample:
+
+    time,zvel,target
+    0,0.12,0.5
+    10,5.31,0.62
+    ...
+
+where `time` is in milliseconds, `zvel` is as computed in controlstate.py, and
+`target` is the throttle that should have been produced.
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import csv
+import itertools
+import math
+import random
+import sys
+
+from controlstate import ControlState
+from throttle import Throttle
+
+# Values tried by the grid search, for each parameter
+GRID = {
+    'peakTimeout': [300, 400, 500, 600, 700],
+    'peakGain':    [1.4, 1.5, 1.6, 1.7, 1.82, 1.9, 2.0, 2.1, 2.2],
+    'waitScale':   [60, 90, 120, 150, 180],
+    'waitBase':    [30, 60, 90],
+    'midpoint':    [2, 3, 4, 5, 6],
+}
+
+# (low, high) for each parameter, for the random search
+BOUNDS = {
+    'peakTimeout': (200, 800),
+    'peakGain':    (1.0, 2.5),
+    'waitScale':   (30, 240),
+    'waitBase':    (0, 120),
+    'midpoint':    (1, 8),
+}
+
+PARAMETERS = ('peakTimeout', 'peakGain', 'waitScale', 'waitBase', 'midpoint')
+
+def loadTrace(path):
+    """
+    Reads a recorded trace.
+
+    Parameters:
+        path (string): A CSV file, as described at the top of this file
+
+    Returns:
+        A tuple of (times, velocities, targets) lists
+    """
+
+    times = []
+    velocities = []
+    targets = []
+
+    with open(path, newline='') as f:
+        for row in csv.DictReader(f):
+            times.append(int(float(row['time'])))
+            velocities.append(float(row['zvel']))
+            targets.append(float(row['target']))
+
+    return (times, velocities, targets)
+
+def gridSearch(grid = GRID):
+    """
+    Returns:
+        A list of parameter dicts, one for every combination in `grid`
+    """
+
+    return [dict(zip(PARAMETERS, values)) for values in itertools.product(*(grid[name] for name in PARAMETERS))]
+
+def randomSearch(count, bounds = BOUNDS, seed = None):
+    """
+    Returns:
+        A list of `count` parameter dicts, drawn uniformly from `bounds`
+    """
+
+    generator = random.Random(seed)
+
+    return [{ name: generator.uniform(*bounds[name]) for name in PARAMETERS } for _ in range(count)]
+
+def score(traces, parameters):
+    """
+    Replays every trace through a ControlState built from `parameters`, so
+    throttle is produced exactly as it is in flight.
+
+    Returns:
+        The root mean square error between the throttle produced and each
+        trace's target
+    """
+
+    total = 0.0
+    count = 0
+
+    for times, velocities, targets in traces:
+        now = [0]
+
+        throttle = Throttle(
+            clock=lambda: now[0],
+            peakTimeout=parameters['peakTimeout'],
+            peakGain=parameters['peakGain'],
+            waitScale=parameters['waitScale'],
+            waitBase=parameters['waitBase'])
+
+        computeThrottle = ControlState(throttle, midpoint=parameters['midpoint']).computeThrottle
+
+        for i in range(len(times)):
+            now[0] = times[i]
+
+            error = computeThrottle(velocities[i]) - targets[i]
+            total += error * error
+
+        count += len(times)
+
+    return math.sqrt(total / count) if count > 0 else 0.0
+
+def tune(traces, candidates, workers = None, chunkSize = 64):
+    """
+    Scores every parameter set across a process pool.
+
+    Parameters:
+        traces     (list): Traces from loadTrace()
+        candidates (list): Parameter dicts, e.g. from gridSearch() or randomSearch()
+        workers    (int):  Processes to use, defaulting to one per CPU
+        chunkSize  (int):  Parameter sets handed to a process at once
+
+    Returns:
+        A list of (score, parameters) tuples, best (lowest) score first
+    """
+
+    chunks = [candidates[i:i + chunkSize] for i in range(0, len(candidates), chunkSize)]
+
+    # Traces are sent to each process once, rather than with every chunk
+    with ProcessPoolExecutor(workers, initializer=_setTraces, initargs=(traces,)) as pool:
+        scores = [value for chunk in pool.map(_scoreChunk, chunks) for value in chunk]
+
+    return sorted(zip(scores, candidates), key=lambda result: result[0])
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Tune the Throttle gesture model against recorded traces.')
+    parser.add_argument('traces', nargs='+', help='CSV traces of time, zvel and target throttle')
+    parser.add_argument('--random', type=int, default=None, metavar='N', help='random search N parameter sets, instead of the grid')
+    parser.add_argument('--seed', type=int, default=None, help='seed for the random search')
+    parser.add_argument('--workers', type=int, default=None, help='processes to use (default: one per CPU)')
+    parser.add_argument('--top', type=int, default=20, help='rows of the ranked table to show (default: 20)')
+    args = parser.parse_args(argv)
+
+    traces = [loadTrace(path) for path in args.traces]
+    candidates = gridSearch() if args.random is None else randomSearch(args.random, seed=args.seed)
+
+    results = tune(traces, candidates, args.workers)
+
+    print('{:>4} {:>10} {:>12} {:>10} {:>10} {:>10} {:>10}'.format('rank', 'rmse', *PARAMETERS))
+
+    for rank, (value, parameters) in enumerate(results[:args.top], 1):
+        print('{:>4} {:>10.5f} {:>12.1f} {:>10.3f} {:>10.1f} {:>10.1f} {:>10.2f}'.format(
+            rank, value, *(parameters[name] for name in PARAMETERS)))
+
+    return 0
+
+#############################################################################
+# Private
+#############################################################################
+
+_traces = None
+
+def _setTraces(traces):
+    global _traces
+    _traces = traces
+
+def _scoreChunk(chunk):
+    return [score(_traces, parameters) for parameters in chunk]
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))